@@ -0,0 +1,396 @@
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from itertools import accumulate
+from typing import Callable, Iterable, Iterator, Optional
+
+from bfops import Context, PyOpCode, arg_size, encode_instruction
+from targets import COMPARE_MASKS, TARGET_310, Target
+
+OPNAMES = {op.value: op.name for op in PyOpCode}
+# location entry code for a line without column information
+LOCATION_NO_COLUMNS = 13
+INVERTED_BRANCHES = {
+    "POP_JUMP_IF_FALSE": "POP_JUMP_IF_TRUE",
+    "POP_JUMP_IF_TRUE": "POP_JUMP_IF_FALSE",
+}
+
+
+@dataclass
+class Stream:
+    """Instruction stream of a target version, laid out like the one of
+    `Context` but with jumps pointing at instruction indices"""
+
+    op_codes: array = field(default_factory=lambda: array("B"))
+    op_args: array = field(default_factory=lambda: array("B"))
+    wide_args: dict[int, int] = field(default_factory=dict)
+    # instruction index -> index of the instruction it jumps to
+    jumps: dict[int, int] = field(default_factory=dict)
+    stacksize: int = 0
+    # (instruction index, line) wherever the line changes, see `Context.lines`
+    lines: list[tuple[int, int]] = field(default_factory=list)
+    # (first, end, handler) instruction indices of the ranges protected by an
+    # exception handler, on targets using exception tables; the handler
+    # unwinds the stack to empty
+    handlers: list[tuple[int, int, int]] = field(default_factory=list)
+
+    def append(self, target: Target, name: str, value: int = 0) -> int:
+        """Appends an instruction followed by its inline caches
+
+        Returns:
+            int: index of the instruction
+        """
+        idx = len(self.op_codes)
+        if not 0 <= value <= 0xFF:
+            arg_size(value)  # validate early
+            self.wide_args[idx] = value
+            value &= 0xFF
+        self.op_codes.append(target.opcode(name))
+        self.op_args.append(value)
+        caches = target.caches.get(name, 0)
+        if caches:
+            self.op_codes.extend(bytes(caches))
+            self.op_args.extend(bytes(caches))
+        return idx
+
+
+def lower(ctx: Context, target: Target = TARGET_310) -> Stream:
+    """Rewrites the 3.10 instructions of `ctx` for `target`
+
+    Most instructions are replaced following `target.rewrites`. Jumps become
+    forward or backward ones depending on where their label is, calls get the
+    NULL newer versions expect next to the callable and conditional jumps
+    are preceded by TO_BOOL where needed. SETUP_FINALLY and POP_BLOCK only
+    delimit an entry of `Stream.handlers`.
+
+    Raises:
+        ValueError: if a label was never placed or an instruction has no
+            equivalent on `target`
+    """
+    count = len(ctx.op_codes)
+    for label in ctx.jump_targets.values():
+        if not 0 <= label.index <= count:
+            raise ValueError("jump to an unplaced label")
+    if target.abstract:
+        return Stream(
+            ctx.op_codes,
+            ctx.op_args,
+            ctx.wide_args,
+            {idx: label.index for idx, label in ctx.jump_targets.items()},
+            ctx.stacksize,
+            ctx.lines,
+        )
+    stream = Stream(stacksize=ctx.stacksize + target.stack_margin)
+    append = stream.append
+    calls = target.rewrites["CALL_METHOD"]
+    labelled = {label.index for label in ctx.jump_targets.values()}
+    # abstract instruction index -> index of its first replacement
+    starts = array("L")
+    # (replacement jump index, abstract index it jumps to)
+    pending: list[tuple[int, int]] = []
+    # (first replacement index, abstract index of the handler) of open blocks
+    blocks: list[tuple[int, int]] = []
+    handlers: list[tuple[int, int, int]] = []
+    bool_on_stack = False
+    generator = count > 0 and ctx.op_codes[0] == PyOpCode.GEN_START.value
+    if target.resume and not generator:
+        # generators resume after the rewritten GEN_START instead
+        append(target, "RESUME", 0)
+    for idx in range(count):
+        starts.append(len(stream.op_codes))
+        name = OPNAMES[ctx.op_codes[idx]]
+        value = ctx.wide_args.get(idx, ctx.op_args[idx])
+        if name == "SETUP_FINALLY":
+            blocks.append((len(stream.op_codes), ctx.jump_targets[idx].index))
+            continue
+        if name == "POP_BLOCK":
+            first, handler = blocks.pop()
+            handlers.append((first, len(stream.op_codes), handler))
+            continue
+        if name in target.branches:
+            destination = ctx.jump_targets[idx].index
+            forward, backward = target.branches[name]
+            conditional = name in INVERTED_BRANCHES
+            if conditional and target.to_bool and not bool_on_stack:
+                append(target, "TO_BOOL")
+            if destination > idx:
+                pending.append((append(target, forward), destination))
+            elif backward is not None:
+                pending.append((append(target, backward), destination))
+            elif conditional:
+                # jump back unconditionally unless the inverted condition
+                # skips over it
+                skip = append(target, INVERTED_BRANCHES[name])
+                jump = target.branches["JUMP_ABSOLUTE"][1]
+                pending.append((append(target, jump), destination))
+                stream.jumps[skip] = len(stream.op_codes)
+            else:
+                raise ValueError(f"{name} can't jump backwards")
+            bool_on_stack = False
+            continue
+        bool_on_stack = False
+        if name == "COMPARE_OP":
+            arg = value << target.compare_shift
+            if target.compare_masks:
+                arg |= COMPARE_MASKS[value]
+            if (
+                target.compare_bool
+                and idx + 1 < count
+                and OPNAMES[ctx.op_codes[idx + 1]] in INVERTED_BRANCHES
+                and idx + 1 not in labelled
+            ):
+                arg |= target.compare_bool
+                bool_on_stack = True
+            append(target, name, arg)
+        elif name == "CALL_FUNCTION":
+            if value == 0:
+                append(target, "PUSH_NULL")
+                if not target.null_above_callable:
+                    append(target, "SWAP", 2)
+            else:
+                # the callable takes the place of a bound method's function
+                # and the first argument the one of `self`
+                value -= 1
+            for op in calls:
+                append(target, op.name, value)
+        elif name == "MAKE_FUNCTION":
+            if not target.qualname_on_stack:
+                append(target, "POP_TOP")
+            if not target.function_attributes:
+                append(target, name, value)
+                continue
+            append(target, name)
+            # the extras are below the function, the last pushed on top
+            for flag in (0x08, 0x04, 0x02, 0x01):
+                if value & flag:
+                    append(target, "SET_FUNCTION_ATTRIBUTE", flag)
+        elif name in target.rewrites:
+            for op in target.rewrites[name]:
+                arg = op.value
+                if arg is None:
+                    arg = value << op.shift | op.flag
+                append(target, op.name, arg)
+        else:
+            append(target, name, value)
+    starts.append(len(stream.op_codes))
+    for jump, destination in pending:
+        stream.jumps[jump] = starts[destination]
+    stream.lines = [(starts[idx], line) for idx, line in ctx.lines]
+    stream.handlers = [
+        (first, end, starts[handler]) for first, end, handler in handlers
+    ]
+    return stream
+
+
+def resolve_jumps(
+    stream: Stream, target: Target = TARGET_310
+) -> dict[int, int]:
+    """Computes the size in code units of every instruction that needs
+    EXTENDED_ARG prefixes and patches the argument of every jump with the final
+    position of its target
+
+    Jump targets are instruction offsets, which depend on how many
+    EXTENDED_ARG prefixes every instruction before them needs. Sizes start at
+    one code unit and only ever grow, so repeating until nothing changes
+    reaches a fixpoint. Only the few instructions wider than one code unit are
+    tracked, offsets of the others are found by bisecting over them.
+
+    Args:
+        stream (Stream): instructions whose `op_args` and `wide_args` get
+            patched
+        target (Target): version deciding how jump arguments are encoded
+
+    Raises:
+        ValueError: if a jump goes the wrong way for its opcode
+
+    Returns:
+        dict[int, int]: instruction index -> size, for sizes above one
+    """
+    kinds = {target.opcode(name): kind for name, kind in target.jumps.items()}
+    caches = {target.opcode(name): size for name, size in target.caches.items()}
+    sizes = {idx: arg_size(value) for idx, value in stream.wide_args.items()}
+    jumps = []
+    for idx, destination in stream.jumps.items():
+        code = stream.op_codes[idx]
+        if code not in kinds:
+            raise ValueError(f"opcode {code} is not a jump")
+        following = idx + 1 + caches.get(code, 0)
+        jumps.append((idx, destination, kinds[code], following))
+    changed = True
+    while changed:
+        changed = False
+        wide = sorted(sizes)
+        extra = list(accumulate(sizes[idx] - 1 for idx in wide))
+
+        def offset(idx: int) -> int:
+            position = bisect_left(wide, idx)
+            return idx + (extra[position - 1] if position else 0)
+
+        for idx, destination, kind, following in jumps:
+            if kind == "absolute":
+                value = offset(destination)
+            elif kind == "forward":
+                value = offset(destination) - offset(following)
+            else:
+                value = offset(following) - offset(destination)
+            if value < 0:
+                raise ValueError(f"opcode {stream.op_codes[idx]} can't jump {kind}")
+            stream.op_args[idx] = value & 0xFF
+            if value > 0xFF:
+                stream.wide_args[idx] = value
+            else:
+                stream.wide_args.pop(idx, None)
+            size = arg_size(value)
+            if size > sizes.get(idx, 1):
+                sizes[idx] = size
+                changed = True
+    return sizes
+
+
+def assemble(
+    stream: Stream, target: Target = TARGET_310, sizes: Optional[dict[int, int]] = None
+) -> bytearray:
+    """Encodes the instruction stream into a co_code buffer
+
+    Runs of one code unit instructions are interleaved straight from the
+    opcode and argument arrays, only wide instructions are encoded one by one.
+
+    Args:
+        sizes (Optional[dict[int, int]]): result of `resolve_jumps`, which is
+            called when omitted
+    """
+    if sizes is None:
+        sizes = resolve_jumps(stream, target)
+    extended_arg = target.opcode("EXTENDED_ARG")
+    code = bytearray()
+    start = 0
+    for idx in sorted(sizes) + [len(stream.op_codes)]:
+        run = bytearray(2 * (idx - start))
+        run[0::2] = stream.op_codes[start:idx]
+        run[1::2] = stream.op_args[start:idx]
+        code += run
+        if idx == len(stream.op_codes):
+            break
+        value = stream.wide_args.get(idx, stream.op_args[idx])
+        code += encode_instruction(
+            stream.op_codes[idx], value, sizes[idx], extended_arg
+        )
+        start = idx + 1
+    return code
+
+
+def code_offsets(sizes: dict[int, int]) -> Callable[[int], int]:
+    """Maps instruction indices to the offset in code units of their first
+    EXTENDED_ARG prefix, or of the instruction itself"""
+    wide = sorted(sizes)
+    extra = [0, *accumulate(sizes[idx] - 1 for idx in wide)]
+
+    def offset(idx: int) -> int:
+        return idx + extra[bisect_left(wide, idx)]
+
+    return offset
+
+
+def line_ranges(
+    stream: Stream, sizes: dict[int, int]
+) -> Iterator[tuple[int, int, int]]:
+    """Yields (start, end, line) for the runs of code units on the same line,
+    with the EXTENDED_ARG prefixes of an instruction counted in its run"""
+    offset = code_offsets(sizes)
+    changes = [(0, 0), *stream.lines, (len(stream.op_codes), None)]
+    for (idx, line), (following, _) in zip(changes, changes[1:]):
+        start, end = offset(idx), offset(following)
+        if start < end:
+            yield start, end, line
+
+
+def _varint(value: int) -> bytes:
+    """Unsigned integer in 6 bit chunks, least significant first, with 0x40
+    set on every chunk but the last"""
+    chunks = bytearray()
+    while value >= 0x40:
+        chunks.append(0x40 | value & 0x3F)
+        value >>= 6
+    chunks.append(value)
+    return bytes(chunks)
+
+
+def _except_varint(value: int, start: bool = False) -> bytes:
+    """Unsigned integer in 6 bit chunks, most significant first, with 0x40
+    set on every chunk but the last and 0x80 on the first of an entry"""
+    chunks = bytearray((value & 0x3F,))
+    value >>= 6
+    while value:
+        chunks.insert(0, 0x40 | value & 0x3F)
+        value >>= 6
+    if start:
+        chunks[0] |= 0x80
+    return bytes(chunks)
+
+
+def exception_table(stream: Stream, sizes: dict[int, int]) -> bytes:
+    """co_exceptiontable of the assembled `stream`: start, length and
+    handler of every protected range in code units, then the stack depth to
+    unwind to shifted left, its low bit not asking for the last offset"""
+    offset = code_offsets(sizes)
+    table = bytearray()
+    for first, end, handler in stream.handlers:
+        start = offset(first)
+        table += _except_varint(start, start=True)
+        table += _except_varint(offset(end) - start)
+        table += _except_varint(offset(handler))
+        table += _except_varint(0)
+    return bytes(table)
+
+
+def line_table(
+    stream: Stream, sizes: dict[int, int], target: Target = TARGET_310
+) -> bytes:
+    """co_linetable of the assembled `stream` for `target`"""
+    return encode_lines(line_ranges(stream, sizes), target.location_table)
+
+
+def encode_lines(
+    ranges: Iterable[tuple[int, int, int]],
+    location_table: bool = False,
+    firstlineno: int = 0,
+) -> bytes:
+    """Encodes (start, end, line) runs of code units into a co_linetable
+
+    3.10 stores pairs of a bytecode delta in bytes (at most 254) and a signed
+    line delta (at most 127 either way). 3.11 and later store location
+    entries of up to 8 code units; only the line is known here, so every
+    entry uses the "no column" form: a header byte followed by the line delta
+    as a signed varint. Deltas are relative to the previous line, starting
+    from `firstlineno`.
+    """
+    table = bytearray()
+    previous = firstlineno
+    for start, end, line in ranges:
+        delta = line - previous
+        previous = line
+        length = end - start
+        if location_table:
+            # later entries of a long run repeat the line, a delta of 0
+            first = min(length, 8)
+            table.append(0x80 | LOCATION_NO_COLUMNS << 3 | first - 1)
+            table += _varint(-delta << 1 | 1 if delta < 0 else delta << 1)
+            full, rest = divmod(length - first, 8)
+            table += bytes((0x80 | LOCATION_NO_COLUMNS << 3 | 7, 0)) * full
+            if rest:
+                table += bytes((0x80 | LOCATION_NO_COLUMNS << 3 | rest - 1, 0))
+            continue
+        while delta > 127:
+            table += bytes((0, 127))
+            delta -= 127
+        while delta < -127:
+            table += bytes((0, -127 & 0xFF))
+            delta += 127
+        length *= 2
+        if length > 254:
+            table += bytes((254, delta & 0xFF))
+            full, length = divmod(length - 254, 254)
+            table += bytes((254, 0)) * full
+            delta = 0
+        table += bytes((length, delta & 0xFF))
+    return bytes(table)
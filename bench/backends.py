@@ -0,0 +1,77 @@
+"""Compares the bytecode and python backends on the running interpreter
+
+usage: python bench/backends.py [files ...] [-r REPEAT]
+
+The bytecode backend is skipped on versions it can't target.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyfuck import BACKENDS, CompileOptions, compile_to_code, run  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PROGRAMS = sorted(
+    glob.glob(os.path.join(ROOT, "bench", "programs", "*.b"))
+    + glob.glob(os.path.join(ROOT, "bfs", "*.bf"))
+)
+
+parser = argparse.ArgumentParser(description="PyFuck backend benchmark")
+parser.add_argument("files", nargs="*", default=DEFAULT_PROGRAMS)
+parser.add_argument(
+    "-r", "--repeat", type=int, default=3, help="runs per program, best is kept"
+)
+parser.add_argument(
+    "-i", "--input", default=None, help="file fed to the programs as stdin"
+)
+
+
+def measure(source: bytes, options: CompileOptions, stdin: bytes, repeat: int):
+    """Returns (compile seconds, best run seconds, output)"""
+    start = time.perf_counter()
+    code = compile_to_code(source, options, cache=None)
+    compiled = time.perf_counter() - start
+    best = float("inf")
+    for _ in range(repeat):
+        stdout = io.BytesIO()
+        start = time.perf_counter()
+        run(code, io.BytesIO(stdin), stdout)
+        best = min(best, time.perf_counter() - start)
+    return compiled, best, stdout.getvalue()
+
+
+def main():
+    args = parser.parse_args()
+    stdin = b""
+    if args.input is not None:
+        with open(args.input, "rb") as f:
+            stdin = f.read()
+    print(f"Python {sys.version.split()[0]}")
+    print(f"{'program':<24}{'backend':<10}{'compile':>10}{'run':>10}")
+    for path in args.files:
+        with open(path, "rb") as f:
+            source = f.read()
+        outputs = {}
+        for backend in BACKENDS:
+            try:
+                compiled, best, outputs[backend] = measure(
+                    source, CompileOptions(backend=backend), stdin, args.repeat
+                )
+            except RuntimeError as error:
+                print(f"{os.path.basename(path):<24}{backend:<10}  skipped: {error}")
+                continue
+            print(
+                f"{os.path.basename(path):<24}{backend:<10}"
+                f"{compiled:>9.3f}s{best:>9.3f}s"
+            )
+        if len(set(outputs.values())) > 1:
+            print(f"{os.path.basename(path)}: backends produced different output")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Runs programs through the reference interpreter and the compiler, diffs
+their outputs and reports how much faster the compiled code is
+
+usage: python bench/differential.py [files ...] [--fuzz N] [--backend B]
+                                    [--safety S]
+
+With --fuzz, N random programs are checked as well. Those accessing a cell
+off the tape must fail like in the interpreter, with the same IndexError
+after the same output, unless --safety is unchecked: they are skipped then.
+A few programs that fail after writing something are run on every backend
+and through bfbatch, to check that their output still gets out. Exits with
+status 1 if any output differs.
+"""
+import argparse
+import glob
+import io
+import os
+import random
+import sys
+import time
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bfbatch  # noqa: E402
+import interpreter  # noqa: E402
+from bfir import SAFETY_LEVELS  # noqa: E402
+from bfops import Tape  # noqa: E402
+from pyfuck import BACKENDS, CompileOptions, compile_to_code, run  # noqa: E402
+
+DEFAULT_PROGRAMS = sorted(
+    glob.glob(os.path.join(ROOT, "bench", "programs", "*.b"))
+    + glob.glob(os.path.join(ROOT, "bfs", "*.bf"))
+)
+
+# (source, compile options, output written before the IndexError)
+FAULTS = [
+    ("++++++++[>++++++++<-]>+.<<<<+", {"safety": "checked"}, b"A"),
+    ("+++++[>+++++++++++++<-]>.>>>>+", {"tape": Tape(size=4)}, b"A"),
+]
+# writes A then never stops, for the step limit of bfbatch
+ENDLESS = "++++++++[>++++++++<-]>+.+[]"
+
+parser = argparse.ArgumentParser(description="PyFuck differential test")
+parser.add_argument("files", nargs="*", default=DEFAULT_PROGRAMS)
+parser.add_argument("-i", "--input", help="file fed to the programs as stdin")
+parser.add_argument("--backend", choices=BACKENDS, default="bytecode")
+parser.add_argument("--safety", choices=SAFETY_LEVELS, default="unchecked")
+parser.add_argument("--fuzz", type=int, default=0, help="random programs to check")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument(
+    "--max-steps",
+    type=int,
+    default=10**6,
+    help="random programs running longer in the interpreter are skipped",
+)
+
+
+def random_body(rng: random.Random, depth: int = 0) -> str:
+    """Straight-line code mixed with clear, multiply and nested loops"""
+    parts = []
+    for _ in range(rng.randint(1, 8)):
+        kind = rng.random()
+        if kind < 0.3:
+            parts.append(rng.choice("+-") * rng.randint(1, 5))
+        elif kind < 0.5:
+            parts.append(rng.choice("<>") * rng.randint(1, 3))
+        elif kind < 0.6:
+            parts.append(".")
+        elif kind < 0.65:
+            parts.append(",")
+        elif kind < 0.75:
+            parts.append("[-]")
+        elif kind < 0.85:
+            step = rng.randint(1, 3)
+            factor = "+" * rng.randint(1, 3)
+            parts.append(f"[-{'>' * step}{factor}{'<' * step}]")
+        elif depth < 3:
+            parts.append(f"[{random_body(rng, depth + 1)}]")
+    return "".join(parts)
+
+
+def random_program(seed: int) -> str:
+    rng = random.Random(seed)
+    # start away from the left end so `<` stays on the tape
+    return ">" * 5 + "".join(random_body(rng) for _ in range(3))
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    except Exception as error:
+        result = error
+    return result, time.perf_counter() - start
+
+
+def run_compiled(source: bytes, stdin: bytes, options: CompileOptions) -> bytes:
+    stdout = io.BytesIO()
+    run(compile_to_code(source, options, cache=None), io.BytesIO(stdin), stdout)
+    return stdout.getvalue()
+
+
+def compiled_outcome(
+    source: bytes, stdin: bytes, options: CompileOptions
+) -> tuple[Optional[str], bytes]:
+    """The error the compiled program raised, if any, and its output"""
+    stdout = io.BytesIO()
+    try:
+        run(compile_to_code(source, options, cache=None), io.BytesIO(stdin), stdout)
+    except Exception as error:
+        return describe(error), stdout.getvalue()
+    return None, stdout.getvalue()
+
+
+def check_faults() -> int:
+    """Runs `FAULTS` on every backend, returns the number of mismatches"""
+    failures = 0
+    for source, options, expected in FAULTS:
+        for backend in BACKENDS:
+            stdout = io.BytesIO()
+            code = compile_to_code(
+                source, CompileOptions(backend=backend, **options), cache=None
+            )
+            try:
+                run(code, io.BytesIO(), stdout)
+            except IndexError:
+                pass
+            else:
+                failures += 1
+                print(f"{source} on {backend}: no IndexError")
+                continue
+            if stdout.getvalue() != expected:
+                failures += 1
+                got = describe(stdout.getvalue())
+                print(f"{source} on {backend}: wrote {got} before failing")
+    return failures
+
+
+def check_batch() -> int:
+    """Checks that bfbatch records that fail or run out of steps keep the
+    output written before, returns the number of mismatches"""
+    runs = [
+        (bfbatch.compile_program(source, CompileOptions(**options)), expected)
+        for source, options, expected in FAULTS
+    ]
+    options = CompileOptions(backend="python")
+    runs.append((bfbatch.compile_program(ENDLESS, options, max_steps=1000), b"A"))
+    failures = 0
+    for code, expected in runs:
+        result = bfbatch.run_record(code, b"")
+        if result.error is None or result.output != expected:
+            failures += 1
+            print(f"bfbatch: wrote {describe(result.output)}, {result.error}")
+    return failures
+
+
+def describe(result) -> str:
+    if isinstance(result, Exception):
+        return f"{type(result).__name__}: {result}"
+    return repr(result[:60])
+
+
+def outcome(error: Optional[str], output: bytes) -> str:
+    if error is None:
+        return describe(output)
+    return f"{describe(output)} then {error}"
+
+
+def main():
+    args = parser.parse_args()
+    stdin = b""
+    if args.input is not None:
+        with open(args.input, "rb") as f:
+            stdin = f.read()
+    options = CompileOptions(backend=args.backend, safety=args.safety)
+    failures = 0
+    print(f"{'program':<24}{'interpreter':>12}{'compiled':>12}{'speedup':>10}")
+    for path in args.files:
+        with open(path, "rb") as f:
+            source = f.read()
+        expected, reference = timed(interpreter.run, source, stdin)
+        got, compiled = timed(run_compiled, source, stdin, options)
+        name = os.path.basename(path)
+        if isinstance(expected, Exception) and isinstance(got, Exception):
+            print(f"{name:<24}failed in both: {describe(got)}")
+            continue
+        if expected != got:
+            failures += 1
+            print(f"{name:<24}MISMATCH {describe(expected)} != {describe(got)}")
+            continue
+        print(
+            f"{name:<24}{reference:>11.3f}s{compiled:>11.3f}s"
+            f"{reference / compiled:>9.1f}x"
+        )
+    checked = 0
+    fuzz_input = bytes(range(40, 90)) * 20
+    for seed in range(args.seed, args.seed + args.fuzz):
+        source = random_program(seed)
+        output = bytearray()
+        error = None
+        try:
+            interpreter.run(source, fuzz_input, max_steps=args.max_steps, output=output)
+        except interpreter.StepLimitExceeded:
+            continue
+        except IndexError as failure:
+            if options.safety == "unchecked":
+                continue
+            error = describe(failure)
+        checked += 1
+        expected = (error, bytes(output))
+        got = compiled_outcome(source.encode(), fuzz_input, options)
+        if got != expected:
+            failures += 1
+            print(f"seed {seed}: {outcome(*expected)} != {outcome(*got)}")
+            print(f"    {source}")
+    if args.fuzz:
+        print(f"fuzz: {checked} of {args.fuzz} random programs checked")
+    failures += check_faults() + check_batch()
+    if failures:
+        print(f"{failures} mismatches")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""Generated workloads of the benchmark suite
+
+The programs and inputs are built from a fixed seed, so every run of the
+suite measures the same work without large files in the repository.
+"""
+import contextlib
+import os
+import random
+from typing import Callable, Iterator, Union
+
+PROGRAMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+WORDS = (
+    "tape cell loop pointer byte input output bracket shift clear scan add "
+    "move copy fold compile marshal code const name frame stack jump"
+).split()
+
+
+def words(count: int, seed: int = 0) -> str:
+    """`count` pseudo random words in lines of about 70 characters"""
+    rng = random.Random(seed)
+    lines = []
+    line: list[str] = []
+    width = 0
+    for _ in range(count):
+        word = rng.choice(WORDS)
+        if rng.random() < 0.1:
+            word = word.capitalize()
+        if width + len(word) > 70:
+            lines.append(" ".join(line))
+            line, width = [], 0
+        line.append(word)
+        width += len(word) + 1
+    lines.append(" ".join(line))
+    return "\n".join(lines) + "\n"
+
+
+def text_program(text: str) -> str:
+    """A program printing `text` from a single cell
+
+    Small steps between characters are plain `+`/`-` runs, larger ones use a
+    multiply loop over a scratch cell, the way hand written printers do.
+    """
+    parts = []
+    value = 0
+    for byte in text.encode():
+        delta = (byte - value + 128) % 256 - 128
+        if abs(delta) > 12:
+            factor, rest = divmod(abs(delta), 8)
+            sign = "+" if delta > 0 else "-"
+            parts.append(f">{'+' * 8}[<{sign * factor}>-]<{sign * rest}")
+        else:
+            parts.append(("+" if delta > 0 else "-") * abs(delta))
+        parts.append(".")
+        value = byte
+    lines = []
+    source = "".join(parts)
+    for start in range(0, len(source), 80):
+        lines.append(source[start : start + 80])
+    return "\n".join(lines) + "\n"
+
+
+class Builder:
+    """Writes brainfuck addressing cells by name, keeping track of the
+    pointer so every loop starts and ends on its own cell
+
+    Helpers taking temporary cells expect them to be zero and leave them so.
+    """
+
+    def __init__(self, names: list[str]):
+        self.cells = {name: index for index, name in enumerate(names)}
+        self.pointer = 0
+        self.parts: list[str] = []
+
+    @property
+    def source(self) -> str:
+        source = "".join(self.parts)
+        lines = [source[start : start + 80] for start in range(0, len(source), 80)]
+        return "\n".join(lines) + "\n"
+
+    def at(self, cell: str):
+        delta = self.cells[cell] - self.pointer
+        self.parts.append(">" * delta if delta > 0 else "<" * -delta)
+        self.pointer = self.cells[cell]
+
+    def add(self, cell: str, value: int = 1):
+        self.at(cell)
+        self.parts.append("+" * value if value > 0 else "-" * -value)
+
+    def clear(self, cell: str):
+        self.at(cell)
+        self.parts.append("[-]")
+
+    def output(self, cell: str):
+        self.at(cell)
+        self.parts.append(".")
+
+    @contextlib.contextmanager
+    def loop(self, cell: str) -> Iterator[None]:
+        self.at(cell)
+        self.parts.append("[")
+        yield
+        self.at(cell)
+        self.parts.append("]")
+
+    def move(self, source: str, *targets: Union[str, tuple[str, int]]):
+        """Adds `source` (times a factor) to the targets and clears it"""
+        with self.loop(source):
+            self.add(source, -1)
+            for target in targets:
+                cell, factor = (target, 1) if isinstance(target, str) else target
+                self.add(cell, factor)
+
+    def copy(self, source: str, target: str, temporary: str):
+        self.move(source, target, temporary)
+        self.move(temporary, source)
+
+    def branch(
+        self,
+        condition: str,
+        flag: str,
+        then: Callable[[], None],
+        otherwise: Callable[[], None],
+    ):
+        """Runs `then` if `condition` isn't zero, `otherwise` if it is, and
+        clears `condition`"""
+        self.add(flag)
+        with self.loop(condition):
+            self.clear(condition)
+            self.add(flag, -1)
+            then()
+        with self.loop(flag):
+            self.add(flag, -1)
+            otherwise()
+
+    def subtract(self, a: str, b: str, below: str, t: tuple[str, str, str]):
+        """a, below = max(a - b, 0), max(b - a, 0), clears `b`"""
+        copied, temporary, flag = t
+        with self.loop(b):
+            self.add(b, -1)
+            self.copy(a, copied, temporary)
+            self.branch(
+                copied, flag, lambda: self.add(a, -1), lambda: self.add(below)
+            )
+
+    def greater(self, a: str, limit: int, result: str, t: tuple[str, ...]):
+        """Adds 1 to `result` if `a` is greater than `limit`"""
+        rest, copied, temporary, count = t
+        self.copy(a, rest, temporary)
+        self.add(count, limit + 1)
+        with self.loop(count):
+            self.add(count, -1)
+            self.copy(rest, copied, temporary)
+            with self.loop(copied):
+                self.clear(copied)
+                self.add(rest, -1)
+        with self.loop(rest):
+            self.clear(rest)
+            self.add(result)
+
+    def multiply(
+        self, a: str, b: str, product: str, scale: int, t: tuple[str, ...]
+    ):
+        """Adds a * b // scale to `product`, dividing as it goes so that
+        nothing overflows a byte"""
+        outer, inner, temporary, copied, flag, count = t
+        self.add(count, scale)
+        self.copy(a, outer, temporary)
+        with self.loop(outer):
+            self.add(outer, -1)
+            self.copy(b, inner, temporary)
+            with self.loop(inner):
+                self.add(inner, -1)
+                self.add(count, -1)
+                self.copy(count, copied, temporary)
+
+                def carry():
+                    self.add(product)
+                    self.add(count, scale)
+
+                self.branch(copied, flag, lambda: None, carry)
+        self.clear(count)
+
+
+def mandelbrot_program(columns: int = 40, rows: int = 17, limit: int = 24) -> str:
+    """A program drawing the Mandelbrot set, `*` for the points that stay
+    within radius 2 for `limit` iterations
+
+    Numbers are a sign cell and a magnitude cell in fixed point with 4
+    fractional bits, squares divide while they multiply and adding numbers
+    of opposite signs counts both magnitudes down, so the work is nested
+    loops of byte arithmetic, like the classic mandelbrot.b. Columns go from
+    -2 in steps of 1/16, rows from -1 in steps of 1/8.
+    """
+    b = Builder(
+        "row col j i cxs cxm cys cym xs xm ys ym n run esc xx yy xy xys a neg "
+        "char t0 t1 t2 t3 t4 t5".split()
+    )
+    t = ("t0", "t1", "t2", "t3", "t4", "t5")
+
+    def signed(value: str, offset: int, sign: str, magnitude: str):
+        # sign, magnitude = value - offset
+        b.copy(value, "a", "t0")
+        b.add("t3", offset)
+        b.subtract("a", "t3", "neg", t[:3])
+        b.copy("neg", "t3", "t0")
+        with b.loop("t3"):
+            b.clear("t3")
+            b.add(sign)
+        b.move("a", magnitude)
+        b.move("neg", magnitude)
+
+    def add_signed(sign: str, magnitude: str, other_sign: str, other: str):
+        # sign, magnitude += copies of other_sign, other
+        b.copy(other_sign, "t4", "t0")
+        b.copy(sign, "t5", "t0")
+        b.move("t4", ("t5", -1))
+        b.copy(other, "t4", "t0")
+
+        def opposite():
+            b.subtract(magnitude, "t4", "neg", t[:3])
+            b.copy("neg", "t3", "t0")
+            with b.loop("t3"):
+                b.clear("t3")
+                b.move(sign, "t0")
+                b.add(sign)
+                b.move("t0", (sign, -1))
+            b.move("neg", magnitude)
+
+        b.branch("t5", "t3", opposite, lambda: b.move("t4", magnitude))
+
+    def iterate():
+        b.multiply("xm", "xm", "xx", 16, t)
+        b.multiply("ym", "ym", "yy", 16, t)
+        b.copy("xx", "a", "t0")
+        b.copy("yy", "a", "t0")
+        b.greater("a", 64, "esc", t[:4])
+        b.clear("a")
+        b.copy("esc", "t5", "t0")
+        b.branch("t5", "t4", lambda: None, step)
+
+    def step():
+        b.multiply("xm", "ym", "xy", 8, t)
+        b.copy("xs", "xys", "t0")
+        b.copy("ys", "t5", "t0")
+        b.move("t5", ("xys", -1))
+        with b.loop("xys"):
+            b.clear("xys")
+            b.add("t5")
+        b.move("t5", "xys")
+        for cell in ("xs", "xm", "ys", "ym"):
+            b.clear(cell)
+        b.subtract("xx", "yy", "neg", t[:3])
+        b.copy("neg", "t3", "t0")
+        with b.loop("t3"):
+            b.clear("t3")
+            b.add("xs")
+        b.move("xx", "xm")
+        b.move("neg", "xm")
+        add_signed("xs", "xm", "cxs", "cxm")
+        b.move("xys", "ys")
+        b.move("xy", "ym")
+        add_signed("ys", "ym", "cys", "cym")
+        b.add("n", -1)
+        b.copy("n", "t5", "t0")
+        with b.loop("t5"):
+            b.clear("t5")
+            b.add("run")
+
+    b.add("row", rows)
+    with b.loop("row"):
+        b.add("row", -1)
+        b.add("col", columns)
+        with b.loop("col"):
+            b.add("col", -1)
+            for cell in ("cxs", "cxm", "cys", "cym", "xs", "xm", "ys", "ym"):
+                b.clear(cell)
+            signed("i", 32, "cxs", "cxm")
+            b.copy("j", "t4", "t0")
+            b.move("t4", ("t5", 2))
+            signed("t5", 16, "cys", "cym")
+            b.clear("t5")
+            b.add("n", limit)
+            b.add("run")
+            with b.loop("run"):
+                b.clear("run")
+                b.greater("xm", 32, "esc", t[:4])
+                b.greater("ym", 32, "esc", t[:4])
+                b.copy("esc", "t5", "t0")
+                b.branch("t5", "t4", lambda: None, iterate)
+                b.clear("xx")
+                b.clear("yy")
+            b.add("char", ord("*"))
+            with b.loop("esc"):
+                b.clear("esc")
+                b.add("char", ord(" ") - ord("*"))
+            b.output("char")
+            b.clear("char")
+            b.clear("n")
+            b.add("i")
+        b.clear("i")
+        b.add("char", ord("\n"))
+        b.output("char")
+        b.clear("char")
+        b.add("j")
+    return b.source
+
+
+def workloads() -> dict[str, tuple[bytes, bytes]]:
+    """name -> (source, stdin) of the generated workloads"""
+    with open(os.path.join(PROGRAMS, "rot13.b"), "rb") as f:
+        rot13 = f.read()
+    return {
+        "text.b": (text_program(words(8000, seed=1)).encode(), b""),
+        "rot13-large.b": (rot13, words(4000, seed=2).encode()),
+        "mandelbrot.b": (mandelbrot_program().encode(), b""),
+    }
+
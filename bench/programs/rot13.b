@@ -0,0 +1,26 @@
+,[
+    [
+        >>++++[>++++++++<-]
+        <+<-[
+            >+>+>-[>>>]
+            <[[>+<-]>>+>]
+            <<<<<-
+        ]
+    ]>>>[-]+
+    >--[-[<->+++[-]]]<[
+        ++++++++++++<[
+            >-[>+>>]
+            >[+[<+>-]>+>>]
+            <<<<<-
+        ]
+        >>[<+>-]
+        >[
+            -[
+                -<<[-]>>
+            ]<<[<<->>-]>>
+        ]<<[<<+>>-]
+    ]
+    <[-]
+    <.[-]
+    <,
+]
@@ -0,0 +1,186 @@
+"""Benchmark suite: compiles and runs the standard workloads and stores the
+results as JSON, so regressions between commits are visible
+
+usage: python bench/run.py [names ...] [-r REPEAT] [-o FILE] [--baseline FILE]
+
+Every program in bench/programs and bfs, plus the generated workloads of
+`generate.py`, is compiled into a .pyc and run on the running interpreter. A
+program `name.b` is fed `name.in` as stdin when that file exists. For each
+one the suite records:
+
+    compile_s   time to write the .pyc, including parsing and the passes
+    pyc_bytes   size of the .pyc
+    steps       IR nodes executed, counted by an instrumented python backend
+                build, so it shrinks when the passes fold more work
+    run_s       best wall time over REPEAT runs
+    output      length and sha256 of what the program wrote
+
+With --baseline, the ratio of every metric to the one in an earlier result
+file is printed next to it.
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import marshal
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate  # noqa: E402
+import pysource  # noqa: E402
+from pyfuck import (  # noqa: E402
+    BACKENDS,
+    CompileOptions,
+    build_source,
+    compile_file,
+    program_namespace,
+    run,
+)
+from targets import DEFAULT_TARGET, TARGETS  # noqa: E402
+
+RESULTS = os.path.join(ROOT, "bench", "results")
+METRICS = ("compile_s", "pyc_bytes", "steps", "run_s")
+
+parser = argparse.ArgumentParser(description="PyFuck benchmark suite")
+parser.add_argument("names", nargs="*", help="only run these programs")
+parser.add_argument(
+    "-r", "--repeat", type=int, default=3, help="runs per program, best is kept"
+)
+parser.add_argument("-o", "--output", help="result file, under bench/results by default")
+parser.add_argument("--baseline", help="earlier result file to compare with")
+parser.add_argument("--backend", choices=BACKENDS, default="bytecode")
+parser.add_argument("--target", choices=TARGETS, default=DEFAULT_TARGET.name)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def workloads() -> dict[str, tuple[bytes, bytes]]:
+    """name -> (source, stdin) of every program in the suite"""
+    programs = {}
+    paths = glob.glob(os.path.join(ROOT, "bench", "programs", "*.b"))
+    paths += glob.glob(os.path.join(ROOT, "bfs", "*.bf"))
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            source = f.read()
+        stdin = b""
+        if os.path.exists(os.path.splitext(path)[0] + ".in"):
+            with open(os.path.splitext(path)[0] + ".in", "rb") as f:
+                stdin = f.read()
+        programs[os.path.basename(path)] = (source, stdin)
+    programs.update(generate.workloads())
+    return programs
+
+
+def count_steps(source: bytes, stdin: bytes, options: CompileOptions) -> int:
+    program = build_source(source, options, count_steps=True)
+    namespace = program_namespace(io.BytesIO(stdin), io.BytesIO())
+    exec(pysource.compile_source(program), namespace)
+    return namespace["steps"]
+
+
+def measure(
+    name: str, source: bytes, stdin: bytes, options: CompileOptions, repeat: int
+) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(source)
+        pyc = path + ".pyc"
+        start = time.perf_counter()
+        compile_file(path, pyc, options, force=True)
+        result = {"compile_s": time.perf_counter() - start}
+        result["pyc_bytes"] = os.path.getsize(pyc)
+        with open(pyc, "rb") as f:
+            data = f.read()
+    if options.magic != data[:4]:
+        # compiled for another version, only the compile metrics are known
+        return result
+    code = marshal.loads(data[16:])
+    best = float("inf")
+    for _ in range(repeat):
+        stdout = io.BytesIO()
+        start = time.perf_counter()
+        run(code, io.BytesIO(stdin), stdout)
+        best = min(best, time.perf_counter() - start)
+    output = stdout.getvalue()
+    result["steps"] = count_steps(source, stdin, options)
+    result["run_s"] = best
+    result["output_bytes"] = len(output)
+    result["output_sha256"] = hashlib.sha256(output).hexdigest()
+    return result
+
+
+def compare(value, base) -> str:
+    if value is None or not base:
+        return ""
+    return f" ({value / base:.2f}x)"
+
+
+def main():
+    args = parser.parse_args()
+    options = CompileOptions(backend=args.backend, target=args.target)
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["programs"]
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "backend": options.backend,
+        "target": options.target,
+        "repeat": args.repeat,
+        "programs": {},
+    }
+    print(f"{'program':<20}" + "".join(f"{metric:>22}" for metric in METRICS))
+    for name, (source, stdin) in workloads().items():
+        if args.names and name not in args.names:
+            continue
+        result = measure(name, source, stdin, options, args.repeat)
+        report["programs"][name] = result
+        old = baseline.get(name, {})
+        if old.get("output_sha256", result.get("output_sha256")) != result.get(
+            "output_sha256"
+        ):
+            print(f"{name}: output differs from the baseline")
+        cells = []
+        for metric in METRICS:
+            value = result.get(metric)
+            text = "-" if value is None else f"{value:.3f}"
+            if isinstance(value, int):
+                text = str(value)
+            cells.append(f"{text + compare(value, old.get(metric)):>22}")
+        print(f"{name:<20}" + "".join(cells))
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        version = "".join(platform.python_version_tuple()[:2])
+        output = os.path.join(RESULTS, f"{commit}-py{version}-{options.backend}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Runs one compiled brainfuck program on many independent inputs
+
+usage: python bfbatch.py program.bf records [-o OUTPUT] [-j JOBS]
+                         [--framing lines|length] [--max-steps N]
+                         [--timeout SECONDS]
+
+The program is compiled once, then the records of the input file are fed to
+it one by one, each as the whole stdin of a fresh run, by a pool of forked
+worker processes which inherit the code object instead of unpickling it.
+Outputs come back in the order of the records and are written with the same
+framing:
+
+    lines   a record is a line without its newline; an output has its last
+            newline, if any, replaced by exactly one
+    length  a record is a 4 byte big endian length followed by that many bytes
+
+Records are read lazily, so the input file can be larger than memory. A run
+stops after `--max-steps` IR nodes (the program is then compiled with the
+python backend, which counts them) or `--timeout` seconds; the failure is
+reported on stderr and the record gets the output written before it.
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import signal
+import struct
+import sys
+import time
+import types
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from pyfuck import (
+    BACKENDS,
+    CompileOptions,
+    build_writer,
+    compile_to_code,
+    compile_writer,
+    program_namespace,
+)
+from pysource import StepLimitExceeded
+
+FRAMINGS = ("lines", "length")
+LENGTH = struct.Struct(">I")
+# records sent to a worker at once
+CHUNK_SIZE = 16
+
+parser = argparse.ArgumentParser(description="PyFuck batch runner")
+parser.add_argument("file", help="brainfuck file")
+parser.add_argument("records", help="file holding the inputs, - for stdin")
+parser.add_argument("-o", "--output", help="file receiving the outputs")
+parser.add_argument("-j", "--jobs", type=int, help="worker processes")
+parser.add_argument("--framing", choices=FRAMINGS, default="lines")
+parser.add_argument("--max-steps", type=int, help="stop a run after this many IR nodes")
+parser.add_argument("--timeout", type=float, help="stop a run after this long")
+parser.add_argument("--backend", choices=BACKENDS, default="bytecode")
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+@dataclass
+class Result:
+    """Outcome of running the program on one record"""
+
+    output: bytes
+    # why the run stopped early, None if the program finished
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
+def read_records(f: BinaryIO, framing: str = "lines") -> Iterator[bytes]:
+    """Yields the records of `f` one at a time"""
+    if framing == "lines":
+        for line in f:
+            yield line[:-1] if line.endswith(b"\n") else line
+        return
+    while header := f.read(LENGTH.size):
+        if len(header) < LENGTH.size:
+            raise ValueError("truncated record length")
+        (size,) = LENGTH.unpack(header)
+        record = f.read(size)
+        if len(record) < size:
+            raise ValueError("truncated record")
+        yield record
+
+
+def write_record(f: BinaryIO, data: bytes, framing: str = "lines"):
+    if framing == "lines":
+        f.write(data[:-1] if data.endswith(b"\n") else data)
+        f.write(b"\n")
+    else:
+        f.write(LENGTH.pack(len(data)))
+        f.write(data)
+
+
+@contextlib.contextmanager
+def time_limit(seconds: Optional[float]):
+    """Raises TimeLimitExceeded in the block after `seconds`, using SIGALRM,
+    so only in the main thread"""
+    if seconds is None:
+        yield
+        return
+
+    def expire(signum, frame):
+        raise TimeLimitExceeded(f"timed out after {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def run_record(
+    code: types.CodeType, record: bytes, timeout: Optional[float] = None
+) -> Result:
+    """Runs `code` with `record` as its stdin, in this process"""
+    stdout = io.BytesIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with time_limit(timeout):
+            exec(code, program_namespace(io.BytesIO(record), stdout))
+    except StepLimitExceeded as exceeded:
+        error = f"exceeded {exceeded.args[0]} steps"
+    except TimeLimitExceeded as exceeded:
+        error = str(exceeded)
+    except Exception as failure:
+        error = f"{type(failure).__name__}: {failure}"
+    return Result(stdout.getvalue(), error, time.perf_counter() - start)
+
+
+# set in the parent before forking the workers, which inherit it
+_worker_code: Optional[types.CodeType] = None
+_worker_timeout: Optional[float] = None
+
+
+def _run_in_worker(record: bytes) -> Result:
+    return run_record(_worker_code, record, _worker_timeout)
+
+
+def run_records(
+    code: types.CodeType,
+    records: Iterable[bytes],
+    jobs: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> Iterator[Result]:
+    """Runs `code` on every record with a pool of `jobs` forked processes
+    (all cores by default), yields the results in the order of the records
+
+    Needs the fork start method, so a POSIX system. `jobs=1` runs the
+    records in this process instead.
+    """
+    global _worker_code, _worker_timeout
+    if jobs == 1:
+        for record in records:
+            yield run_record(code, record, timeout)
+        return
+    _worker_code, _worker_timeout = code, timeout
+    context = multiprocessing.get_context("fork")
+    try:
+        with context.Pool(jobs) as pool:
+            # unlike Executor.map, imap consumes the records as workers take them
+            yield from pool.imap(_run_in_worker, records, CHUNK_SIZE)
+    finally:
+        _worker_code = _worker_timeout = None
+
+
+def compile_program(
+    source: bytes,
+    options: Optional[CompileOptions] = None,
+    max_steps: Optional[int] = None,
+    filename: str = "<brainfuck>",
+) -> types.CodeType:
+    """Code object of the program, raising StepLimitExceeded after
+    `max_steps` IR nodes if given, which needs the python backend"""
+    options = options or CompileOptions()
+    if max_steps is None:
+        return compile_to_code(source, options, cache=None, filename=filename)
+    if options.backend != "python":
+        raise ValueError("step limits need the python backend")
+    writer = build_writer(source, options, max_steps=max_steps)
+    return compile_writer(writer, filename)
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.file, "rb") as f:
+        source = f.read()
+    backend = "python" if args.max_steps is not None else args.backend
+    options = CompileOptions(backend=backend)
+    code = compile_program(source, options, args.max_steps, args.file)
+    failed = 0
+    with contextlib.ExitStack() as stack:
+        if args.records == "-":
+            records_file = sys.stdin.buffer
+        else:
+            records_file = stack.enter_context(open(args.records, "rb"))
+        if args.output is None:
+            output = sys.stdout.buffer
+        else:
+            output = stack.enter_context(open(args.output, "wb"))
+        records = read_records(records_file, args.framing)
+        results = run_records(code, records, args.jobs, args.timeout)
+        for index, result in enumerate(results):
+            write_record(output, result.output, args.framing)
+            if result.error is not None:
+                failed += 1
+                print(f"record {index}: {result.error}", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Import hook making brainfuck files importable
+
+    import bfimport
+    bfimport.install()
+    import hello  # finds hello.bf on sys.path and runs it
+
+Importing a module runs the program in it, on the process stdin and stdout.
+With `install(CompileOptions(resumable=True))` it only defines the generator
+function `main` instead, see `bfsession`.
+
+The compiled module is cached in the `__pycache__` directory next to the
+source, in `<name>.pyfuck-<options>.pyc` where `<options>` identifies the
+compile options, so programs compiled with different options don't evict
+each other. The cache is checked the PEP 552 way, as the `validation` of
+`install` says:
+
+    timestamp   the header holds the mtime and size of the source, an import
+                costs a stat of the source and an unmarshal
+    hash        the header holds the hash of the source and options
+                (`CompileOptions.source_hash`), an import reads and hashes
+                the source, so the cache survives touching or checking out
+                the file again
+"""
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import sys
+import types
+from io import BytesIO
+from typing import Optional, Sequence, Union
+
+from compile import read_header
+from pyfuck import CompileOptions, write_pyc
+
+SUFFIX = ".bf"
+VALIDATIONS = ("timestamp", "hash")
+
+
+def cache_path(path: str, options: CompileOptions) -> str:
+    """Where the compiled module of the source at `path` is cached"""
+    directory, filename = os.path.split(path)
+    name = os.path.splitext(filename)[0]
+    tag = options.hasher().hexdigest()
+    return os.path.join(directory, "__pycache__", f"{name}.pyfuck-{tag}.pyc")
+
+
+class BrainfuckLoader(importlib.abc.InspectLoader):
+    """Loads the module compiled from the brainfuck file at `path`, going
+    through its cache"""
+
+    def __init__(
+        self, path: str, options: CompileOptions, validation: str = "timestamp"
+    ):
+        self.path = path
+        self.options = options
+        self.validation = validation
+
+    def get_filename(self, fullname: Optional[str] = None) -> str:
+        return self.path
+
+    def is_package(self, fullname: str) -> bool:
+        return False
+
+    def get_source(self, fullname: str) -> None:
+        # brainfuck isn't python source, tracebacks can't show it
+        return None
+
+    def get_code(self, fullname: Optional[str] = None) -> types.CodeType:
+        cached = cache_path(self.path, self.options)
+        source = source_hash = None
+        mtime = size = 0
+        if self.validation == "hash":
+            with open(self.path, "rb") as f:
+                source = f.read()
+            source_hash = expected = self.options.source_hash(source)
+        else:
+            stat = os.stat(self.path)
+            # the header keeps the low 32 bits of both, like importlib does
+            mtime, size = int(stat.st_mtime) & 0xFFFFFFFF, stat.st_size & 0xFFFFFFFF
+            expected = (mtime, size)
+        code = self._read_cache(cached, expected)
+        if code is not None:
+            return code
+        if source is None:
+            with open(self.path, "rb") as f:
+                source = f.read()
+        buffer = BytesIO()
+        write_pyc(buffer, source, self.options, source_hash, mtime, size, self.path)
+        data = buffer.getvalue()
+        if not sys.dont_write_bytecode:
+            self._write_cache(cached, data)
+        return marshal.loads(memoryview(data)[16:])
+
+    def _read_cache(
+        self, cached: str, expected: Union[bytes, tuple[int, int]]
+    ) -> Optional[types.CodeType]:
+        """The cached code object if its header is `expected`"""
+        try:
+            with open(cached, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if read_header(data, self.options.magic) != expected:
+            return None
+        try:
+            return marshal.loads(memoryview(data)[16:])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def _write_cache(self, cached: str, data: bytes):
+        # renamed into place so concurrent imports never read a partial
+        # file; a read only directory just means no cache
+        temporary = f"{cached}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            with open(temporary, "wb") as f:
+                f.write(data)
+            os.replace(temporary, cached)
+        except OSError:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+
+class BrainfuckFinder(importlib.abc.MetaPathFinder):
+    """Finds `<name>.bf` in the directories of `sys.path`, or of the parent
+    package for submodules"""
+
+    def __init__(
+        self,
+        options: Optional[CompileOptions] = None,
+        validation: str = "timestamp",
+    ):
+        if validation not in VALIDATIONS:
+            raise ValueError(f"unknown validation {validation}")
+        self.options = options or CompileOptions()
+        self.validation = validation
+
+    def find_spec(
+        self,
+        fullname: str,
+        path: Optional[Sequence[str]] = None,
+        target: Optional[types.ModuleType] = None,
+    ) -> Optional[importlib.machinery.ModuleSpec]:
+        name = fullname.rpartition(".")[2]
+        for directory in sys.path if path is None else path:
+            candidate = os.path.join(directory or ".", name + SUFFIX)
+            if not os.path.isfile(candidate):
+                continue
+            loader = BrainfuckLoader(candidate, self.options, self.validation)
+            spec = importlib.util.spec_from_file_location(
+                fullname, candidate, loader=loader
+            )
+            spec.cached = cache_path(candidate, self.options)
+            return spec
+        return None
+
+
+def install(
+    options: Optional[CompileOptions] = None, validation: str = "timestamp"
+) -> BrainfuckFinder:
+    """Makes .bf files importable, after every other finder so python
+    modules of the same name win; `uninstall` undoes it"""
+    finder = BrainfuckFinder(options, validation)
+    sys.meta_path.append(finder)
+    return finder
+
+
+def uninstall(finder: Optional[BrainfuckFinder] = None):
+    """Removes `finder`, or every finder added by `install`"""
+    for installed in list(sys.meta_path):
+        if finder is None:
+            remove = isinstance(installed, BrainfuckFinder)
+        else:
+            remove = installed is finder
+        if remove:
+            sys.meta_path.remove(installed)
@@ -0,0 +1,989 @@
+from dataclasses import dataclass, field, replace
+from itertools import chain
+from typing import Callable, Iterable, Iterator, Optional, Sequence, Union
+
+from bfops import Tape
+
+
+@dataclass
+class Add:
+    """memory[pointer + offset] += value
+
+    `wrap` is cleared when the new value is known to fit in a cell, so it
+    needs no masking, see `RangeAnalysis`. The same goes for `MulAdd` and
+    `ProductAdd`.
+    """
+
+    offset: int
+    value: int
+    wrap: bool = True
+
+
+@dataclass
+class Move:
+    """pointer += value"""
+
+    value: int
+
+
+@dataclass
+class Output:
+    """stdout.write(chr(memory[pointer + offset]))"""
+
+    offset: int = 0
+
+
+@dataclass
+class Write:
+    """stdout.write(data), output known at compile time"""
+
+    data: bytes
+
+
+@dataclass
+class Input:
+    """memory[pointer + offset] = ord(stdin.read(1))"""
+
+    offset: int = 0
+
+
+@dataclass
+class Clear:
+    """memory[pointer + offset] = 0"""
+
+    offset: int = 0
+
+
+@dataclass
+class MulAdd:
+    """memory[pointer + offset] += memory[pointer + source] * factor"""
+
+    offset: int
+    factor: int
+    source: int = 0
+    wrap: bool = True
+
+
+@dataclass
+class ProductAdd:
+    """memory[pointer + offset] += memory[pointer + source] *
+    memory[pointer + other] * factor"""
+
+    offset: int
+    factor: int
+    source: int = 0
+    other: int = 0
+    wrap: bool = True
+
+
+@dataclass
+class Scan:
+    """while memory[pointer]: pointer += step"""
+
+    step: int
+
+
+@dataclass
+class Loop:
+    """while memory[pointer]: body
+
+    `position` is the index of the `[` among the commands of the source (the
+    comments left out), None for loops the passes made up.
+    """
+
+    body: list["Node"] = field(default_factory=list)
+    position: Optional[int] = None
+
+
+@dataclass
+class Check:
+    """raise IndexError unless 0 <= pointer + low and, on a fixed size tape,
+    pointer + high < size; a bound left to None isn't checked"""
+
+    low: Optional[int] = None
+    high: Optional[int] = None
+
+
+Node = Union[
+    Add, Move, Output, Write, Input, Clear, MulAdd, ProductAdd, Scan, Loop, Check
+]
+Pass = Callable[[list[Node]], list[Node]]
+
+
+SEGMENT_SIZE = 1 << 14
+
+
+def build_segments(
+    tokens: Iterable[tuple[str, int]], segment_size: int = SEGMENT_SIZE
+) -> Iterator[list[Node]]:
+    """Builds the IR from run-length encoded brainfuck source, yielding the
+    top level of the program in pieces
+
+    A piece is yielded once it holds at least `segment_size` nodes and a top
+    level loop has just been closed, so consumers can process the program
+    while it is being read. Every piece but the last ends with a loop.
+
+    Args:
+        tokens (Iterable[tuple[str, int]]): output of `pyfuck.tokenize`
+        segment_size (int): minimum number of nodes per piece
+
+    Raises:
+        ValueError: if the brackets are unbalanced
+
+    Yields:
+        list[Node]: consecutive top level nodes of the program
+    """
+    stack: list[list[Node]] = [[]]
+    created = 0
+    position = 0
+    for char, count in tokens:
+        nodes = stack[-1]
+        if char == "+":
+            nodes.append(Add(0, count))
+        elif char == "-":
+            nodes.append(Add(0, -count))
+        elif char == ">":
+            nodes.append(Move(count))
+        elif char == "<":
+            nodes.append(Move(-count))
+        elif char == ".":
+            nodes.extend(Output() for _ in range(count))
+        elif char == ",":
+            nodes.extend(Input() for _ in range(count))
+        elif char == "[":
+            for index in range(count):
+                loop = Loop(position=position + index)
+                stack[-1].append(loop)
+                stack.append(loop.body)
+        elif char == "]":
+            for _ in range(count):
+                if len(stack) == 1:
+                    raise ValueError("unmatched ']'")
+                stack.pop()
+            if len(stack) == 1 and created >= segment_size:
+                yield stack[0]
+                stack[0] = []
+                created = 0
+                position += count
+                continue
+        created += count
+        position += count
+    if len(stack) != 1:
+        raise ValueError("unmatched '['")
+    if stack[0]:
+        yield stack[0]
+
+
+def build(tokens: Iterable[tuple[str, int]]) -> list[Node]:
+    """Builds the IR from run-length encoded brainfuck source
+
+    Args:
+        tokens (Iterable[tuple[str, int]]): output of `pyfuck.compress_str`
+
+    Raises:
+        ValueError: if the brackets are unbalanced
+
+    Returns:
+        list[Node]: top level nodes of the program
+    """
+    return list(chain.from_iterable(build_segments(tokens, segment_size=-1)))
+
+
+def _map_loops(nodes: list[Node], fn: Pass) -> list[Node]:
+    """Applies `fn` to the body of every loop, innermost first"""
+    for node in nodes:
+        if isinstance(node, Loop):
+            node.body = fn(node.body)
+    return nodes
+
+
+def cancel_pairs(nodes: list[Node]) -> list[Node]:
+    """Merges adjacent `+-` and `<>` runs and drops the moves that cancel out
+
+    Adds that cancel out are kept with a zero value: they still access their
+    cell, which may be off the tape. `drop_noops` removes them once the
+    checks are placed.
+    """
+    result: list[Node] = []
+    for node in _map_loops(nodes, cancel_pairs):
+        last = result[-1] if result else None
+        if isinstance(node, Move) and isinstance(last, Move):
+            last.value += node.value
+        elif (
+            isinstance(node, Add)
+            and isinstance(last, Add)
+            and last.offset == node.offset
+        ):
+            last.value += node.value
+        else:
+            result.append(node)
+            continue
+        if isinstance(last, Move) and last.value == 0:
+            result.pop()
+    return result
+
+
+def fold_clears(nodes: list[Node]) -> list[Node]:
+    """`[-]` and `[+]` become a single `Clear`
+
+    Any odd step reaches zero when cells wrap around, so `[---]` is folded too.
+    """
+    result: list[Node] = []
+    for node in _map_loops(nodes, fold_clears):
+        if (
+            isinstance(node, Loop)
+            and len(node.body) == 1
+            and isinstance(node.body[0], Add)
+            and node.body[0].offset == 0
+            and node.body[0].value % 2 == 1
+        ):
+            result.append(Clear())
+        else:
+            result.append(node)
+    return result
+
+
+def fold_scans(nodes: list[Node]) -> list[Node]:
+    """`[>]` and `[<]` (of any stride) become a single `Scan`"""
+    result: list[Node] = []
+    for node in _map_loops(nodes, fold_scans):
+        if (
+            isinstance(node, Loop)
+            and len(node.body) == 1
+            and isinstance(node.body[0], Move)
+        ):
+            result.append(Scan(node.body[0].value))
+        else:
+            result.append(node)
+    return result
+
+
+def _loop_deltas(body: Sequence[Node]) -> Union[dict[int, int], None]:
+    """Net change of every cell touched by a loop body made only of `Add` and
+    `Move` nodes that returns to the starting cell, or None for anything else"""
+    deltas: dict[int, int] = {}
+    offset = 0
+    for node in body:
+        if isinstance(node, Move):
+            offset += node.value
+        elif isinstance(node, Add):
+            deltas[offset + node.offset] = (
+                deltas.get(offset + node.offset, 0) + node.value
+            )
+        else:
+            return None
+    if offset != 0:
+        return None
+    return deltas
+
+
+def fold_mul_loops(nodes: list[Node]) -> list[Node]:
+    """`[->+++<]` becomes `MulAdd(1, 3)` followed by a `Clear`
+
+    Only loops stepping the loop cell by exactly one are folded, so the number
+    of iterations is the value of the loop cell (or its negation).
+    """
+    result: list[Node] = []
+    for node in _map_loops(nodes, fold_mul_loops):
+        deltas = _loop_deltas(node.body) if isinstance(node, Loop) else None
+        if deltas is None or deltas.get(0) not in (-1, 1):
+            result.append(node)
+            continue
+        sign = -deltas.pop(0)
+        # zero factors included, the cells are accessed all the same
+        result.extend(MulAdd(offset, value * sign) for offset, value in deltas.items())
+        result.append(Clear())
+    return result
+
+
+def _shift(node: Node, offset: int) -> Node:
+    if isinstance(node, MulAdd):
+        return MulAdd(node.offset + offset, node.factor, node.source + offset)
+    if isinstance(node, ProductAdd):
+        return ProductAdd(
+            node.offset + offset,
+            node.factor,
+            node.source + offset,
+            node.other + offset,
+        )
+    if isinstance(node, (Add, Output, Input, Clear)):
+        node.offset += offset
+    return node
+
+
+def fold_offsets(nodes: list[Node]) -> list[Node]:
+    """Turns pointer moves within straight-line code into cell offsets
+
+    The pointer is only committed before loops and scans and at the end of a
+    loop body or segment, so `>+>++<<` becomes `Add(1, 1), Add(2, 2)` with no
+    `Move`. Adds to the same cell are merged unless something in between
+    reads it. An add merged to zero is kept, see `cancel_pairs`.
+    """
+    result: list[Node] = []
+    pending: dict[int, int] = {}
+    offset = 0
+
+    def flush(*cells: int):
+        for cell in cells or list(pending):
+            if cell in pending:
+                result.append(Add(cell, pending.pop(cell)))
+
+    for node in nodes:
+        if isinstance(node, Move):
+            offset += node.value
+        elif isinstance(node, Add):
+            cell = offset + node.offset
+            pending[cell] = pending.get(cell, 0) + node.value
+        elif isinstance(node, Clear):
+            # anything added to the cell beforehand is overwritten anyway
+            pending.pop(offset + node.offset, None)
+            result.append(_shift(node, offset))
+        elif isinstance(node, Output):
+            # a pending add may fault on a cell off the tape, which has to
+            # happen before the output it precedes
+            flush()
+            result.append(_shift(node, offset))
+        elif isinstance(node, Input):
+            flush(offset + node.offset)
+            result.append(_shift(node, offset))
+        elif isinstance(node, MulAdd):
+            flush(offset + node.source, offset + node.offset)
+            result.append(_shift(node, offset))
+        elif isinstance(node, ProductAdd):
+            flush(offset + node.source, offset + node.other, offset + node.offset)
+            result.append(_shift(node, offset))
+        else:
+            flush()
+            if offset != 0:
+                result.append(Move(offset))
+                offset = 0
+            if isinstance(node, Loop):
+                node.body = fold_offsets(node.body)
+            result.append(node)
+    flush()
+    if offset != 0:
+        result.append(Move(offset))
+    return result
+
+
+# affine expression over the cells a loop starts with: cell offset -> factor,
+# with the constant term under None
+Affine = dict[Optional[int], int]
+
+
+def _combine(left: Affine, right: Affine, factor: int = 1) -> Affine:
+    """left + right * factor, without zero terms"""
+    result = dict(left)
+    for key, value in right.items():
+        total = result.get(key, 0) + value * factor
+        if total:
+            result[key] = total
+        else:
+            result.pop(key, None)
+    return result
+
+
+def _iterate(body: Sequence[Node], state: dict[int, Affine]) -> Optional[dict]:
+    """Runs `body` once on symbolic cells, None if it isn't affine
+
+    `state` maps the cells known to differ from their starting value to their
+    expression, the result is the state after the body.
+    """
+    state = dict(state)
+
+    def read(cell: int) -> Affine:
+        return state.get(cell, {cell: 1})
+
+    for node in body:
+        if isinstance(node, Add):
+            state[node.offset] = _combine(read(node.offset), {None: node.value})
+        elif isinstance(node, Clear):
+            state[node.offset] = {}
+        elif isinstance(node, MulAdd):
+            state[node.offset] = _combine(
+                read(node.offset), read(node.source), node.factor
+            )
+        else:
+            return None
+    return state
+
+
+def _difference(after: dict[int, Affine], before: dict[int, Affine]) -> dict:
+    """Per cell change from `before` to `after`, cells that don't change left
+    out"""
+    result = {}
+    for cell in after.keys() | before.keys():
+        change = _combine(
+            after.get(cell, {cell: 1}), before.get(cell, {cell: 1}), -1
+        )
+        if change:
+            result[cell] = change
+    return result
+
+
+def _closed_form(loop: Loop) -> Optional[list[Node]]:
+    """Nodes with the effect of `loop` and no iteration, or None
+
+    The body must be straight-line `Add`, `Clear` and `MulAdd` nodes without
+    pointer movement, so one iteration is an affine map T of the cells. The
+    loop folds when the change made by an iteration, D = T(S) - S, is the
+    same from the second iteration on (D(S2) == D(S1) is enough for an
+    affine T), steps the loop cell by exactly one and only reads cells that
+    D leaves alone. After n iterations every cell is then S1 + (n - 1) D,
+    with n given by the loop cell.
+
+    The first iteration usually differs because temporaries start with
+    whatever value they have; it is then peeled off and runs as is, inside
+    a loop that clears its cell and so runs at most once.
+    """
+    first = _iterate(loop.body, {})
+    if first is None:
+        return None
+    second = _iterate(loop.body, first)
+    third = _iterate(loop.body, second)
+    change = _difference(second, first)
+    if change != _difference(third, second):
+        return None
+    step = change.pop(0, None)
+    if step not in ({None: 1}, {None: -1}):
+        return None
+    # -step * memory[pointer] is the number of (remaining) iterations
+    factor = -step[None]
+    delta = _difference(first, {})
+    nodes: list[Node] = []
+    for cell, expression in sorted(delta.items()):
+        if cell == 0 or cell not in change:
+            continue
+        if None in expression:
+            nodes.append(MulAdd(cell, expression[None] * factor))
+        for source in sorted(key for key in expression if key is not None):
+            if source == 0 or source in change:
+                # the number of iterations or a value that keeps changing
+                return None
+            nodes.append(ProductAdd(cell, expression[source] * factor, 0, source))
+    nodes.append(Clear())
+    # the first iteration is peeled off as well when it accesses a cell the
+    # nodes don't, which may be off the tape
+    covered = first.keys() <= {0, *change}
+    if covered and _difference(first, {}) == {0: step, **change}:
+        return nodes
+    return [Loop(loop.body + nodes, loop.position)]
+
+
+def fold_closed_loops(nodes: list[Node]) -> list[Node]:
+    """Replaces loops whose iterations all change the cells by the same
+    amount with arithmetic, see `_closed_form`
+
+    This covers the nested loops `fold_mul_loops` can't fold on its own, like
+    the multiplication `[>[->+>+<<]>>[-<<+>>]<<<-]` which becomes a product
+    of two cells once its inner loops are folded. Runs after `fold_offsets`,
+    whose form it keeps.
+    """
+    result: list[Node] = []
+    folded = False
+    for node in nodes:
+        if isinstance(node, Loop):
+            node.body = fold_closed_loops(node.body)
+            replacement = _closed_form(node)
+            if replacement is not None:
+                result.extend(replacement)
+                folded = True
+                continue
+        result.append(node)
+    if folded:
+        # the pointer moves around folded loops are now offsets
+        return fold_offsets(result)
+    return result
+
+
+def drop_dead_loops(nodes: list[Node]) -> list[Node]:
+    """Drops loops whose cell is known to be zero when they are reached
+
+    A cell is zero after a `Clear` and after a loop or scan stopped on it, so
+    the second loop of `[-][...]` or `[...][...]` (a common way to write
+    comments) never runs.
+    """
+    result: list[Node] = []
+    # offsets from the pointer of the cells known to be zero
+    zero: set[int] = set()
+    for node in _map_loops(nodes, drop_dead_loops):
+        if isinstance(node, Loop):
+            if 0 in zero:
+                continue
+            zero = {0}
+        elif isinstance(node, Scan):
+            zero = {0}
+        elif isinstance(node, Clear):
+            zero.add(node.offset)
+        elif isinstance(node, Move):
+            zero = {offset - node.value for offset in zero}
+        elif isinstance(node, (Add, Input, MulAdd, ProductAdd)):
+            zero.discard(node.offset)
+        result.append(node)
+    return result
+
+
+def drop_noops(nodes: list[Node]) -> list[Node]:
+    """Drops the adds of zero left for their cell access, see `cancel_pairs`"""
+    result: list[Node] = []
+    for node in _map_loops(nodes, drop_noops):
+        if isinstance(node, Add) and node.value == 0:
+            continue
+        if isinstance(node, MulAdd) and node.factor == 0:
+            continue
+        result.append(node)
+    return result
+
+
+def reach(nodes: Sequence[Node]) -> int:
+    """Largest offset from the pointer any node accesses"""
+    result = 0
+    for node in nodes:
+        if isinstance(node, Loop):
+            result = max(result, reach(node.body))
+        elif isinstance(node, MulAdd):
+            result = max(result, node.offset, node.source)
+        elif isinstance(node, ProductAdd):
+            result = max(result, node.offset, node.source, node.other)
+        elif isinstance(node, (Add, Output, Input, Clear)):
+            result = max(result, node.offset)
+    return result
+
+
+DEFAULT_PASSES: list[Pass] = [
+    cancel_pairs,
+    fold_clears,
+    fold_scans,
+    fold_mul_loops,
+    fold_offsets,
+    fold_closed_loops,
+    drop_dead_loops,
+]
+
+
+@dataclass
+class ConstantPropagation:
+    """Evaluates the start of a program at compile time
+
+    A program starts on a zeroed tape with the pointer on the first cell, so
+    every cell is known until the first input or the first loop over a cell
+    that isn't zero. `run` folds that part away: outputs become a single
+    `Write` of their bytes, loops over zero cells are dropped, and the
+    pointer and the cells left non-zero are set right before the first node
+    it can't evaluate. Segments must be passed in program order; once a node
+    stops the evaluation, the rest of the program is left alone.
+    """
+
+    tape: Tape = field(default_factory=Tape)
+    pointer: int = 0
+    # cell index -> value, cells left out are zero
+    cells: dict[int, int] = field(default_factory=dict)
+    done: bool = False
+
+    def run(self, nodes: list[Node]) -> list[Node]:
+        if self.done:
+            return nodes
+        output = bytearray()
+        result: list[Node] = []
+        for index, node in enumerate(nodes):
+            if not self._evaluate(node, output):
+                self.done = True
+                if output:
+                    result.append(Write(bytes(output)))
+                return result + self._restore() + nodes[index:]
+        if output:
+            result.append(Write(bytes(output)))
+        return result
+
+    def _on_tape(self, cell: int) -> bool:
+        return cell >= 0 and (self.tape.grow or cell < self.tape.size)
+
+    def _cell(self, offset: int) -> Optional[int]:
+        """Index of the cell at `offset`, None if it is off the tape"""
+        cell = self.pointer + offset
+        return cell if self._on_tape(cell) else None
+
+    def _store(self, cell: int, value: int):
+        value &= self.tape.mask
+        if value:
+            self.cells[cell] = value
+        else:
+            self.cells.pop(cell, None)
+
+    def _evaluate(self, node: Node, output: bytearray) -> bool:
+        """Applies `node` to the known cells, False if it can't be"""
+        cells = self.cells
+        if isinstance(node, Move):
+            target = self._cell(node.value)
+            if target is None:
+                return False
+            self.pointer = target
+        elif isinstance(node, Write):
+            output += node.data
+        elif isinstance(node, Loop):
+            # a loop over a non-zero cell would have to run
+            return self.pointer not in cells
+        elif isinstance(node, Scan):
+            pointer = self.pointer
+            while pointer in cells:
+                pointer += node.step
+                if not self._on_tape(pointer):
+                    return False
+            self.pointer = pointer
+        elif isinstance(node, (Add, Output, Clear)):
+            cell = self._cell(node.offset)
+            if cell is None:
+                return False
+            if isinstance(node, Add):
+                self._store(cell, cells.get(cell, 0) + node.value)
+            elif isinstance(node, Output):
+                output.append(cells.get(cell, 0) & 0xFF)
+            else:
+                cells.pop(cell, None)
+        elif isinstance(node, (MulAdd, ProductAdd)):
+            offsets = [node.offset, node.source]
+            if isinstance(node, ProductAdd):
+                offsets.append(node.other)
+            indices = [self._cell(offset) for offset in offsets]
+            if None in indices:
+                return False
+            cell, *sources = indices
+            value = node.factor
+            for source in sources:
+                value *= cells.get(source, 0)
+            self._store(cell, cells.get(cell, 0) + value)
+        else:
+            # input
+            return False
+        return True
+
+    def _restore(self) -> list[Node]:
+        """Nodes moving the pointer and setting the cells of a zeroed tape to
+        the evaluated state"""
+        nodes: list[Node] = []
+        if self.pointer:
+            nodes.append(Move(self.pointer))
+        for cell, value in sorted(self.cells.items()):
+            if value > self.tape.mask // 2:
+                # fewer steps the other way around
+                value -= self.tape.mask + 1
+            nodes.append(Add(cell - self.pointer, value))
+        return nodes
+
+
+SAFETY_LEVELS = ("unchecked", "checked", "where-needed")
+# smallest and largest value a cell may hold
+Range = tuple[int, int]
+# nodes that access their cells unconditionally, without branching or I/O
+ARITHMETIC = (Move, Add, Clear, Check)
+
+
+def _accessed(node: Node) -> tuple[int, ...]:
+    """Offsets of the cells `node` accesses before moving the pointer"""
+    if isinstance(node, MulAdd):
+        return (node.offset, node.source)
+    if isinstance(node, ProductAdd):
+        return (node.offset, node.source, node.other)
+    if isinstance(node, (Add, Output, Input, Clear)):
+        return (node.offset,)
+    if isinstance(node, (Loop, Scan)):
+        return (0,)
+    return ()
+
+
+def _written(body: Sequence[Node]) -> Optional[set[int]]:
+    """Offsets of the cells a loop body may change, None unless the pointer
+    is back where it started after every iteration"""
+    shift = 0
+    written: set[int] = set()
+    for node in body:
+        if isinstance(node, Move):
+            shift += node.value
+        elif isinstance(node, Loop):
+            inner = _written(node.body)
+            if inner is None:
+                return None
+            written.update(shift + offset for offset in inner)
+        elif isinstance(node, Scan):
+            return None
+        elif isinstance(node, (Add, Input, Clear, MulAdd, ProductAdd)):
+            written.add(shift + node.offset)
+    return written if shift == 0 else None
+
+
+def _join(bound: Optional[int], other: Optional[int], pick: Callable) -> Optional[int]:
+    return None if bound is None or other is None else pick(bound, other)
+
+
+@dataclass
+class RangeAnalysis:
+    """Follows the range of the pointer and of the cells through the program
+    to check and mask only where it can't prove the program safe
+
+    The pointer range [`low`, `high`] (None for no bound) starts at 0 and
+    narrows after every check. With `safety`:
+
+        unchecked       nothing is checked: past the end of a fixed size
+                        tape Python raises IndexError, before its start the
+                        index is taken from the end
+        checked         every access gets a `Check`
+        where-needed    an access gets a `Check` only if the pointer range
+                        doesn't keep it on the tape; the check covers the
+                        arithmetic that follows up to the next loop, scan or
+                        I/O, so the rest of it needs none
+
+    Loops access their cell before the first and after every iteration: a
+    loop that doesn't move the pointer back runs its iterations from a
+    checked cell and gets a check at the end of its body.
+
+    In every level, the range of the cells tells which updates can't wrap
+    around and get their `wrap` flag cleared: cells start at zero, a loop
+    body starts on a non-zero cell and a loop ends on a zero one. Segments
+    must be passed in program order, like to `ConstantPropagation`.
+    """
+
+    tape: Tape = field(default_factory=Tape)
+    safety: str = "unchecked"
+    low: Optional[int] = 0
+    high: Optional[int] = 0
+    # pointer from an arbitrary origin, the key of `cells`
+    position: int = 0
+    # position -> range of the cell, `default` for the cells left out
+    cells: dict[int, Range] = field(default_factory=dict)
+    default: Range = (0, 0)
+
+    def __post_init__(self):
+        if self.safety not in SAFETY_LEVELS:
+            raise ValueError(f"unknown safety level {self.safety}")
+
+    def run(self, nodes: list[Node]) -> list[Node]:
+        if self.safety != "unchecked":
+            nodes = self._check(nodes)
+        return self._mark(nodes)
+
+    def _move(self, value: int):
+        if self.low is not None:
+            self.low += value
+        if self.high is not None:
+            self.high += value
+
+    def _proves(self, first: int, last: int) -> bool:
+        """Whether cells `first` to `last` from the pointer are on the tape"""
+        if self.low is None or self.low + first < 0:
+            return False
+        return self.tape.grow or (
+            self.high is not None and self.high + last < self.tape.size
+        )
+
+    def _require(self, first: int, last: int) -> Optional[Check]:
+        """Check that cells `first` to `last` from the pointer are on the
+        tape, None if the pointer range proves it; the range is narrowed to
+        the pointers passing it"""
+        low = high = None
+        if self.low is None or self.low + first < 0:
+            low = first
+            self.low = -first if self.low is None else max(self.low, -first)
+        size = self.tape.size
+        if not self.tape.grow and (self.high is None or self.high + last >= size):
+            high = last
+            limit = size - 1 - last
+            self.high = limit if self.high is None else min(self.high, limit)
+        if low is None and high is None:
+            return None
+        return Check(low, high)
+
+    def _extent(self, nodes: list[Node], index: int) -> Range:
+        """Smallest and largest offset accessed by `nodes[index]` and, unless
+        it branches or does I/O, by the arithmetic right after it"""
+        node = nodes[index]
+        offsets = list(_accessed(node))
+        if self.safety == "where-needed" and not isinstance(
+            node, (Loop, Scan, Input, Output)
+        ):
+            shift = 0
+            for node in nodes[index + 1 :]:
+                if not isinstance(node, ARITHMETIC):
+                    break
+                if isinstance(node, Move):
+                    shift += node.value
+                offsets.extend(shift + offset for offset in _accessed(node))
+        return min(offsets), max(offsets)
+
+    def _folded(self, nodes: list[Node], index: int) -> Optional[list[Node]]:
+        """The folded loop starting at `nodes[index]`, if its accesses aren't
+        proven on the tape
+
+        A folded loop is a run of `MulAdd` and `ProductAdd` nodes counted by
+        the same `source` cell and the `Clear` of that cell. They access
+        their other cells only when the count isn't zero, like the loop
+        they come from, so they can't be checked unconditionally.
+        """
+        first = nodes[index]
+        if not isinstance(first, (MulAdd, ProductAdd)):
+            return None
+        for end in range(index, len(nodes)):
+            node = nodes[end]
+            if isinstance(node, Clear) and node.offset == first.source:
+                break
+            if not isinstance(node, (MulAdd, ProductAdd)):
+                return None
+            if node.source != first.source:
+                return None
+        else:
+            return None
+        folded = nodes[index : end + 1]
+        offsets = [offset for node in folded for offset in _accessed(node)]
+        if self.safety == "where-needed" and self._proves(min(offsets), max(offsets)):
+            return None
+        return folded
+
+    def _check(self, nodes: list[Node], unfold: bool = True) -> list[Node]:
+        result: list[Node] = []
+        index = 0
+        while index < len(nodes):
+            folded = self._folded(nodes, index) if unfold else None
+            if folded is not None:
+                # back into a loop, which runs at most once as it clears its
+                # cell, so the checks only run with a non-zero count
+                count = folded[0].source
+                body = [_shift(replace(node), -count) for node in folded]
+                moves = [Move(count)] if count else []
+                guarded = moves + [Loop(body)] + [Move(-count) for _ in moves]
+                result.extend(self._check(guarded, unfold=False))
+                index += len(folded)
+                continue
+            node = nodes[index]
+            index += 1
+            if isinstance(node, Move):
+                self._move(node.value)
+            elif _accessed(node):
+                if self.safety == "checked":
+                    self.low = self.high = None
+                check = self._require(*self._extent(nodes, index - 1))
+                if check is not None:
+                    result.append(check)
+            if isinstance(node, Loop):
+                node = self._check_loop(node, unfold)
+            result.append(node)
+            if isinstance(node, Scan):
+                # the scan stops on a cell it may not have checked
+                if node.step > 0:
+                    self.high = None
+                else:
+                    self.low = None
+                check = self._require(0, 0)
+                if check is not None:
+                    result.append(check)
+        return result
+
+    def _check_loop(self, loop: Loop, unfold: bool = True) -> Loop:
+        low, high = self.low, self.high
+        balanced = _written(loop.body) is not None
+        if not balanced:
+            # the cell of every iteration but the first is checked at the
+            # end of the one before
+            self.low, self.high = 0, None if self.tape.grow else self.tape.size - 1
+        body = self._check(loop.body, unfold)
+        check = self._require(0, 0)
+        if check is not None:
+            body.append(check)
+        if balanced:
+            self.low, self.high = low, high
+        else:
+            self.low = _join(self.low, low, min)
+            self.high = _join(self.high, high, max)
+        return Loop(body, loop.position)
+
+    def _range(self, offset: int) -> Range:
+        return self.cells.get(self.position + offset, self.default)
+
+    def _update(self, node: Node, offset: int, low: int, high: int) -> Node:
+        """Records the range of the cell `node` sets to low..high before
+        masking, `node` without `wrap` if the value always fits"""
+        mask = self.tape.mask
+        cell = self.position + offset
+        if 0 <= low and high <= mask:
+            self.cells[cell] = (low, high)
+            return replace(node, wrap=False)
+        if low == high:
+            self.cells[cell] = (low & mask, low & mask)
+        else:
+            self.cells[cell] = (0, mask)
+        return node
+
+    def _mark(self, nodes: list[Node]) -> list[Node]:
+        result: list[Node] = []
+        for node in nodes:
+            if isinstance(node, Move):
+                self.position += node.value
+            elif isinstance(node, Add):
+                low, high = self._range(node.offset)
+                node = self._update(
+                    node, node.offset, low + node.value, high + node.value
+                )
+            elif isinstance(node, Clear):
+                self.cells[self.position + node.offset] = (0, 0)
+            elif isinstance(node, Input):
+                self.cells[self.position + node.offset] = (0, 0xFF)
+            elif isinstance(node, (MulAdd, ProductAdd)):
+                sources = [node.source]
+                if isinstance(node, ProductAdd):
+                    sources.append(node.other)
+                products = [node.factor]
+                for source in sources:
+                    products = [
+                        product * value
+                        for product in products
+                        for value in self._range(source)
+                    ]
+                low, high = self._range(node.offset)
+                node = self._update(
+                    node, node.offset, low + min(products), high + max(products)
+                )
+            elif isinstance(node, Scan):
+                self.cells = {self.position: (0, 0)}
+                self.default = (0, self.tape.mask)
+            elif isinstance(node, Loop):
+                node = self._mark_loop(node)
+            result.append(node)
+        return result
+
+    def _mark_loop(self, loop: Loop) -> Loop:
+        unknown = (0, self.tape.mask)
+        written = _written(loop.body)
+        if written is None:
+            cells, default = {}, unknown
+        else:
+            # cells the body leaves alone keep their value
+            cells, default = dict(self.cells), self.default
+            cells.update((self.position + offset, unknown) for offset in written)
+        low, high = cells.get(self.position, default)
+        self.cells = {**cells, self.position: (max(low, 1), high)}
+        self.default = default
+        body = self._mark(loop.body)
+        self.cells = {**cells, self.position: (0, 0)}
+        self.default = default
+        return Loop(body, loop.position)
+
+
+@dataclass
+class PassManager:
+    """Runs the passes on the segments of a program
+
+    With `constants` and `ranges`, the segments are then passed through them
+    in order, so a manager with either is good for a single program only.
+    The adds of zero kept for the checks are dropped last.
+    """
+
+    passes: list[Pass] = field(default_factory=lambda: list(DEFAULT_PASSES))
+    constants: Optional[ConstantPropagation] = None
+    ranges: Optional[RangeAnalysis] = None
+
+    def run(self, nodes: list[Node]) -> list[Node]:
+        for optimization in self.passes:
+            nodes = optimization(nodes)
+        if self.constants is not None:
+            nodes = self.constants.run(nodes)
+        if self.ranges is not None:
+            nodes = self.ranges.run(nodes)
+        return drop_noops(nodes)
@@ -2,12 +2,19 @@ from asyncio import constants
 from dataclasses import dataclass, field
 from enum import Enum
 import enum
-from typing import MutableSequence, Sequence, Union, overload
+from typing import MutableSequence, Optional, Sequence, Union, overload
 import struct
+from array import array
 
 from sys import stdin
 
-SIMPLE_TYPE = Union[int, str, bytes, None]
+SIMPLE_TYPE = Union[int, str, bytes, None, "Context"]
+BUILTINS = ("len",)
+OUTPUT_BUFFER_SIZE = 1 << 16
+INPUT_CHUNK_SIZE = 1 << 16
+# messages of the IndexError raised by bounds checks, see `check_bounds`
+TAPE_START_ERROR = "pointer moved before the start of the tape"
+TAPE_END_ERROR = "pointer moved past the end of the tape"
 
 
 class PyCmpOp(Enum):
@@ -149,53 +156,209 @@ class PyOpCode(Enum):
     DICT_UPDATE = 165
 
 
+@dataclass(eq=False)
+class Label:
+    """Jump target, resolved to a byte offset by the assembler"""
+
+    # index of the instruction the label points at
+    index: int = -1
+
+
+ABSOLUTE_JUMPS = frozenset(
+    {
+        PyOpCode.JUMP_ABSOLUTE,
+        PyOpCode.POP_JUMP_IF_FALSE,
+        PyOpCode.POP_JUMP_IF_TRUE,
+        PyOpCode.JUMP_IF_FALSE_OR_POP,
+        PyOpCode.JUMP_IF_TRUE_OR_POP,
+        PyOpCode.JUMP_IF_NOT_EXC_MATCH,
+    }
+)
+RELATIVE_JUMPS = frozenset(
+    {
+        PyOpCode.JUMP_FORWARD,
+        PyOpCode.FOR_ITER,
+        PyOpCode.SETUP_FINALLY,
+        PyOpCode.SETUP_WITH,
+        PyOpCode.SETUP_ASYNC_WITH,
+    }
+)
+MAX_ARG_SIZE = 4  # bytes, i.e. up to three EXTENDED_ARG prefixes
+EXTENDED_ARG = PyOpCode.EXTENDED_ARG.value
+
+
+def arg_size(value: int) -> int:
+    """Number of code units needed to encode `value` as an oparg"""
+    if value < 0:
+        raise ValueError(f"{value} is not a valid value for an opcode")
+    size = 1
+    while value > 0xFF:
+        value >>= 8
+        size += 1
+    if size > MAX_ARG_SIZE:
+        raise ValueError(f"{value} is not a valid value for an opcode")
+    return size
+
+
+def encode_instruction(
+    op: int, value: int, size: int = 0, extended_arg: int = EXTENDED_ARG
+) -> bytes:
+    """Encodes an instruction, prefixed with as many EXTENDED_ARG as needed or
+    padded with zeroed ones up to `size` code units"""
+    size = max(size, arg_size(value))
+    code = bytearray()
+    for i in range(size - 1, 0, -1):
+        code += struct.pack("<BB", extended_arg, (value >> (8 * i)) & 0xFF)
+    code += struct.pack("<BB", op, value & 0xFF)
+    return bytes(code)
+
+
 @dataclass
 class OpCode:
     op: PyOpCode
     value: int = 0
+    target: Union[Label, None] = None
+
+    def as_byte(self, size: int = 0) -> bytes:
+        return encode_instruction(self.op.value, self.value, size)
+
+
+ARRAY_TYPECODES = {8: "B", 16: "H", 32: "I"}
+
+
+@dataclass(frozen=True)
+class Tape:
+    """Runtime representation of the brainfuck tape
+
+    `backend` is one of "list" (python ints), "bytearray" (8 bit cells only)
+    or "array" (`array.array` with a typecode matching `cell_bits`). A
+    growing tape is extended by another `size` cells whenever the pointer
+    gets close to its end.
+    """
+
+    backend: str = "bytearray"
+    size: int = 30000
+    cell_bits: int = 8
+    grow: bool = False
 
-    def as_byte(self) -> bytes:
-        # TODO: check if this is correct
-        if 0 <= self.value <= 255:
-            return struct.pack("<BB", self.op.value, self.value)
-        if 256 <= self.value < 65536:  # not sure if `<` is correct
-            top_two_bytes = self.value >> 8
-            bottom_byte = self.value & 0xFF
-            extend = OpCode(PyOpCode.EXTENDED_ARG, top_two_bytes)
-            this = OpCode(self.op, bottom_byte)
-            return extend.as_byte() + this.as_byte()
-        raise ValueError(f"{self.value} is not a valid value for an opcode")
+    def __post_init__(self):
+        if self.backend not in ("list", "bytearray", "array"):
+            raise ValueError(f"unknown tape backend {self.backend}")
+        if self.cell_bits not in ARRAY_TYPECODES:
+            raise ValueError(f"unsupported cell size of {self.cell_bits} bits")
+        if self.backend == "bytearray" and self.cell_bits != 8:
+            raise ValueError("bytearray tape only supports 8 bit cells")
+        if self.size <= 0:
+            raise ValueError("tape size must be positive")
+
+    @property
+    def mask(self) -> int:
+        return (1 << self.cell_bits) - 1
+
+    @property
+    def typecode(self) -> str:
+        return ARRAY_TYPECODES[self.cell_bits]
 
 
 @dataclass
 class Context:
     constants: MutableSequence[SIMPLE_TYPE] = field(default_factory=list)
     names: MutableSequence[str] = field(default_factory=list)
-    ops: list[OpCode] = field(default_factory=list)
-    _jump_stack: list[int] = field(default_factory=list)
+    # instruction stream: opcodes and the low byte of their argument, with the
+    # full argument of the few that don't fit in a byte kept aside
+    op_codes: array = field(default_factory=lambda: array("B"))
+    op_args: array = field(default_factory=lambda: array("B"))
+    wide_args: dict[int, int] = field(default_factory=dict)
+    # instruction index -> label for jumps, patched by the assembler
+    jump_targets: dict[int, Label] = field(default_factory=dict)
+    # (instruction index, line) wherever the line changes, the code starts on
+    # line 0; see `set_line`
+    lines: list[tuple[int, int]] = field(default_factory=list)
+    line: int = 0
+    _jump_stack: list[Label] = field(default_factory=list)
+    stacksize: int = 6
+    varnames: list[str] = field(default_factory=list)
+    # keep variables in fast local slots, only valid for function code objects
+    fast_locals: bool = False
+    name: str = "<module>"
+    tape: Tape = field(default_factory=Tape)
+    # largest offset from the pointer accessed by the program
+    reach: int = 0
+    # set by `init_io`, the output buffer has to be flushed on termination
+    buffered_io: bool = False
+    # the code is a generator doing its I/O through yield, see `init_io`
+    resumable: bool = False
+    # flushes the output buffer when the program raises, see `guard_output`
+    _output_handler: Optional[Label] = None
+    # accesses are bounds checked, see `check_bounds`
+    checked: bool = False
+    # positions in `constants`, `names` and `varnames`, keyed by `intern_key`
+    _const_index: dict[tuple, int] = field(default_factory=dict)
+    _name_index: dict[str, int] = field(default_factory=dict)
+    _varname_index: dict[str, int] = field(default_factory=dict)
+
+    @staticmethod
+    def intern_key(value: SIMPLE_TYPE) -> tuple:
+        """Key telling apart values that compare equal, like 0, False and 0.0;
+        code objects are only ever equal to themselves"""
+        if isinstance(value, Context):
+            return (Context, id(value))
+        return (type(value), value)
 
     def consti(self, value: SIMPLE_TYPE) -> int:
-        if value not in self.constants:
+        key = self.intern_key(value)
+        index = self._const_index.get(key)
+        if index is None:
+            index = self._const_index[key] = len(self.constants)
             self.constants.append(value)
-        return self.constants.index(value)
+        return index
 
     def load_const(self, value: SIMPLE_TYPE):
         self.append_op(PyOpCode.LOAD_CONST, self.consti(value))
 
     def append_name(self, name: str):
-        if name in self.names:
+        if name in self._name_index:
             return
+        self._name_index[name] = len(self.names)
         self.names.append(name)
 
     def namei(self, name: str) -> int:
         self.append_name(name)
-        return self.names.index(name)
+        return self._name_index[name]
+
+    def varnamei(self, name: str) -> int:
+        index = self._varname_index.get(name)
+        if index is None:
+            index = self._varname_index[name] = len(self.varnames)
+            self.varnames.append(name)
+        return index
 
     def load_name(self, name: str):
-        self.append_op(PyOpCode.LOAD_NAME, self.namei(name))
+        if self.fast_locals:
+            self.load_fast(name)
+        else:
+            self.append_op(PyOpCode.LOAD_NAME, self.namei(name))
 
     def store_name(self, name: str):
-        self.append_op(PyOpCode.STORE_NAME, self.namei(name))
+        if self.fast_locals:
+            self.store_fast(name)
+        else:
+            self.append_op(PyOpCode.STORE_NAME, self.namei(name))
+
+    def load_fast(self, name: str):
+        self.append_op(PyOpCode.LOAD_FAST, self.varnamei(name))
+
+    def store_fast(self, name: str):
+        self.append_op(PyOpCode.STORE_FAST, self.varnamei(name))
+
+    def load_global(self, name: str):
+        self.append_op(PyOpCode.LOAD_GLOBAL, self.namei(name))
+
+    def load_builtin(self, name: str):
+        if self.fast_locals:
+            self.load_global(name)
+        else:
+            self.load_name(name)
 
     @overload
     def append_op(self, op: OpCode):
@@ -207,12 +370,55 @@ class Context:
 
     def append_op(self, op: Union[OpCode, PyOpCode], value: int = 0):
         if isinstance(op, OpCode):
-            self.ops.append(op)
-        else:
-            self.ops.append(OpCode(op, value))
+            if op.target is not None:
+                self.jump_targets[len(self.op_codes)] = op.target
+            op, value = op.op, op.value
+        if not 0 <= value <= 0xFF:
+            arg_size(value)  # validate early
+            self.wide_args[len(self.op_codes)] = value
+            value &= 0xFF
+        # `_value_` skips the descriptor behind `Enum.value`, this is hot
+        self.op_codes.append(op._value_)
+        self.op_args.append(value)
 
     def extends_ops(self, ops: Sequence[OpCode]):
-        self.ops.extend(ops)
+        for op in ops:
+            self.append_op(op)
+
+    @property
+    def ops(self) -> list[OpCode]:
+        """Instructions as OpCode objects, for inspection only"""
+        return [
+            OpCode(
+                PyOpCode(code),
+                self.wide_args.get(idx, arg),
+                self.jump_targets.get(idx),
+            )
+            for idx, (code, arg) in enumerate(zip(self.op_codes, self.op_args))
+        ]
+
+    def set_line(self, line: int):
+        """Attributes the next emitted instructions to `line`
+
+        Brainfuck has no lines worth reporting, the compiler uses the position
+        of the innermost enclosing `[` plus one instead, 0 outside of loops.
+        """
+        if line == self.line:
+            return
+        self.line = line
+        idx = len(self.op_codes)
+        if self.lines and self.lines[-1][0] == idx:
+            self.lines.pop()
+        self.lines.append((idx, line))
+
+    def mark_label(self, label: Union[Label, None] = None) -> Label:
+        """Points `label` (or a new one) at the next emitted instruction"""
+        label = label or Label()
+        label.index = len(self.op_codes)
+        return label
+
+    def jump(self, op: PyOpCode, label: Label):
+        self.append_op(OpCode(op, target=label))
 
     def nop(self):
         self.append_op(PyOpCode.NOP)
@@ -251,6 +457,10 @@ class Context:
         """
         self.append_op(PyOpCode.STORE_SUBSCR)
 
+    def load_attr(self, name: str):
+        """TOS = TOS.name"""
+        self.append_op(PyOpCode.LOAD_ATTR, self.namei(name))
+
     def load_method(self, name: str):
         self.append_op(PyOpCode.LOAD_METHOD, self.namei(name))
 
@@ -273,33 +483,222 @@ class Context:
         self.store_name("stdout")  # sys
         self.pop_top()  #
 
-    def init_memory(self):
+    def init_io(self):
+        """Sets up buffered I/O on top of the binary stdin and stdout
+
+        Output bytes are collected in a preallocated `output` bytearray which
+        is written out once full, before reading input and on termination,
+        even by an exception (`guard_output`).
+        Input is read in chunks of up to INPUT_CHUNK_SIZE bytes into `input`.
+
+        A resumable program never touches the streams: it yields the output
+        as bytes, and yields None for more input, which is then sent in (an
+        empty or None chunk at the end of input).
+        """
+        if not self.resumable:
+            self.import_streams()
+        self.load_builtin("bytearray")  # bytearray()
+        self.load_const(OUTPUT_BUFFER_SIZE)  # bytearray(), size
+        self.call_function()  # bytearray(size)
+        self.append_op(PyOpCode.DUP_TOP)  # output, output
+        self.store_name("output")  # output
+        self.load_builtin("memoryview")  # output, memoryview()
+        self.append_op(PyOpCode.ROT_TWO)  # memoryview(), output
+        self.call_function()  # memoryview(output)
+        self.store_name("output_view")  #
+        self.load_const(0)  # 0
+        self.store_name("output_len")  #
+        self.load_const(b"")  # b""
+        self.store_name("input")  #
+        self.load_const(0)  # 0
+        self.store_name("input_pos")  #
+        self.buffered_io = True
+
+    def import_streams(self):
+        """Binds the binary stdin and stdout and their read and write methods"""
+        self.import_stdin_stdout()
+        for stream in ("stdin", "stdout"):
+            self.load_name(stream)  # stream
+            self.load_attr("buffer")  # stream.buffer
+            self.store_name(stream)  #
+        self.load_name("stdout")  # stdout
+        self.load_attr("write")  # stdout.write
+        self.store_name("stdout_write")  #
+        self.load_name("stdin")  # stdin
+        self.load_attr("read1")  # stdin.read1
+        self.store_name("stdin_read")  #
+
+    def flush_output(self, flush_stream: bool = False):
+        """Writes out the pending part of the output buffer"""
+        if self.resumable:
+            self.yield_output()
+            return
+        self.load_name("stdout_write")  # write()
+        self.load_name("output_view")  # write(), output_view
+        self.load_const(None)  # write(), output_view, None
+        self.load_name("output_len")  # write(), output_view, None, output_len
+        self.append_op(PyOpCode.BUILD_SLICE, 2)  # write(), output_view, [:len]
+        self.binary_subscr()  # write(), output_view[:output_len]
+        self.call_function()  # write(output_view[:output_len])
+        self.pop_top()  #
+        self.load_const(0)  # 0
+        self.store_name("output_len")  #
+        if flush_stream:
+            self.load_name("stdout")  # stdout
+            self.load_method("flush")  # flush()
+            self.call_method(0)  # flush()
+            self.pop_top()  #
+
+    def yield_output(self):
+        """Yields the pending part of the output buffer, if any, as bytes"""
+        empty = Label()
+        self.load_name("output_len")  # output_len
+        self.jump(PyOpCode.POP_JUMP_IF_FALSE, empty)  #
+        self.load_builtin("bytes")  # bytes()
+        self.load_name("output_view")  # bytes(), output_view
+        self.load_const(None)  # bytes(), output_view, None
+        self.load_name("output_len")  # bytes(), output_view, None, output_len
+        self.append_op(PyOpCode.BUILD_SLICE, 2)  # bytes(), output_view, [:len]
+        self.binary_subscr()  # bytes(), output_view[:output_len]
+        self.call_function()  # bytes(output_view[:output_len])
+        self.yield_value()  # sent value
+        self.pop_top()  #
         self.load_const(0)  # 0
-        self.append_op(PyOpCode.BUILD_LIST, 1)  #  [0]
-        self.load_const(2 ** 9)  # [0], 2 ** 9
-        self.append_op(PyOpCode.BINARY_MULTIPLY)  # [0] * 2 ** 9
+        self.store_name("output_len")  #
+        self.mark_label(empty)
+
+    def yield_value(self):
+        """TOS -- sent value"""
+        self.append_op(PyOpCode.YIELD_VALUE)
+
+    def new_tape(self, size: int):
+        """-- zeroed tape of `size` cells"""
+        if self.tape.backend == "bytearray":
+            self.load_builtin("bytearray")  # bytearray()
+            self.load_const(size)  # bytearray(), size
+            self.call_function()  # bytearray(size)
+            return
+        if self.tape.backend == "array":
+            self.load_name("array")  # array()
+            self.load_const(self.tape.typecode)  # array(), typecode
+            self.load_const(0)  # array(), typecode, 0
+            self.append_op(PyOpCode.BUILD_LIST, 1)  # array(), typecode, [0]
+            self.call_function(2)  # array(typecode, [0])
+        else:
+            self.load_const(0)  # 0
+            self.append_op(PyOpCode.BUILD_LIST, 1)  # [0]
+        self.load_const(size)  # [0], size
+        self.append_op(PyOpCode.BINARY_MULTIPLY)  # [0] * size
+
+    def import_array(self):
+        self.load_const(0)  # 0
+        self.load_const("array")  # 0, "array"
+        self.append_op(PyOpCode.BUILD_TUPLE, 1)  # 0, ("array",)
+        self.append_op(PyOpCode.IMPORT_NAME, self.namei("array"))  # array module
+        self.append_op(PyOpCode.IMPORT_FROM, self.namei("array"))  # module, array
+        self.store_name("array")  # module
+        self.pop_top()  #
+
+    def tape_length(self) -> int:
+        """Initial length of `memory`: a checked fixed size tape has a zero
+        cell past its end, which stops the scans running off it"""
+        if self.checked and not self.tape.grow:
+            return self.tape.size + 1
+        return self.tape.size
+
+    def init_memory(self):
+        if self.tape.backend == "array":
+            self.import_array()
+        self.new_tape(self.tape_length())  # memory
         self.store_name("memory")  #
+        if self.tape.grow:
+            self.new_tape(self.tape.size)  # zeroes
+            self.store_name("tape_chunk")  #
 
     def init_pointer(self):
         self.load_const(0)  # 0
         self.store_name("pointer")  #
 
+    def ensure_tape(self):
+        """Grows the tape until `memory[pointer + reach]` is valid"""
+        if not self.tape.grow:
+            return
+        check = self.mark_label()
+        done = Label()
+        self.load_name("pointer")  # pointer
+        self.load_const(self.reach)  # pointer, reach
+        self.binary_add()  # pointer + reach
+        self.load_name("len")  # pointer + reach, len()
+        self.load_name("memory")  # pointer + reach, len(), memory
+        self.call_function()  # pointer + reach, len(memory)
+        self.compare_op(PyCmpOp.SMALLER)  # pointer + reach < len(memory)
+        self.jump(PyOpCode.POP_JUMP_IF_TRUE, done)  #
+        self.load_name("memory")  # memory
+        self.load_name("tape_chunk")  # memory, tape_chunk
+        self.append_op(PyOpCode.INPLACE_ADD)  # memory + tape_chunk
+        self.store_name("memory")  #
+        self.jump(PyOpCode.JUMP_ABSOLUTE, check)
+        self.mark_label(done)
+
+    def hoist_builtins(self, names: Sequence[str] = BUILTINS):
+        """Copies builtins into fast locals so the program never looks them up"""
+        for name in names:
+            self.load_global(name)  # name
+            self.store_fast(name)  #
+
+    def guard_output(self):
+        """Makes the rest of the program, up to `terminate`, flush the output
+        buffer before letting an exception through
+
+        A resumable program can't yield from there, the ones driving it get
+        what it yielded before.
+        """
+        if not self.buffered_io or self.resumable:
+            return
+        self._output_handler = Label()
+        self.jump(PyOpCode.SETUP_FINALLY, self._output_handler)
+        # the handler runs above the 6 values 3.10 pushes for the exception
+        self.stacksize = max(self.stacksize, 12)
+
     def init_program(self):
-        self.import_stdin_stdout()
+        if self.resumable:
+            # pops the None a generator is started with
+            self.append_op(PyOpCode.GEN_START, 0)
+        self.init_io()
+        if self.fast_locals:
+            self.hoist_builtins()
+        self.guard_output()
         self.init_memory()
         self.init_pointer()
+        self.ensure_tape()
+
+    def raise_if_true(self, message: str, error: str = "IndexError"):
+        """if TOS: raise error(message)
 
-    def raise_if_true(self, message: str):
-        """
-        TODO: doesn't work, needs to be fixed
-        if TOS: raise Exception(message)
         TOS --
         """
-        self.append_op(PyOpCode.POP_JUMP_IF_FALSE, len(self.ops) + 5)
-        self.load_name("Exception")  # Exception
-        self.load_const(message)  # Exception, message
-        self.call_function()  # Exception
-        self.append_op(PyOpCode.RAISE_VARARGS, 1)
+        end = Label()
+        self.jump(PyOpCode.POP_JUMP_IF_FALSE, end)  #
+        self.load_builtin(error)  # error()
+        self.load_const(message)  # error(), message
+        self.call_function()  # error(message)
+        self.append_op(PyOpCode.RAISE_VARARGS, 1)  #
+        self.mark_label(end)
+
+    def check_bounds(self, low: Optional[int] = None, high: Optional[int] = None):
+        """Raises IndexError unless 0 <= pointer + low and pointer + high <
+        tape size, bounds left to None aren't checked"""
+        self.nop()
+        if low is not None:
+            self.load_name("pointer")  # pointer
+            self.load_const(-low)  # pointer, -low
+            self.compare_op(PyCmpOp.SMALLER)  # pointer < -low
+            self.raise_if_true(TAPE_START_ERROR)
+        if high is not None:
+            self.load_name("pointer")  # pointer
+            self.load_const(self.tape.size - high)  # pointer, size - high
+            self.compare_op(PyCmpOp.GREATER_EQUAL)  # pointer >= size - high
+            self.raise_if_true(TAPE_END_ERROR)
 
     def increment_pointer(self, increment: int = 1):
         self.nop()
@@ -307,100 +706,327 @@ class Context:
         self.load_const(increment)  # pointer, increment
         self.append_op(PyOpCode.INPLACE_ADD)  # pointer + increment
         self.store_name("pointer")  #
+        self.ensure_tape()
 
     def decrement_pointer(self, decrement: int = 1):
         self.nop()
         self.load_name("pointer")  # pointer
         self.load_const(decrement)  # pointer, decrement
         self.append_op(PyOpCode.INPLACE_SUBTRACT)  # pointer - decrement
-        # self.dup_top()
-        # self.load_const(0)  # pointer - decrement, pointer - decrement, 0
-        # self.compare_op(
-        #     PyCmpOp.SMALLER
-        # )  # pointer - decrement, (pointer - decrement) < 0
-        # self.raise_if_true("pointer underflow")  # pointer - decrement
         self.store_name("pointer")  #
 
-    def increment_cell(self, increment: int = 1):
-        self.nop()
+    def load_cell_address(self, offset: int = 0):
+        """-- memory, pointer + offset"""
         self.load_name("memory")  # memory
         self.load_name("pointer")  # memory, pointer
-        self.dup_top_two()  # memory, pointer, pointer, pointer
-        self.binary_subscr()  # memory, pointer, memory[pointer]
-        self.load_const(increment)  # memory, pointer, memory[pointer], increment
-        self.append_op(
-            PyOpCode.INPLACE_ADD
-        )  # memory, pointer, memory[pointer] + increment
-        self.load_const(256)  # memory, pointer, memory[pointer] + increment, 256
+        if offset:
+            self.load_const(offset)  # memory, pointer, offset
+            self.binary_add()  # memory, pointer + offset
+
+    def load_cell(self, offset: int = 0):
+        """-- memory[pointer + offset]"""
+        self.load_cell_address(offset)  # memory, pointer + offset
+        self.binary_subscr()  # memory[pointer + offset]
+
+    def wrap_cell(self, wrap: bool = True):
+        """value -- value & mask, a no-op for values known to fit in a cell"""
+        if wrap:
+            self.load_const(self.tape.mask)  # value, mask
+            self.append_op(PyOpCode.BINARY_AND)  # value & mask
+
+    def increment_cell(self, increment: int = 1, offset: int = 0, wrap: bool = True):
+        self.nop()
+        self.load_cell_address(offset)  # memory, index
+        self.dup_top_two()  # memory, index, memory, index
+        self.binary_subscr()  # memory, index, memory[index]
+        self.load_const(increment)  # memory, index, memory[index], increment
+        self.append_op(PyOpCode.INPLACE_ADD)  # memory, index, memory[index] + increment
+        if not wrap:
+            self.append_op(
+                PyOpCode.ROT_THREE
+            )  # memory[index] + increment, memory, index
+            self.store_subscr()  #
+            return
+        self.load_const(self.tape.mask)  # memory, index, memory[index] + inc, mask
         self.append_op(
-            PyOpCode.INPLACE_MODULO
-        )  # memory, pointer, (memory[pointer] + increment) % 256
+            PyOpCode.INPLACE_AND
+        )  # memory, index, (memory[index] + increment) & mask
         # push TOS behind TOS2
         self.append_op(
             PyOpCode.ROT_THREE
-        )  # (memory[pointer] + increment) % 256, memory, pointer
+        )  # (memory[index] + increment) & mask, memory, index
         self.store_subscr()  #
 
-    def decrement_cell(self, decrement: int = 1):
+    def decrement_cell(self, decrement: int = 1, offset: int = 0, wrap: bool = True):
         self.nop()
-        self.load_name("memory")  # memory
-        self.load_name("pointer")  # memory, pointer
-        self.dup_top_two()  # memory, pointer, pointer, pointer
-        self.binary_subscr()  # memory, pointer, memory[pointer]
-        self.load_const(decrement)  # memory, pointer, memory[pointer], decrement
+        self.load_cell_address(offset)  # memory, index
+        self.dup_top_two()  # memory, index, memory, index
+        self.binary_subscr()  # memory, index, memory[index]
+        self.load_const(decrement)  # memory, index, memory[index], decrement
         self.append_op(
             PyOpCode.INPLACE_SUBTRACT
-        )  # memory, pointer, memory[pointer] - decrement
-        self.load_const(256)  # memory, pointer, memory[pointer] - increment, 256
+        )  # memory, index, memory[index] - decrement
+        if not wrap:
+            self.append_op(
+                PyOpCode.ROT_THREE
+            )  # memory[index] - decrement, memory, index
+            self.store_subscr()  #
+            return
+        self.load_const(self.tape.mask)  # memory, index, memory[index] - dec, mask
         self.append_op(
-            PyOpCode.INPLACE_MODULO
-        )  # memory, pointer, (memory[pointer] - increment) % 256
+            PyOpCode.INPLACE_AND
+        )  # memory, index, (memory[index] - decrement) & mask
         # push TOS behind TOS2
         self.append_op(
             PyOpCode.ROT_THREE
-        )  # memory[pointer] - decrement, memory, pointer
+        )  # (memory[index] - decrement) & mask, memory, index
         self.store_subscr()  #
 
-    def stdout_print_cell(self):
+    def clear_cell(self, offset: int = 0):
         self.nop()
-        self.load_name("stdout")  # stdout
-        self.load_method("write")  # write()
-        self.load_name("chr")  # write(), chr()
-        self.load_name("memory")  # write(), chr(), memory
-        self.load_name("pointer")  # write(), chr(), memory, pointer
-        self.binary_subscr()  # write(), chr(), memory[pointer]
-        self.call_function()  # write(), chr(memory[pointer])
-        self.call_method()  # write(chr(memory[pointer]))
-        self.pop_top()  #
+        self.load_const(0)  # 0
+        self.load_cell_address(offset)  # 0, memory, index
+        self.store_subscr()  #
 
-    def stdin_get_cell(self):
+    def mul_add_cell(
+        self, offset: int, factor: int, source: int = 0, wrap: bool = True
+    ):
+        """memory[pointer + offset] += memory[pointer + source] * factor"""
         self.nop()
-        self.load_name("ord")  # ord()
-        self.load_name("stdin")  # ord(), stdin
-        self.load_method("read")  # ord(), read()
-        self.load_const(1)  # ord(), read(), 1
-        self.call_method()  # ord(), read(1)
-        self.call_function()  # ord(read(1))
-        self.load_name("memory")  # ord(read(1)), memory
-        self.load_name("pointer")  # ord(read(1)), memory, pointer
+        self.load_cell_address(offset)  # memory, index
+        self.dup_top_two()  # memory, index, memory, index
+        self.binary_subscr()  # memory, index, memory[index]
+        self.load_cell(source)  # memory, index, memory[index], memory[source]
+        if factor != 1:
+            self.load_const(factor)  # ..., memory[source], factor
+            self.append_op(PyOpCode.BINARY_MULTIPLY)  # ..., memory[source] * factor
+        self.binary_add()  # memory, index, memory[index] + memory[source] * factor
+        self.wrap_cell(wrap)  # memory, index, result
+        self.append_op(PyOpCode.ROT_THREE)  # result, memory, index
         self.store_subscr()  #
 
-    def push_to_jump_stack(self):
+    def product_add_cell(
+        self, offset: int, factor: int, source: int, other: int, wrap: bool = True
+    ):
+        """memory[pointer + offset] +=
+        memory[pointer + source] * memory[pointer + other] * factor"""
+        # the second cell is loaded on top of four values
+        self.stacksize = max(self.stacksize, 7)
         self.nop()
-        self._jump_stack.append(len(self.ops))
+        self.load_cell_address(offset)  # memory, index
+        self.dup_top_two()  # memory, index, memory, index
+        self.binary_subscr()  # memory, index, memory[index]
+        self.load_cell(source)  # memory, index, memory[index], memory[source]
+        self.load_cell(other)  # ..., memory[source], memory[other]
+        self.append_op(PyOpCode.BINARY_MULTIPLY)  # ..., memory[source] * memory[other]
+        if factor != 1:
+            self.load_const(factor)  # ..., product, factor
+            self.append_op(PyOpCode.BINARY_MULTIPLY)  # ..., product * factor
+        self.binary_add()  # memory, index, memory[index] + product * factor
+        self.wrap_cell(wrap)  # memory, index, result
+        self.append_op(PyOpCode.ROT_THREE)  # result, memory, index
+        self.store_subscr()  #
 
-    def cond_jump_top_jump_stack(self):
+    def scan(self, step: int):
+        """while memory[pointer]: pointer += step"""
         self.nop()
-        self.load_name("memory")  # memory
-        self.load_name("pointer")  # memory, pointer
-        self.binary_subscr()  # memory[pointer]
-        self.load_const(0)  # memory[pointer], 0
-        self.compare_op(PyCmpOp.EQUAL)  # memory[pointer] == 0
-        self.append_op(PyOpCode.POP_JUMP_IF_FALSE, self._jump_stack.pop())  #
+        loop_start = Label()
+        done = Label()
+        if step == 1:
+            # index raises ValueError without a zero cell left, the loop
+            # grows the tape or runs off its end instead
+            self.load_name("memory")  # memory
+            self.load_const(-1)  # memory, -1
+            self.binary_subscr()  # memory[-1]
+            self.jump(PyOpCode.POP_JUMP_IF_TRUE, loop_start)  #
+            self.load_name("memory")  # memory
+            self.load_method("index")  # index()
+            self.load_const(0)  # index(), 0
+            self.load_name("pointer")  # index(), 0, pointer
+            self.call_method(2)  # memory.index(0, pointer)
+            self.store_name("pointer")  #
+            self.ensure_tape()
+            self.jump(PyOpCode.JUMP_ABSOLUTE, done)  #
+        if step == -1 and self.tape.backend == "bytearray":
+            # rfind gives -1 when the scan runs off the tape, for the check
+            # that follows a scan to catch
+            self.load_name("memory")  # memory
+            self.load_method("rfind" if self.checked else "rindex")  # rindex()
+            self.load_const(0)  # rindex(), 0
+            self.load_const(0)  # rindex(), 0, 0
+            self.load_name("pointer")  # rindex(), 0, 0, pointer
+            self.load_const(1)  # rindex(), 0, 0, pointer, 1
+            self.binary_add()  # rindex(), 0, 0, pointer + 1
+            self.call_method(3)  # memory.rindex(0, 0, pointer + 1)
+            self.store_name("pointer")  #
+            return
+        self.mark_label(loop_start)
+        self.load_cell()  # memory[pointer]
+        self.jump(PyOpCode.POP_JUMP_IF_FALSE, done)  #
+        self.load_name("pointer")  # pointer
+        self.load_const(step)  # pointer, step
+        self.append_op(PyOpCode.INPLACE_ADD)  # pointer + step
+        self.store_name("pointer")  #
+        if step > 0:
+            self.ensure_tape()
+        if self.checked:
+            if step < 0:
+                self.check_bounds(low=0)
+            elif not self.tape.grow:
+                self.check_bounds(high=0)
+        self.jump(PyOpCode.JUMP_ABSOLUTE, loop_start)  #
+        self.mark_label(done)
+
+    def stdout_print_cell(self, offset: int = 0):
+        self.nop()
+        skip_flush = Label()
+        self.load_cell(offset)  # memory[index]
+        if self.tape.cell_bits > 8:
+            self.load_const(0xFF)  # memory[index], 0xFF
+            self.append_op(PyOpCode.BINARY_AND)  # memory[index] & 0xFF
+        self.load_name("output")  # byte, output
+        self.load_name("output_len")  # byte, output, output_len
+        self.store_subscr()  #
+        self.load_name("output_len")  # output_len
+        self.load_const(1)  # output_len, 1
+        self.append_op(PyOpCode.INPLACE_ADD)  # output_len + 1
+        self.dup_top()  # output_len + 1, output_len + 1
+        self.store_name("output_len")  # output_len
+        self.load_const(OUTPUT_BUFFER_SIZE)  # output_len, size
+        self.compare_op(PyCmpOp.SMALLER)  # output_len < size
+        self.jump(PyOpCode.POP_JUMP_IF_TRUE, skip_flush)  #
+        self.flush_output()
+        self.mark_label(skip_flush)
+
+    def stdout_write_bytes(self, data: bytes):
+        """Appends bytes known at compile time to the output buffer
+
+        Data that doesn't fit in an empty buffer is written out directly.
+        """
+        self.nop()
+        if len(data) > OUTPUT_BUFFER_SIZE:
+            self.flush_output()
+            if self.resumable:
+                self.load_const(data)  # data
+                self.yield_value()  # sent value
+                self.pop_top()  #
+                return
+            self.load_name("stdout_write")  # write()
+            self.load_const(data)  # write(), data
+            self.call_function()  # write(data)
+            self.pop_top()  #
+            return
+        skip_flush = Label()
+        self.load_name("output_len")  # output_len
+        self.load_const(OUTPUT_BUFFER_SIZE - len(data))  # output_len, room
+        self.compare_op(PyCmpOp.GREATER)  # output_len > room
+        self.jump(PyOpCode.POP_JUMP_IF_FALSE, skip_flush)  #
+        self.flush_output()
+        self.mark_label(skip_flush)
+        self.load_const(data)  # data
+        self.load_name("output")  # data, output
+        self.load_name("output_len")  # data, output, output_len
+        self.dup_top()  # data, output, output_len, output_len
+        self.load_const(len(data))  # data, output, output_len, output_len, n
+        self.binary_add()  # data, output, output_len, output_len + n
+        self.append_op(PyOpCode.BUILD_SLICE, 2)  # data, output, [len:len + n]
+        self.store_subscr()  #
+        self.load_name("output_len")  # output_len
+        self.load_const(len(data))  # output_len, n
+        self.append_op(PyOpCode.INPLACE_ADD)  # output_len + n
+        self.store_name("output_len")  #
+
+    def stdin_get_cell(self, offset: int = 0):
+        """Reads a byte from the input buffer, refilling it when exhausted
+
+        The cell is set to 0 at the end of input.
+        """
+        self.nop()
+        buffered, store = Label(), Label()
+        self.load_name("input_pos")  # input_pos
+        self.load_name("len")  # input_pos, len()
+        self.load_name("input")  # input_pos, len(), input
+        self.call_function()  # input_pos, len(input)
+        self.compare_op(PyCmpOp.SMALLER)  # input_pos < len(input)
+        self.jump(PyOpCode.POP_JUMP_IF_TRUE, buffered)  #
+        # let interactive programs show their prompt before blocking on input
+        self.flush_output(flush_stream=True)
+        if self.resumable:
+            received = Label()
+            self.load_const(None)  # None
+            self.yield_value()  # sent chunk
+            self.dup_top()  # chunk, chunk
+            self.jump(PyOpCode.POP_JUMP_IF_TRUE, received)  # chunk
+            self.pop_top()  #
+            self.load_const(b"")  # b""
+            self.mark_label(received)
+        else:
+            self.load_name("stdin_read")  # read1()
+            self.load_const(INPUT_CHUNK_SIZE)  # read1(), size
+            self.call_function()  # read1(size)
+        self.store_name("input")  #
+        self.load_const(0)  # 0
+        self.store_name("input_pos")  #
+        self.load_name("input")  # input
+        self.jump(PyOpCode.POP_JUMP_IF_TRUE, buffered)  #
+        self.load_const(0)  # 0
+        self.jump(PyOpCode.JUMP_ABSOLUTE, store)  # 0
+        self.mark_label(buffered)
+        self.load_name("input")  # input
+        self.load_name("input_pos")  # input, input_pos
+        self.binary_subscr()  # input[input_pos]
+        self.load_name("input_pos")  # input[input_pos], input_pos
+        self.load_const(1)  # input[input_pos], input_pos, 1
+        self.append_op(PyOpCode.INPLACE_ADD)  # input[input_pos], input_pos + 1
+        self.store_name("input_pos")  # input[input_pos]
+        self.mark_label(store)
+        self.load_cell_address(offset)  # byte, memory, index
+        self.store_subscr()  #
+
+    def push_to_jump_stack(self):
+        """`[`: skip the loop body when the current cell is zero"""
+        body, end = Label(), Label()
+        self.load_cell()  # memory[pointer]
+        self.jump(PyOpCode.POP_JUMP_IF_FALSE, end)  #
+        self.mark_label(body)
+        self._jump_stack.append(body)
+        self._jump_stack.append(end)
+
+    def cond_jump_top_jump_stack(self):
+        """`]`: jump back to the loop body while the current cell is non-zero"""
+        end = self._jump_stack.pop()
+        body = self._jump_stack.pop()
+        self.load_cell()  # memory[pointer]
+        self.jump(PyOpCode.POP_JUMP_IF_TRUE, body)  #
+        self.mark_label(end)
+
+    def call_code(self, code: "Context"):
+        """Calls `code` as a function taking no arguments"""
+        self.load_const(code)  # code
+        self.load_const(code.name)  # code, name
+        self.append_op(PyOpCode.MAKE_FUNCTION, 0)  # function
+        self.call_function(0)  # function()
+        self.pop_top()  #
+
+    def define_function(self, code: "Context", name: str = "main"):
+        """Binds `code`, as a function taking no arguments, to `name`"""
+        self.load_const(code)  # code
+        self.load_const(code.name)  # code, name
+        self.append_op(PyOpCode.MAKE_FUNCTION, 0)  # function
+        self.store_name(name)  #
 
     def terminate(self):
+        handler = self._output_handler
+        if handler is not None:
+            self.append_op(PyOpCode.POP_BLOCK)
+        if self.buffered_io:
+            self.flush_output(flush_stream=True)
         self.load_const(None)  # None
         self.append_op(PyOpCode.RETURN_VALUE)  #
+        if handler is not None:
+            self.mark_label(handler)  # exception
+            self.flush_output(flush_stream=True)  # exception
+            self.append_op(PyOpCode.RERAISE, 0)  #
 
     def print_pointer(self):
         self.load_name("print")  # print()
@@ -415,8 +1041,9 @@ class Context:
         self.pop_top()  #
 
     def print_ops(self):
-        max_len = max(len(op.op.name) for op in self.ops)
-        for idx, op in enumerate(self.ops):
+        ops = self.ops
+        max_len = max(len(op.op.name) for op in ops)
+        for idx, op in enumerate(ops):
             possible_values = [
                 self.names[op.value] if len(self.names) > op.value else None,
                 self.constants[op.value] if len(self.constants) > op.value else None,
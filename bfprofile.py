@@ -0,0 +1,276 @@
+"""Profiles a compiled brainfuck program loop by loop
+
+usage: python bfprofile.py program.bf [-i INPUT] [-n TOP] [--backend B]
+
+Both backends attribute every instruction to the innermost `[` around it:
+its line is the index of the `[` among the commands of the source plus one,
+0 outside of loops (see `Context.set_line`). The program runs under
+instruction events (`sys.monitoring` on 3.12 and later, opcode events of
+`sys.settrace` before); the time between two events goes to the loop of the
+first one and every run of the first instruction of a loop body counts as an
+iteration. Times include the tracing overhead, which grows with the number of
+instructions, so they only compare loops with each other.
+"""
+import argparse
+import dis
+import io
+import re
+import sys
+import time
+import types
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from pyfuck import (
+    BACKENDS,
+    NOT_COMMANDS,
+    CompileOptions,
+    compile_to_code,
+    program_namespace,
+)
+
+JUMPS = frozenset(dis.hasjrel) | frozenset(dis.hasjabs)
+COMMAND = re.compile(rb"[-+<>.,\[\]]")
+SNIPPET_WIDTH = 40
+
+parser = argparse.ArgumentParser(description="PyFuck loop profiler")
+parser.add_argument("file", help="brainfuck file")
+parser.add_argument("-i", "--input", help="file fed to the program as stdin")
+parser.add_argument("-o", "--output", help="file receiving the program output")
+parser.add_argument("-n", "--top", type=int, default=10, help="loops to report")
+parser.add_argument("--backend", choices=BACKENDS, default="bytecode")
+
+
+@dataclass
+class LoopStats:
+    """Profile of the loop whose `[` is command number `position`"""
+
+    position: int
+    iterations: int = 0
+    # time spent in the loop's own instructions
+    self_time: float = 0.0
+    # self time plus the one of every loop nested in it
+    total_time: float = 0.0
+
+
+def code_lines(code: types.CodeType) -> dict[int, int]:
+    """bytecode offset -> line, for every instruction of `code`"""
+    lines = {}
+    for start, end, line in code.co_lines():
+        for offset in range(start, end, 2):
+            lines[offset] = line or 0
+    return lines
+
+
+def loop_heads(code: types.CodeType, lines: dict[int, int]) -> dict[int, int]:
+    """Offset of the first instruction of every loop body -> line of the loop
+
+    The body starts where the last backward jump on the loop's line goes:
+    scans folded into the body jump back too, but always before the `]`.
+    """
+    heads: dict[int, int] = {}
+    for instruction in dis.get_instructions(code):
+        if instruction.opcode not in JUMPS:
+            continue
+        line = lines.get(instruction.offset, 0)
+        if line and instruction.argval < instruction.offset:
+            heads[line] = instruction.argval
+    return {offset: line for line, offset in heads.items()}
+
+
+class Profiler:
+    """Collects per line times and loop iterations of the code objects
+    registered with `register`"""
+
+    def __init__(self):
+        self.times: dict[int, float] = {}
+        self.iterations: dict[int, int] = {}
+        # code object -> (offset -> line, loop head offset -> line)
+        self.codes: dict[types.CodeType, tuple[dict, dict]] = {}
+        self.line = 0
+        self.last = 0.0
+
+    def register(self, code: types.CodeType):
+        """Traces `code` and the code objects nested in it"""
+        lines = code_lines(code)
+        self.codes[code] = (lines, loop_heads(code, lines))
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                self.register(const)
+
+    def record(self, code: types.CodeType, offset: int):
+        """Called before every instruction of the registered code objects"""
+        now = time.perf_counter()
+        self.times[self.line] = self.times.get(self.line, 0.0) + now - self.last
+        lines, heads = self.codes[code]
+        self.line = lines.get(offset, 0)
+        head = heads.get(offset)
+        if head is not None:
+            self.iterations[head] = self.iterations.get(head, 0) + 1
+        self.last = time.perf_counter()
+
+    def trace(self, frame: types.FrameType, event: str, arg):
+        if frame.f_code not in self.codes:
+            return None
+        frame.f_trace_lines = False
+        frame.f_trace_opcodes = True
+        return self.trace_opcode
+
+    def trace_opcode(self, frame: types.FrameType, event: str, arg):
+        if event == "opcode":
+            self.record(frame.f_code, frame.f_lasti)
+        return self.trace_opcode
+
+    def run(self, code: types.CodeType, namespace: dict):
+        """Executes `code` with every instruction going through `record`
+
+        3.12 and later use `sys.monitoring` instruction events on the
+        registered code objects only, older versions `sys.settrace`.
+        """
+        self.register(code)
+        self.line = 0
+        self.last = time.perf_counter()
+        try:
+            if hasattr(sys, "monitoring"):
+                self._run_monitored(code, namespace)
+            else:
+                sys.settrace(self.trace)
+                try:
+                    exec(code, namespace)
+                finally:
+                    sys.settrace(None)
+        finally:
+            self.record_end()
+
+    def _run_monitored(self, code: types.CodeType, namespace: dict):
+        monitoring = sys.monitoring
+        tool = monitoring.PROFILER_ID
+        instruction = monitoring.events.INSTRUCTION
+        monitoring.use_tool_id(tool, "pyfuck")
+        try:
+            monitoring.register_callback(tool, instruction, self.record)
+            for traced in self.codes:
+                monitoring.set_local_events(tool, traced, instruction)
+            exec(code, namespace)
+        finally:
+            for traced in self.codes:
+                monitoring.set_local_events(tool, traced, 0)
+            monitoring.register_callback(tool, instruction, None)
+            monitoring.free_tool_id(tool)
+
+    def record_end(self):
+        now = time.perf_counter()
+        self.times[self.line] = self.times.get(self.line, 0.0) + now - self.last
+        self.last = now
+
+
+def loop_parents(commands: bytes) -> dict[int, Optional[int]]:
+    """Position of every `[` -> position of the `[` enclosing it"""
+    parents: dict[int, Optional[int]] = {}
+    stack: list[int] = []
+    for match in re.finditer(rb"[\[\]]", commands):
+        if match.group() == b"[":
+            parents[match.start()] = stack[-1] if stack else None
+            stack.append(match.start())
+        elif stack:
+            stack.pop()
+    return parents
+
+
+def collect(profiler: Profiler, commands: bytes) -> list[LoopStats]:
+    """Stats of every loop that ran, hottest (by total time) first"""
+    parents = loop_parents(commands)
+    stats = {
+        position: LoopStats(position)
+        for position in parents
+        if position + 1 in profiler.times or position + 1 in profiler.iterations
+    }
+    for position, loop in stats.items():
+        loop.iterations = profiler.iterations.get(position + 1, 0)
+        loop.self_time = loop.total_time = profiler.times.get(position + 1, 0.0)
+    # nested loops come after the loops around them
+    for position in sorted(parents, reverse=True):
+        loop = stats.get(position)
+        parent = parents[position]
+        if loop is not None and parent is not None:
+            stats.setdefault(parent, LoopStats(parent)).total_time += loop.total_time
+    return sorted(stats.values(), key=lambda loop: loop.total_time, reverse=True)
+
+
+def profile(
+    source: Union[str, bytes],
+    stdin: bytes = b"",
+    options: Optional[CompileOptions] = None,
+) -> tuple[bytes, list[LoopStats]]:
+    """Runs a brainfuck program under the profiler
+
+    Returns:
+        tuple[bytes, list[LoopStats]]: the program output and the stats of
+            every loop that ran, hottest first
+    """
+    if isinstance(source, str):
+        source = source.encode()
+    code = compile_to_code(source, options, cache=None)
+    stdout = io.BytesIO()
+    profiler = Profiler()
+    profiler.run(code, program_namespace(io.BytesIO(stdin), stdout))
+    return stdout.getvalue(), collect(profiler, source.translate(None, NOT_COMMANDS))
+
+
+def locate(source: bytes, positions: list[int]) -> dict[int, tuple[int, int]]:
+    """Command position -> (line, column) in `source`, both from 1"""
+    wanted = set(positions)
+    found = {}
+    last = max(positions, default=-1)
+    for index, match in enumerate(COMMAND.finditer(source)):
+        if index in wanted:
+            start = match.start()
+            line_start = source.rfind(b"\n", 0, start) + 1
+            found[index] = (source.count(b"\n", 0, start) + 1, start - line_start + 1)
+        if index >= last:
+            break
+    return found
+
+
+def snippet(commands: bytes, position: int) -> str:
+    """The loop starting at `position`, cut to SNIPPET_WIDTH characters"""
+    depth = 0
+    end = position
+    for end in range(position, min(len(commands), position + SNIPPET_WIDTH)):
+        depth += {91: 1, 93: -1}.get(commands[end], 0)
+        if depth == 0:
+            return commands[position : end + 1].decode()
+    return commands[position : end + 1].decode() + "..."
+
+
+def report(source: bytes, loops: list[LoopStats], top: int = 10):
+    commands = source.translate(None, NOT_COMMANDS)
+    loops = loops[:top]
+    places = locate(source, [loop.position for loop in loops])
+    print(f"{'loop':<12}{'iterations':>12}{'self':>10}{'total':>10}  source")
+    for loop in loops:
+        line, column = places[loop.position]
+        print(
+            f"{f'{line}:{column}':<12}{loop.iterations:>12}"
+            f"{loop.self_time:>9.3f}s{loop.total_time:>9.3f}s  "
+            f"{snippet(commands, loop.position)}"
+        )
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.file, "rb") as f:
+        source = f.read()
+    stdin = b""
+    if args.input is not None:
+        with open(args.input, "rb") as f:
+            stdin = f.read()
+    output, loops = profile(source, stdin, CompileOptions(backend=args.backend))
+    if args.output is not None:
+        with open(args.output, "wb") as f:
+            f.write(output)
+    report(source, loops, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Drives resumable programs, the ones compiled with
+`CompileOptions(resumable=True)`
+
+usage: python bfsession.py program.bf [--host HOST] [--port PORT]
+
+serves the program over TCP, one session per connection.
+
+A resumable program is a module defining the generator function `main`. A
+session, started by calling it, yields:
+
+    bytes   output; resume it with `send(None)`
+    None    it has used up its input; send the next chunk, an empty one (or
+            None) at the end of input
+
+It never touches `sys.stdin` or `sys.stdout`, so any number of sessions can
+be interleaved in one thread. A session only hands control back when it
+does I/O: under `serve`, a long computation between two reads or writes
+still holds the event loop.
+"""
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import types
+from typing import Callable, Generator, Optional, Union
+
+from bfops import INPUT_CHUNK_SIZE
+from pyfuck import BACKENDS, CompileOptions, compile_to_code
+
+Session = Generator[Optional[bytes], Optional[bytes], None]
+
+parser = argparse.ArgumentParser(description="PyFuck session server")
+parser.add_argument("file", help="brainfuck file")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--backend", choices=BACKENDS, default="bytecode")
+
+
+def load(
+    source: Union[str, bytes, types.CodeType],
+    options: Optional[CompileOptions] = None,
+) -> Callable[[], Session]:
+    """`main` of a resumable program
+
+    Args:
+        source (Union[str, bytes, types.CodeType]): brainfuck source code,
+            compiled with `options` made resumable (which needs fast locals),
+            or a resumable code object
+        options (Optional[CompileOptions]): defaults to `CompileOptions()`
+    """
+    if isinstance(source, types.CodeType):
+        code = source
+    else:
+        options = dataclasses.replace(
+            options or CompileOptions(), resumable=True, fast_locals=True
+        )
+        code = compile_to_code(source, options)
+    namespace = {"__name__": "__brainfuck__"}
+    exec(code, namespace)
+    return namespace["main"]
+
+
+def run(program: Callable[[], Session], stdin: bytes = b"") -> bytes:
+    """Runs a session to the end on input known upfront, returns its output"""
+    output = bytearray()
+    session = program()
+    chunk = None
+    position = 0
+    while True:
+        try:
+            request = session.send(chunk)
+        except StopIteration:
+            return bytes(output)
+        chunk = None
+        if request is None:
+            chunk = stdin[position : position + INPUT_CHUNK_SIZE]
+            position += len(chunk)
+        else:
+            output += request
+
+
+async def serve(
+    program: Callable[[], Session],
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    """Runs a session reading from `reader` and writing to `writer`, closes
+    `writer` at the end"""
+    session = program()
+    chunk = None
+    try:
+        while True:
+            try:
+                request = session.send(chunk)
+            except StopIteration:
+                break
+            chunk = None
+            if request is None:
+                chunk = await reader.read(INPUT_CHUNK_SIZE)
+            else:
+                writer.write(request)
+                await writer.drain()
+    finally:
+        session.close()
+        writer.close()
+        with contextlib.suppress(ConnectionError):
+            await writer.wait_closed()
+
+
+async def serve_tcp(program: Callable[[], Session], host: str, port: int):
+    """Serves a session of `program` to every TCP connection"""
+    server = await asyncio.start_server(
+        lambda reader, writer: serve(program, reader, writer), host, port
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.file, "rb") as f:
+        source = f.read()
+    program = load(source, CompileOptions(backend=args.backend))
+    asyncio.run(serve_tcp(program, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,226 +1,375 @@
-from modulefinder import LOAD_CONST
 import struct
-from typing import BinaryIO, Sequence, Union
+from typing import BinaryIO, Optional, Sequence, Union
 
+from assembler import assemble, exception_table, line_table, lower, resolve_jumps
 from bfops import Context, OpCode
+from targets import TARGET_310, Target
 
 REF_FLAG = 0x80
-REFLIST = []
 
+MAGIC_PY = TARGET_310.magic
+HASH_BASED = 0b01
+CHECK_SOURCE = 0b10
 
-def module_header(f: BinaryIO):
+
+def module_header(
+    f: BinaryIO,
+    source_hash: Optional[bytes] = None,
+    magic: bytes = MAGIC_PY,
+    mtime: int = 0,
+    size: int = 0,
+):
     """
     reference: https://www.python.org/dev/peps/pep-0552/#specification
+
+    with a `source_hash` the hash based layout is used, otherwise the
+    timestamp based one with the `mtime` and `size` of the source (both can
+    be zeroed)
     """
-    MAGIC_PY = b"\x6f\x0d\x0d\x0a"
+    if source_hash is not None:
+        fields = [magic, HASH_BASED | CHECK_SOURCE, source_hash]
+        f.write(struct.pack("<4sL8s", *fields))
+        return
     BIT_FIELD = 0
-    TIMESTAMP = 0  # can be zeroed
-    SIZE = 0  # can be zeroed
-    fields = [MAGIC_PY, BIT_FIELD, TIMESTAMP, SIZE]  # 0 for padding
+    fields = [magic, BIT_FIELD, mtime & 0xFFFFFFFF, size & 0xFFFFFFFF]
     f.write(struct.pack("<4sLLL", *fields))
 
 
-def code_header(f: BinaryIO) -> int:
-    """
-    reference code from https://github.com/python/cpython/blob/3.10/Python/marshal.c#L509
-    ```c
-    W_TYPE      TYPE_CODE
-    w_long      co_argcount
-    w_long      co_posonlyargcount
-    w_long      co_kwonlyargcount
-    w_long      co_nlocals
-    w_long      co_stacksize
-    w_long      co_flags
-    w_object    co_code
-    w_object    co_consts
-    w_object    co_names
-    w_object    co_varnames
-    w_object    co_freevars
-    w_object    co_cellvars
-    w_object    co_filename
-    w_object    co_name
-    w_long      co_firstlineno
-    w_object    co_linetable
-    ```
-    """
-
-    CODE_OBJECT_TYPE = 0x63 | REF_FLAG
-
-    fields = [
-        CODE_OBJECT_TYPE,
-        0,  # co_argcount
-        0,  # co_posonlyargcount
-        0,  # co_kwonlyargcount
-        0,  # co_nlocals
-        4,  # co_stacksize
-        64,  # co_flags
-    ]
-    f.write(struct.pack("<BLLLLLL", *fields))
-    REFLIST.append(CODE_OBJECT_TYPE)
-    return len(REFLIST) - 1  # return reflist index
-
-
-def write_bytes(f: BinaryIO, b: bytes):
-    """
-    ╥
-    ╠═ W_TYPE(TYPE_STRING, p);
-    ╠═ w_pstring(PyBytes_AS_STRING(v), PyBytes_GET_SIZE(v), p)
-    ╠─── W_SIZE(PyBytes_GET_SIZE(v), p);
-    ╠─── w_string(PyBytes_AS_STRING(v), PyBytes_GET_SIZE(v), p);
-    ╨
-    """
-    TYPE_STRING = 0x73
-    SIZE = len(b)
-    static_fields = [TYPE_STRING, SIZE]
-    f.write(struct.pack("<BL", *static_fields))
-    f.write(b)
-
-
-def write_code(f: BinaryIO, ops: Sequence[OpCode]):
-    byte_list = [op.as_byte() for op in ops]
-    write_bytes(f, b"".join(byte_list))
-
-
-def write_none(f: BinaryIO):
-    TYPE_NONE = b"N"  # 0x4e
-    f.write(TYPE_NONE)
-
-
-def write_false(f: BinaryIO):
-    TYPE_FALSE = b"F"
-    f.write(TYPE_FALSE)
-
+def read_header(
+    header: bytes, magic: bytes = MAGIC_PY
+) -> Union[bytes, tuple[int, int], None]:
+    """Parses the 16 byte header written by `module_header`
 
-def write_true(f: BinaryIO):
-    TYPE_TRUE = b"T"
-    f.write(TYPE_TRUE)
-
-
-def write_bool(f: BinaryIO, value: bool):
-    if value:
-        write_true(f)
-    else:
-        write_false(f)
-
-
-def write_long(f: BinaryIO, value: int):
-    """
-    ╥
-    ╠═ W_TYPE TYPE_INT
-    ╠═ w_long value
-    ╨
+    Returns:
+        Union[bytes, tuple[int, int], None]: the source hash of a hash based
+            header, (mtime, size) of a timestamp based one, None if the
+            header is truncated or for another magic
     """
-    TYPE_LONG = 0x69
-    statis_fields = [TYPE_LONG, value]
-    f.write(struct.pack("<BL", *statis_fields))
-
-
-def write_short_interned_string(f: BinaryIO, string: str) -> int:
-    if len(string) > 255:
-        raise ValueError("too long string")
-    TYPE_SHORT_ASCII_INTERNED = 0x5A | REF_FLAG
-    SIZE = len(string)
-    static_fields = [TYPE_SHORT_ASCII_INTERNED, SIZE]
-    f.write(struct.pack("<BB", *static_fields))
-    f.write(string.encode())
-
-    REFLIST.append(TYPE_SHORT_ASCII_INTERNED)
-    return len(REFLIST) - 1  # return reflist index
-
-
-def write_short_string(f: BinaryIO, string: str) -> int:
-    if len(string) > 255:
-        raise ValueError("too long string")
-    TYPE_SHORT_ASCII = 0x7A | REF_FLAG
-    SIZE = len(string)
-    static_fields = [TYPE_SHORT_ASCII, SIZE]
-    f.write(struct.pack("<BB", *static_fields))
-    f.write(string.encode())
-    REFLIST.append(TYPE_SHORT_ASCII)
-    return len(REFLIST) - 1  # return reflist index
-
+    if len(header) < 16:
+        return None
+    found, bit_field = struct.unpack("<4sL", header[:8])
+    if found != magic:
+        return None
+    if bit_field & HASH_BASED:
+        return header[8:16]
+    return struct.unpack("<LL", header[8:16])
+
+
+def read_source_hash(path: str, magic: bytes = MAGIC_PY) -> Optional[bytes]:
+    """Returns the source hash of a hash based .pyc written for this magic,
+    None if the file is missing or not hash based"""
+    try:
+        with open(path, "rb") as f:
+            header = read_header(f.read(16), magic)
+    except OSError:
+        return None
+    return header if isinstance(header, bytes) else None
+
+
+CO_OPTIMIZED = 0x01
+CO_NEWLOCALS = 0x02
+CO_GENERATOR = 0x20
+CO_FAST_LOCAL = 0x20
+
+TYPE_NONE = 0x4E  # N
+TYPE_FALSE = 0x46  # F
+TYPE_TRUE = 0x54  # T
+TYPE_INT = 0x69  # i
+TYPE_LONG = 0x6C  # l
+TYPE_STRING = 0x73  # s, bytes
+TYPE_ASCII = 0x61  # a
+TYPE_ASCII_INTERNED = 0x41  # A
+TYPE_SHORT_ASCII = 0x7A  # z
+TYPE_SHORT_ASCII_INTERNED = 0x5A  # Z
+TYPE_UNICODE = 0x75  # u
+TYPE_TUPLE = 0x28  # (
+TYPE_SMALL_TUPLE = 0x29  # )
+TYPE_CODE = 0x63  # c
+TYPE_REF = 0x72  # r
 
 SIMPLE_TYPE = Union[int, str, bytes, bool, None]
 
 
-def write_simple_tuple(f: BinaryIO, elements: Sequence[SIMPLE_TYPE], flag=0x00) -> int:
-    """
-    ╥
-    ╠═  W_TYPE TYPE_SMALL_TUPLE
-    ╠═  w_byte PyTuple_GET_SIZE(v)
-    for i in range(PyTuple_GET_SIZE(v)):
-    ╠═  w_object v[i]
-    ╨
-    """
-    if len(elements) > 255:
-        raise ValueError("too many consts")
-
-    TYPE_SMALL_TUPLE = 0x29 | flag
-    SIZE = len(elements)
-    static_fields = [TYPE_SMALL_TUPLE, SIZE]
-    f.write(struct.pack("<BB", *static_fields))
-    for element in elements:
-        if isinstance(element, int):
-            write_long(f, element)
-        elif isinstance(element, bytes):
-            write_bytes(f, element)
-        elif isinstance(element, str):
-            write_short_interned_string(f, element)
-        elif isinstance(element, bool):
-            write_bool(f, element)
-        elif element == None:
-            write_none(f)
-        else:
-            raise ValueError("unsupported type")
-    if flag == 0:
-        return -1
-    REFLIST.append(TYPE_SMALL_TUPLE)
-    return len(REFLIST) - 1  # return reflist index
+class MarshalWriter:
+    """Writes code objects to `f` in the marshal format
 
-
-def write_ref(f: BinaryIO, ref: int):
-    """
-    ╥
-    ╠═ W_TYPE TYPE_REF
-    ╠═ w_long ref
-    ╨
+    Strings, bytes and tuples of them are written once; their later
+    occurrences become TYPE_REF back-references. `marshal.loads` numbers the
+    objects carrying REF_FLAG in the order it meets them, so the writer
+    counts them the same way and its table only holds for the file it
+    writes: use a writer per file, and per thread when compiling
+    concurrently. Every code object gets `filename` as its co_filename.
     """
-    TYPE_REF = 0x72
-    static_fields = [TYPE_REF, ref]
-    f.write(struct.pack("<BL", *static_fields))
 
-
-def write_consts(f: BinaryIO, consts: Sequence[SIMPLE_TYPE]):
-    write_simple_tuple(f, consts)
-
-
-def write_names(f: BinaryIO, names: Sequence[SIMPLE_TYPE]):
-    write_simple_tuple(f, names)
-
-
-def write_tail(f: BinaryIO):
-    """
-    w_object    co_varnames
-    w_object    co_freevars
-    w_object    co_cellvars
-    w_object    co_filename
-    w_object    co_name
-    w_long      co_firstlineno
-    w_object    co_linetable
-    """
-    write_simple_tuple(f, [])
-    write_simple_tuple(f, [])
-    write_simple_tuple(f, [])
-    write_short_string(f, ".\\1line.py")
-    write_short_interned_string(f, "<module>")
-    f.write(struct.pack("<l", -1))
-    write_bytes(f, b"")
-
-
-def compile_context(file: BinaryIO, ctx: Context):
-    module_header(file)
-    code_header(file)
-    write_code(file, ctx.ops)
-    write_consts(file, ctx.constants)
-    write_names(file, ctx.names)
-    write_tail(file)
+    def __init__(
+        self, f: BinaryIO, target: Target = TARGET_310, filename: str = "<brainfuck>"
+    ):
+        self.f = f
+        self.target = target
+        self.filename = filename
+        # (type, value) of the objects written so far -> their ref index
+        self.refs: dict[tuple, int] = {}
+        self.ref_count = 0
+
+    def _reserve_ref(self, key: Optional[tuple] = None) -> int:
+        """Index of the next object written with REF_FLAG"""
+        index = self.ref_count
+        self.ref_count += 1
+        if key is not None:
+            self.refs[key] = index
+        return index
+
+    def _write_known(self, key: tuple) -> bool:
+        """Writes a back-reference if the object was already written"""
+        index = self.refs.get(key)
+        if index is None:
+            return False
+        self.write_ref(index)
+        return True
+
+    def write_ref(self, ref: int):
+        """
+        ╥
+        ╠═ W_TYPE TYPE_REF
+        ╠═ w_long ref
+        ╨
+        """
+        self.f.write(struct.pack("<BL", TYPE_REF, ref))
+
+    def write_object(self, value: Union[SIMPLE_TYPE, tuple, Context]):
+        if value is None:
+            self.f.write(bytes([TYPE_NONE]))
+        elif isinstance(value, bool):
+            self.f.write(bytes([TYPE_TRUE if value else TYPE_FALSE]))
+        elif isinstance(value, int):
+            self.write_long(value)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self.write_bytes(value)
+        elif isinstance(value, str):
+            self.write_string(value)
+        elif isinstance(value, (tuple, list)):
+            self.write_tuple(value)
+        elif isinstance(value, Context):
+            self.write_code_object(value)
+        else:
+            raise ValueError(f"unsupported type {type(value).__name__}")
+
+    def write_long(self, value: int):
+        """
+        ╥
+        ╠═ W_TYPE TYPE_INT
+        ╠═ w_long value
+        ╨
+        values that don't fit in 32 bits are written as TYPE_LONG, see
+        `write_big_long`
+        """
+        if not -(2**31) <= value < 2**31:
+            self.write_big_long(value)
+            return
+        self.f.write(struct.pack("<Bl", TYPE_INT, value))
+
+    def write_big_long(self, value: int):
+        """
+        ╥
+        ╠═ W_TYPE TYPE_LONG
+        ╠═ w_long number of 15 bit digits, negative for negative values
+        for digit in digits:
+        ╠═ w_short digit
+        ╨
+        """
+        digits = []
+        magnitude = abs(value)
+        while magnitude:
+            digits.append(magnitude & 0x7FFF)
+            magnitude >>= 15
+        size = -len(digits) if value < 0 else len(digits)
+        self.f.write(struct.pack(f"<Bl{len(digits)}H", TYPE_LONG, size, *digits))
+
+    def write_bytes(self, b: Union[bytes, bytearray, memoryview]):
+        """
+        ╥
+        ╠═ W_TYPE(TYPE_STRING, p);
+        ╠═ w_pstring(PyBytes_AS_STRING(v), PyBytes_GET_SIZE(v), p)
+        ╠─── W_SIZE(PyBytes_GET_SIZE(v), p);
+        ╠─── w_string(PyBytes_AS_STRING(v), PyBytes_GET_SIZE(v), p);
+        ╨
+        only bytes objects are shared, buffers like the assembled co_code are
+        written without REF_FLAG instead of being copied into a key
+        """
+        if not isinstance(b, bytes):
+            self.f.write(struct.pack("<BL", TYPE_STRING, len(b)))
+            self.f.write(b)
+            return
+        key = (bytes, b)
+        if self._write_known(key):
+            return
+        self._reserve_ref(key)
+        self.f.write(struct.pack("<BL", TYPE_STRING | REF_FLAG, len(b)))
+        self.f.write(b)
+
+    def write_string(self, string: str, interned: bool = True):
+        """
+        ╥
+        ╠═ W_TYPE TYPE_SHORT_ASCII(_INTERNED)   up to 255 ascii characters
+        ╠═ w_byte size
+        ╠═ w_string characters
+        ╨
+        longer ascii strings use TYPE_ASCII(_INTERNED) and others TYPE_UNICODE
+        (utf-8), both with a w_long size
+        """
+        key = (str, string)
+        if self._write_known(key):
+            return
+        data = string.encode("utf-8")
+        if not string.isascii():
+            kind, layout = TYPE_UNICODE, "<BL"
+        elif len(data) > 255:
+            kind = TYPE_ASCII_INTERNED if interned else TYPE_ASCII
+            layout = "<BL"
+        else:
+            kind = TYPE_SHORT_ASCII_INTERNED if interned else TYPE_SHORT_ASCII
+            layout = "<BB"
+        self._reserve_ref(key)
+        self.f.write(struct.pack(layout, kind | REF_FLAG, len(data)))
+        self.f.write(data)
+
+    def write_tuple(self, elements: Sequence[Union[SIMPLE_TYPE, Context]]):
+        """
+        ╥
+        ╠═  W_TYPE TYPE_SMALL_TUPLE
+        ╠═  w_byte PyTuple_GET_SIZE(v)
+        for i in range(PyTuple_GET_SIZE(v)):
+        ╠═  w_object v[i]
+        ╨
+        tuples of more than 255 elements are TYPE_TUPLE with a w_long size.
+        Only tuples of simple values are shared, not those holding code.
+        """
+        key = None
+        if not any(isinstance(element, Context) for element in elements):
+            key = (tuple, tuple((type(element), element) for element in elements))
+            if self._write_known(key):
+                return
+            self._reserve_ref(key)
+        flag = 0 if key is None else REF_FLAG
+        if len(elements) > 255:
+            self.f.write(struct.pack("<BL", TYPE_TUPLE | flag, len(elements)))
+        else:
+            self.f.write(struct.pack("<BB", TYPE_SMALL_TUPLE | flag, len(elements)))
+        for element in elements:
+            self.write_object(element)
+
+    def code_header(self, stacksize: int = 4, nlocals: int = 0, flags: int = 0) -> int:
+        """
+        reference code from https://github.com/python/cpython/blob/3.10/Python/marshal.c#L509
+        ```c
+        W_TYPE      TYPE_CODE
+        w_long      co_argcount
+        w_long      co_posonlyargcount
+        w_long      co_kwonlyargcount
+        w_long      co_nlocals          (3.10 only)
+        w_long      co_stacksize
+        w_long      co_flags
+        ```
+        the remaining fields are listed in `target.code_fields`
+
+        Returns:
+            int: ref index of the code object
+        """
+        target = self.target
+        values = {
+            "argcount": 0,
+            "posonlyargcount": 0,
+            "kwonlyargcount": 0,
+            "nlocals": nlocals,
+            "stacksize": stacksize,
+            "flags": flags | target.code_flags,
+        }
+        fields = target.code_fields[: target.code_fields.index("code")]
+        layout = f"<B{len(fields)}L"
+        self.f.write(
+            struct.pack(layout, TYPE_CODE | REF_FLAG, *map(values.get, fields))
+        )
+        # the code object is numbered before the objects inside it
+        return self._reserve_ref()
+
+    def write_tail(
+        self,
+        varnames: Sequence[str] = (),
+        name: str = "<module>",
+        linetable: bytes = b"",
+        exceptiontable: bytes = b"",
+    ):
+        """
+        3.10                    3.11+
+        w_object co_varnames    w_object co_localsplusnames
+        w_object co_freevars    w_object co_localspluskinds
+        w_object co_cellvars    w_object co_filename
+        w_object co_filename    w_object co_name
+        w_object co_name        w_object co_qualname
+        w_long co_firstlineno   w_long co_firstlineno
+        w_object co_linetable   w_object co_linetable
+                                w_object co_exceptiontable
+        """
+        fields = self.target.code_fields[self.target.code_fields.index("names") + 1 :]
+        for field in fields:
+            if field in ("varnames", "localsplusnames"):
+                self.write_tuple(varnames)
+            elif field in ("freevars", "cellvars"):
+                self.write_tuple(())
+            elif field == "localspluskinds":
+                self.write_bytes(bytes([CO_FAST_LOCAL]) * len(varnames))
+            elif field == "filename":
+                self.write_string(self.filename, interned=False)
+            elif field in ("name", "qualname"):
+                self.write_string(name)
+            elif field == "firstlineno":
+                self.f.write(struct.pack("<l", 0))
+            elif field == "linetable":
+                self.write_bytes(linetable)
+            elif field == "exceptiontable":
+                self.write_bytes(exceptiontable)
+            else:
+                raise ValueError(f"unknown code object field {field}")
+
+    def write_code_object(self, ctx: Context):
+        target = self.target
+        flags = 0
+        if ctx.fast_locals:
+            flags |= CO_OPTIMIZED | CO_NEWLOCALS
+        if ctx.resumable:
+            flags |= CO_GENERATOR
+        stream = lower(ctx, target)
+        self.code_header(stream.stacksize, len(ctx.varnames), flags)
+        sizes = resolve_jumps(stream, target)
+        self.write_bytes(assemble(stream, target, sizes))
+        self.write_tuple(ctx.constants)
+        self.write_tuple(ctx.names)
+        self.write_tail(
+            ctx.varnames,
+            ctx.name,
+            line_table(stream, sizes, target),
+            exception_table(stream, sizes),
+        )
+
+
+def write_code_object(
+    f: BinaryIO,
+    ctx: Context,
+    target: Target = TARGET_310,
+    filename: str = "<brainfuck>",
+):
+    """Writes `ctx` as a marshalled code object with a writer of its own"""
+    MarshalWriter(f, target, filename).write_code_object(ctx)
+
+
+def compile_context(
+    file: BinaryIO,
+    ctx: Context,
+    source_hash: Optional[bytes] = None,
+    target: Target = TARGET_310,
+    mtime: int = 0,
+    size: int = 0,
+    filename: str = "<brainfuck>",
+):
+    module_header(file, source_hash, target.magic, mtime, size)
+    write_code_object(file, ctx, target, filename)
@@ -0,0 +1,131 @@
+"""Reference brainfuck interpreter, the baseline the compiler is checked and
+measured against
+
+It runs the run-length encoded tokens of `pyfuck.tokenize` with no other
+optimization, so its behaviour is easy to trust: cells wrap around, a cell
+off the tape may not be accessed (unless the tape grows) and reading past the
+end of input stores 0, like the compiled programs. The pointer itself may
+pass the ends of the tape, as the compiled programs fold moves into the
+offsets of the accesses and only check those.
+"""
+from typing import IO, Iterable, Optional, Union
+
+from bfops import TAPE_END_ERROR, TAPE_START_ERROR, Tape
+from pyfuck import open_source, tokenize
+from pysource import StepLimitExceeded
+
+# opcodes of the interpreter, in the order they are tested in the main loop
+ADD, MOVE, LOOP, END, OUTPUT, INPUT = range(6)
+OPCODES = {"+": ADD, "-": ADD, ">": MOVE, "<": MOVE, "[": LOOP, "]": END}
+OPCODES.update({".": OUTPUT, ",": INPUT})
+
+
+def load(tokens: Iterable[tuple[str, int]]) -> tuple[list[int], list[int]]:
+    """Turns run-length encoded commands into the interpreter program
+
+    Brackets are split into one instruction each and their argument is the
+    index of the matching one, so loops never search for their other end.
+
+    Raises:
+        ValueError: if the brackets are unbalanced
+
+    Returns:
+        tuple[list[int], list[int]]: opcodes and their arguments
+    """
+    ops: list[int] = []
+    args: list[int] = []
+    stack: list[int] = []
+    for char, count in tokens:
+        op = OPCODES[char]
+        if op == LOOP:
+            for _ in range(count):
+                stack.append(len(ops))
+                ops.append(LOOP)
+                args.append(-1)
+        elif op == END:
+            for _ in range(count):
+                if not stack:
+                    raise ValueError("unmatched ']'")
+                start = stack.pop()
+                args[start] = len(ops)
+                ops.append(END)
+                args.append(start)
+        else:
+            ops.append(op)
+            args.append(-count if char in "-<" else count)
+    if stack:
+        raise ValueError("unmatched '['")
+    return ops, args
+
+
+def run(
+    source: Union[str, bytes, IO],
+    stdin: bytes = b"",
+    tape: Tape = Tape(),
+    max_steps: Optional[int] = None,
+    output: Optional[bytearray] = None,
+) -> bytes:
+    """Runs a brainfuck program and returns its output
+
+    Args:
+        source (Union[str, bytes, IO]): brainfuck source code or a stream
+        stdin (bytes): the whole input of the program
+        tape (Tape): size, cell width and growth of the tape, the backend is
+            ignored
+        max_steps (Optional[int]): number of instructions after which
+            StepLimitExceeded is raised, unlimited if None
+        output (Optional[bytearray]): receives the output as it is written,
+            so what came before an error is kept
+
+    Raises:
+        IndexError: if a cell off the tape is accessed
+        StepLimitExceeded: if the program runs for more than `max_steps`
+
+    Returns:
+        bytes: everything the program wrote
+    """
+    ops, args = load(tokenize(open_source(source)))
+    chunk = bytearray(tape.size) if tape.cell_bits == 8 else [0] * tape.size
+    memory = chunk[:]
+    mask = tape.mask
+    grow = tape.grow
+    if output is None:
+        output = bytearray()
+    input_pos = 0
+    pointer = 0
+    pc = 0
+    end = len(ops)
+    steps = 0
+    limit = -1 if max_steps is None else max_steps
+    while pc < end:
+        op = ops[pc]
+        arg = args[pc]
+        if op == ADD:
+            memory[pointer] = (memory[pointer] + arg) & mask
+        elif op == MOVE:
+            pointer += arg
+            while grow and pointer >= len(memory):
+                memory += chunk
+            # every other instruction accesses the cell
+            if not 0 <= pointer < len(memory) and pc + 1 < end and ops[pc + 1] != MOVE:
+                raise IndexError(TAPE_START_ERROR if pointer < 0 else TAPE_END_ERROR)
+        elif op == LOOP:
+            if not memory[pointer]:
+                pc = arg
+        elif op == END:
+            if memory[pointer]:
+                pc = arg
+        elif op == OUTPUT:
+            output += bytes([memory[pointer] & 0xFF]) * arg
+        else:
+            if input_pos + arg > len(stdin):
+                memory[pointer] = 0
+            else:
+                memory[pointer] = stdin[input_pos + arg - 1]
+            input_pos = min(input_pos + arg, len(stdin))
+        pc += 1
+        steps += 1
+        if steps == limit and pc < end:
+            raise StepLimitExceeded(f"no result after {max_steps} steps")
+    return bytes(output)
+
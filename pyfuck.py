@@ -1,14 +1,173 @@
 import argparse
+import builtins
+import glob
+import hashlib
+import importlib.util
+import io
+import marshal
+import mmap
+import os
+import re
+import sys
+import threading
+import types
 from bz2 import compress
-from io import TextIOWrapper
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO, TextIOWrapper
 from itertools import pairwise
-from typing import Callable
+from stat import S_ISREG
+from typing import IO, BinaryIO, Callable, Iterable, Iterator, Optional, Union
 
-from bfops import Context, OpCode, PyOpCode
-from compile import compile_context
+import bfir
+import pysource
+from bfir import PassManager
+from bfops import Context, OpCode, PyOpCode, Tape
+from compile import (
+    compile_context,
+    module_header,
+    read_source_hash,
+    write_code_object,
+)
+from pysource import SourceWriter
+from targets import DEFAULT_TARGET, TARGETS, Target, get_target
+
+# bump whenever the generated code changes, so cached outputs are rebuilt
+CACHE_VERSION = 8
+CHUNK_SIZE = 1 << 20
+COMMANDS = b"><+-.,[]"
+NOT_COMMANDS = bytes(sorted(set(range(256)) - set(COMMANDS)))
+COMMAND_RUN = re.compile(rb"([-+<>.,\[\]])\1*")
+BACKENDS = ("bytecode", "python")
 
 parser = argparse.ArgumentParser(description="PyFuck")
-parser.add_argument("infile", type=argparse.FileType("r"))
+parser.add_argument("inputs", nargs="+", help="brainfuck files or glob patterns")
+parser.add_argument(
+    "-o",
+    "--output-dir",
+    help="directory for the compiled files, ./out.pyc is used for a single input"
+    " when omitted",
+)
+parser.add_argument(
+    "-j", "--jobs", type=int, default=None, help="number of compiler processes"
+)
+parser.add_argument(
+    "--force", action="store_true", help="recompile even if the output is cached"
+)
+parser.add_argument(
+    "--backend",
+    choices=BACKENDS,
+    default="bytecode",
+    help="hand assembled bytecode, or python source compiled by the running"
+    " interpreter",
+)
+parser.add_argument(
+    "--target",
+    choices=list(TARGETS),
+    default=DEFAULT_TARGET.name,
+    help="python version the bytecode backend emits code for, defaults to the"
+    " running one when supported",
+)
+parser.add_argument(
+    "--fast-locals",
+    action=argparse.BooleanOptionalAction,
+    default=True,
+    help="run the program inside a function so variables live in fast locals",
+)
+parser.add_argument(
+    "--propagate-constants",
+    action=argparse.BooleanOptionalAction,
+    default=True,
+    help="evaluate the start of the program, up to its first input or loop"
+    " that has to run, at compile time",
+)
+parser.add_argument(
+    "--precompute",
+    type=int,
+    metavar="STEPS",
+    help="run programs without input at compile time for up to STEPS"
+    " operations and compile the ones that finish to a write of their output",
+)
+parser.add_argument(
+    "--resumable",
+    action="store_true",
+    help="compile into a generator doing its I/O through yield, to be driven"
+    " by bfsession.py",
+)
+parser.add_argument(
+    "--safety",
+    choices=bfir.SAFETY_LEVELS,
+    default="unchecked",
+    help="bounds check every cell access, only the ones that may leave the"
+    " tape (where-needed) or none",
+)
+parser.add_argument(
+    "--tape",
+    choices=["list", "bytearray", "array"],
+    default=Tape.backend,
+    help="runtime representation of the tape",
+)
+parser.add_argument(
+    "--tape-size", type=int, default=Tape.size, help="initial number of cells"
+)
+parser.add_argument(
+    "--cell-bits", type=int, choices=[8, 16, 32], default=Tape.cell_bits
+)
+parser.add_argument(
+    "--grow-tape",
+    action="store_true",
+    help="extend the tape when the pointer runs past its end",
+)
+
+
+def read_chunks(file: IO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Reads a file in pieces of at most `chunk_size` bytes
+
+    Regular files are memory mapped instead of copied through the file
+    object's buffers. Text streams are encoded back to bytes.
+    """
+    try:
+        fileno = file.fileno()
+        stat = os.fstat(fileno)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        stat = None
+    if stat is not None and S_ISREG(stat.st_mode) and stat.st_size > 0:
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, len(mapped), chunk_size):
+                yield mapped[start : start + chunk_size]
+        return
+    while chunk := file.read(chunk_size):
+        yield chunk.encode() if isinstance(chunk, str) else chunk
+
+
+def tokenize(file: IO, chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[str, int]]:
+    """Yields runs of brainfuck commands read from `file` chunk by chunk
+
+    Comments are dropped and runs spanning chunk boundaries are joined, so
+    ">>x>" yields (">", 3) wherever the chunks are split.
+
+    Args:
+        file (IO): binary or text stream
+        chunk_size (int): number of bytes read at once
+
+    Yields:
+        tuple[str, int]: command and how many times it repeats
+    """
+    current_char, current_count = "", 0
+    for chunk in read_chunks(file, chunk_size):
+        commands = chunk.translate(None, NOT_COMMANDS)
+        for match in COMMAND_RUN.finditer(commands):
+            char = chr(commands[match.start()])
+            count = match.end() - match.start()
+            if char == current_char:
+                current_count += count
+                continue
+            if current_count:
+                yield current_char, current_count
+            current_char, current_count = char, count
+    if current_count:
+        yield current_char, current_count
 
 
 def compress_str(string: str) -> list[tuple[str, int]]:
@@ -21,55 +180,588 @@ def compress_str(string: str) -> list[tuple[str, int]]:
     Returns:
         list[tuple[str, int]]: compressed string as a list of tuples
     """
-    compressed = []
-    current_char = string[0]
-    current_count = 0
-    for char in string:
-        if char not in "><+-.,[]":
-            continue
-        if char == current_char:
-            current_count += 1
+    return list(tokenize(io.BytesIO(string.encode())))
+
+
+def emit_nodes(nodes: list[bfir.Node], ctx: Context):
+    for node in nodes:
+        if isinstance(node, bfir.Add):
+            if node.value > 0:
+                ctx.increment_cell(node.value, node.offset, node.wrap)
+            else:
+                ctx.decrement_cell(-node.value, node.offset, node.wrap)
+        elif isinstance(node, bfir.Move):
+            if node.value > 0:
+                ctx.increment_pointer(node.value)
+            else:
+                ctx.decrement_pointer(-node.value)
+        elif isinstance(node, bfir.Output):
+            ctx.stdout_print_cell(node.offset)
+        elif isinstance(node, bfir.Write):
+            ctx.stdout_write_bytes(node.data)
+        elif isinstance(node, bfir.Input):
+            ctx.stdin_get_cell(node.offset)
+        elif isinstance(node, bfir.Clear):
+            ctx.clear_cell(node.offset)
+        elif isinstance(node, bfir.MulAdd):
+            ctx.mul_add_cell(node.offset, node.factor, node.source, node.wrap)
+        elif isinstance(node, bfir.ProductAdd):
+            ctx.product_add_cell(
+                node.offset, node.factor, node.source, node.other, node.wrap
+            )
+        elif isinstance(node, bfir.Scan):
+            ctx.scan(node.step)
+        elif isinstance(node, bfir.Loop):
+            line = ctx.line
+            if node.position is not None:
+                ctx.set_line(node.position + 1)
+            ctx.push_to_jump_stack()
+            emit_nodes(node.body, ctx)
+            ctx.cond_jump_top_jump_stack()
+            ctx.set_line(line)
+        elif isinstance(node, bfir.Check):
+            ctx.check_bounds(node.low, node.high)
         else:
-            compressed.append((current_char, current_count))
-            current_char = char
-            current_count = 1
-    compressed.append((current_char, current_count))
-    return compressed
-
-
-def parse_source(string: str, ctx: Context):
-    CHAR_MAP = {
-        ">": ctx.increment_pointer,
-        "<": ctx.decrement_pointer,
-        "+": ctx.increment_cell,
-        "-": ctx.decrement_cell,
-        ".": ctx.stdout_print_cell,
-        ",": ctx.stdin_get_cell,
-        "[": ctx.push_to_jump_stack,
-        "]": ctx.cond_jump_top_jump_stack,
-    }
+            raise ValueError(f"unsupported node {node}")
+
+
+def optimize_source(
+    string: str, passes: Optional[PassManager] = None
+) -> list[bfir.Node]:
+    """Optimized IR of a whole program"""
     # join consecutive >, <, + and - to reduce the number of instructions
     compressed = compress_str(string)
-    for char, count in compressed:
-        if char in "><+-":
-            CHAR_MAP[char](count)
-        elif char in CHAR_MAP:
-            for _ in range(count):
-                CHAR_MAP[char]()
+    nodes = bfir.build(compressed)
+    return (passes or PassManager()).run(nodes)
 
 
-def main():
-    args = parser.parse_args()
-    file: TextIOWrapper = args.infile
-    source = file.read()
+def parse_source(string: str, ctx: Context, passes: Optional[PassManager] = None):
+    nodes = optimize_source(string, passes)
+    ctx.reach = max(ctx.reach, bfir.reach(nodes))
+    emit_nodes(nodes, ctx)
+
+
+@dataclass(frozen=True)
+class CompileOptions:
+    """Settings affecting the generated code
+
+    Attributes:
+        fast_locals (bool): emit the program as a nested function whose
+            variables live in fast local slots instead of the module dict
+        tape (Tape): tape configuration
+        passes (tuple[bfir.Pass, ...]): optimizations to run, in order
+        backend (str): "bytecode" assembles bytecode by hand, "python"
+            generates python source and compiles it with the running
+            interpreter (the program always runs in fast locals then)
+        target (str): python version the bytecode backend emits code for
+        propagate_constants (bool): evaluate the start of the program, up to
+            the first input or loop that has to run, at compile time, see
+            `bfir.ConstantPropagation`
+        precompute_steps (Optional[int]): run programs that read no input at
+            compile time for up to this many IR nodes; the ones finishing in
+            time compile to a single write of their output, see
+            `precompute_output`. None disables it
+        resumable (bool): compile the program into a generator function
+            `main` that yields its output and asks for input through yield
+            instead of using sys.stdin and sys.stdout, see `bfsession`;
+            the module only defines `main`. Needs fast locals
+        safety (str): one of `bfir.SAFETY_LEVELS`, which accesses raise
+            IndexError when they fall off the tape, see `bfir.RangeAnalysis`
+    """
+
+    fast_locals: bool = True
+    tape: Tape = Tape()
+    passes: tuple[bfir.Pass, ...] = tuple(bfir.DEFAULT_PASSES)
+    backend: str = "bytecode"
+    target: str = DEFAULT_TARGET.name
+    propagate_constants: bool = True
+    precompute_steps: Optional[int] = None
+    resumable: bool = False
+    safety: str = "unchecked"
+
+    def __post_init__(self):
+        if self.backend not in BACKENDS:
+            raise ValueError(f"unknown backend {self.backend}")
+        if self.resumable and not self.fast_locals and self.backend == "bytecode":
+            raise ValueError("resumable programs need fast locals")
+        if self.safety not in bfir.SAFETY_LEVELS:
+            raise ValueError(f"unknown safety level {self.safety}")
+        get_target(self.target)
+
+    @property
+    def bytecode_target(self) -> Target:
+        return get_target(self.target)
+
+    @property
+    def magic(self) -> bytes:
+        """Magic number of the .pyc files written for these options"""
+        if self.backend == "python":
+            return importlib.util.MAGIC_NUMBER
+        return self.bytecode_target.magic
+
+    def fingerprint(self) -> bytes:
+        passes = ",".join(optimization.__name__ for optimization in self.passes)
+        target = self.target if self.backend == "bytecode" else sys.version
+        return (
+            f"{CACHE_VERSION}|{self.backend}|{target}|{self.fast_locals}|"
+            f"{self.tape}|{passes}|{self.propagate_constants}|"
+            f"{self.precompute_steps}|{self.resumable}|{self.safety}"
+        ).encode()
+
+    def pass_manager(self) -> PassManager:
+        """Fresh pass manager for compiling one program"""
+        constants = None
+        if self.propagate_constants:
+            constants = bfir.ConstantPropagation(self.tape)
+        ranges = bfir.RangeAnalysis(self.tape, self.safety)
+        return PassManager(list(self.passes), constants, ranges)
+
+    @property
+    def checked(self) -> bool:
+        return self.safety != "unchecked"
+
+    def hasher(self) -> "hashlib._Hash":
+        """blake2b hasher seeded with the options, fed with the source"""
+        digest = hashlib.blake2b(self.fingerprint(), digest_size=8)
+        digest.update(b"\0")
+        return digest
+
+    def source_hash(self, source: bytes) -> bytes:
+        """8 byte key identifying the output for `source` under these options"""
+        digest = self.hasher()
+        digest.update(source)
+        return digest.digest()
+
+
+def emit_stream(
+    tokens: Iterable[tuple[str, int]],
+    ctx: Union[Context, SourceWriter],
+    passes: PassManager,
+    emit: Callable = emit_nodes,
+):
+    """Optimizes and emits the program one top level segment at a time, so
+    only the IR of the current segment is held in memory"""
+    for segment in bfir.build_segments(tokens):
+        nodes = passes.run(segment)
+        reach = bfir.reach(nodes)
+        if reach > ctx.reach:
+            # the pointer may already be close to the end of a growing tape
+            ctx.reach = reach
+            ctx.ensure_tape()
+        emit(nodes, ctx)
+
+
+def precompute_output(source: bytes, options: CompileOptions) -> Optional[bytes]:
+    """Output of a program that reads no input, found by running it with the
+    python backend for at most `options.precompute_steps` IR nodes
+
+    Returns:
+        Optional[bytes]: everything the program writes, None if it reads
+            input, runs for longer or fails
+    """
+    if options.precompute_steps is None or b"," in source:
+        return None
+    writer = SourceWriter(
+        tape=options.tape,
+        count_steps=True,
+        max_steps=options.precompute_steps,
+        checked=options.checked,
+    )
+    stdout = BytesIO()
+    try:
+        writer.init_program()
+        emit_stream(
+            tokenize(open_source(source)),
+            writer,
+            options.pass_manager(),
+            pysource.emit_nodes,
+        )
+        writer.terminate()
+        code = pysource.compile_source(writer.source)
+        exec(code, program_namespace(BytesIO(), stdout))
+    except Exception:
+        # out of steps, an error the compiled program has to raise itself, or
+        # a program the python backend can't express, like deep nesting
+        return None
+    return stdout.getvalue()
+
+
+def emit_program(
+    source: Union[str, bytes, IO],
+    ctx: Union[Context, SourceWriter],
+    options: CompileOptions,
+    emit: Callable = emit_nodes,
+):
+    """Emits the program, or only a write of its output when
+    `precompute_output` finds it"""
+    if options.precompute_steps is not None:
+        source = b"".join(read_chunks(open_source(source)))
+        output = precompute_output(source, options)
+        if output is not None:
+            emit([bfir.Write(output)], ctx)
+            return
+    emit_stream(tokenize(open_source(source)), ctx, options.pass_manager(), emit)
+
+
+def open_source(source: Union[str, bytes, IO]) -> IO:
+    if isinstance(source, str):
+        source = source.encode()
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return source
+
+
+def build_context(
+    source: Union[str, bytes, IO], options: Optional[CompileOptions] = None
+) -> Context:
+    """Compiles brainfuck source into the module level Context
+
+    Args:
+        source (Union[str, bytes, IO]): brainfuck source code, or a binary or
+            text stream to read it from incrementally
+        options (Optional[CompileOptions]): defaults to `CompileOptions()`
+
+    Returns:
+        Context: context ready to be passed to `compile_context`
+    """
+    options = options or CompileOptions()
+    fast_locals = options.fast_locals
+    name = "main" if fast_locals else "<module>"
+    program = Context(
+        fast_locals=fast_locals,
+        name=name,
+        tape=options.tape,
+        resumable=options.resumable,
+        checked=options.checked,
+    )
+    program.init_program()
+    emit_program(source, program, options)
+    program.terminate()
+    if not fast_locals:
+        return program
     ctx = Context()
-    ctx.init_program()
-    parse_source(source, ctx)
+    if options.resumable:
+        ctx.define_function(program)
+    else:
+        ctx.call_code(program)
     ctx.terminate()
-    # ctx.print_ops()
-    with open("out.pyc", "wb") as f:
-        compile_context(f, ctx)
-    print("Compilation ended. Output written to ./out.pyc")
+    return ctx
+
+
+def build_writer(
+    source: Union[str, bytes, IO],
+    options: Optional[CompileOptions] = None,
+    count_steps: bool = False,
+    max_steps: Optional[int] = None,
+) -> SourceWriter:
+    """Translates brainfuck source into python source for the python backend
+
+    Args:
+        source (Union[str, bytes, IO]): brainfuck source code, or a binary or
+            text stream to read it from incrementally
+        options (Optional[CompileOptions]): defaults to `CompileOptions()`
+        count_steps (bool): make the program count the IR nodes it executes
+            into the global `steps`, see `SourceWriter`
+        max_steps (Optional[int]): make the program raise
+            `StepLimitExceeded` after executing this many IR nodes
+
+    Returns:
+        SourceWriter: writer holding the module source, defining and calling
+            `main`, and its line mapping
+    """
+    options = options or CompileOptions()
+    writer = SourceWriter(
+        tape=options.tape,
+        count_steps=count_steps or max_steps is not None,
+        max_steps=max_steps,
+        resumable=options.resumable,
+        checked=options.checked,
+    )
+    writer.init_program()
+    emit_program(source, writer, options, pysource.emit_nodes)
+    writer.terminate()
+    return writer
+
+
+def build_source(
+    source: Union[str, bytes, IO],
+    options: Optional[CompileOptions] = None,
+    count_steps: bool = False,
+) -> str:
+    """Python source of the program, see `build_writer`"""
+    return build_writer(source, options, count_steps).source
+
+
+def compile_writer(writer: SourceWriter, filename: str = "<brainfuck>") -> types.CodeType:
+    return pysource.compile_source(writer.source, filename, writer.bf_lines)
+
+
+def build_code(
+    source: Union[str, bytes, IO],
+    options: Optional[CompileOptions] = None,
+    filename: str = "<brainfuck>",
+) -> types.CodeType:
+    """Compiles brainfuck source into a module code object with the backend
+    selected in `options`, reporting `filename` in tracebacks"""
+    options = options or CompileOptions()
+    if options.backend == "python":
+        return compile_writer(build_writer(source, options), filename)
+    buffer = BytesIO()
+    context = build_context(source, options)
+    write_code_object(buffer, context, options.bytecode_target, filename)
+    return marshal.loads(buffer.getvalue())
+
+
+class CodeCache:
+    """Thread safe LRU cache of compiled code objects keyed by source hash"""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[bytes, types.CodeType] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[types.CodeType]:
+        with self._lock:
+            code = self._entries.get(key)
+            if code is not None:
+                self._entries.move_to_end(key)
+            return code
+
+    def put(self, key: bytes, code: types.CodeType):
+        with self._lock:
+            self._entries[key] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+code_cache = CodeCache()
+
+
+def compile_to_code(
+    source: Union[str, bytes],
+    options: Optional[CompileOptions] = None,
+    cache: Optional[CodeCache] = code_cache,
+    filename: str = "<brainfuck>",
+) -> types.CodeType:
+    """Compiles brainfuck source straight into a module code object
+
+    Args:
+        source (Union[str, bytes]): brainfuck source code
+        options (Optional[CompileOptions]): defaults to `CompileOptions()`
+        cache (Optional[CodeCache]): cache to look the code object up in and
+            store it to, None disables caching
+        filename (str): co_filename of the code, the path of the source
+
+    Raises:
+        RuntimeError: if the running interpreter can't execute the bytecode
+
+    Returns:
+        types.CodeType: code object that can be passed to `exec`
+    """
+    options = options or CompileOptions()
+    if importlib.util.MAGIC_NUMBER != options.magic:
+        raise RuntimeError(
+            f"generated bytecode can't run on Python {sys.version.split()[0]}"
+        )
+    if isinstance(source, str):
+        source = source.encode()
+    # the code object carries its filename
+    key = options.source_hash(source) + filename.encode()
+    code = cache.get(key) if cache is not None else None
+    if code is not None:
+        return code
+    code = build_code(source, options, filename)
+    if cache is not None:
+        cache.put(key, code)
+    return code
+
+
+def run(
+    source: Union[str, bytes, types.CodeType],
+    stdin: Optional[BinaryIO] = None,
+    stdout: Optional[BinaryIO] = None,
+    options: Optional[CompileOptions] = None,
+):
+    """Compiles (if needed) and runs a brainfuck program in this process
+
+    The program sees `stdin` and `stdout` instead of the process streams,
+    without touching `sys`, so several programs can run in parallel threads.
+
+    Args:
+        source (Union[str, bytes, types.CodeType]): brainfuck source code or
+            the result of `compile_to_code`
+        stdin (Optional[BinaryIO]): binary stream with `read1`, defaults to
+            `sys.stdin.buffer`
+        stdout (Optional[BinaryIO]): binary stream, defaults to
+            `sys.stdout.buffer`
+        options (Optional[CompileOptions]): used when compiling `source`
+    """
+    if isinstance(source, types.CodeType):
+        code = source
+    else:
+        code = compile_to_code(source, options)
+    exec(code, program_namespace(stdin, stdout))
+
+
+def program_namespace(
+    stdin: Optional[BinaryIO] = None, stdout: Optional[BinaryIO] = None
+) -> dict:
+    """Globals for running a compiled program on the given streams, see `run`
+
+    They include `StepLimitExceeded`, raised by programs built with a
+    `max_steps` budget.
+    """
+    streams = types.SimpleNamespace(
+        stdin=types.SimpleNamespace(buffer=stdin or sys.stdin.buffer),
+        stdout=types.SimpleNamespace(buffer=stdout or sys.stdout.buffer),
+    )
+
+    def import_streams(name, *args, **kwargs):
+        if name == "sys":
+            return streams
+        return builtins.__import__(name, *args, **kwargs)
+
+    return {
+        "__name__": "__brainfuck__",
+        "__builtins__": {**builtins.__dict__, "__import__": import_streams},
+        "StepLimitExceeded": pysource.StepLimitExceeded,
+    }
+
+
+def write_pyc(
+    f: BinaryIO,
+    source: Union[str, bytes, IO],
+    options: CompileOptions,
+    source_hash: Optional[bytes] = None,
+    mtime: int = 0,
+    size: int = 0,
+    filename: str = "<brainfuck>",
+):
+    """Compiles `source` into a .pyc file written to `f`, with a hash based
+    header for a `source_hash`, a timestamp based one otherwise (see
+    `module_header`), and `filename` as the co_filename of its code"""
+    if options.backend == "python":
+        code = compile_writer(build_writer(source, options), filename)
+        module_header(f, source_hash, options.magic, mtime, size)
+        marshal.dump(code, f)
+    else:
+        ctx = build_context(source, options)
+        compile_context(
+            f, ctx, source_hash, options.bytecode_target, mtime, size, filename
+        )
+
+
+def compile_file(
+    path: str, output: str, options: CompileOptions, force: bool = False
+) -> bool:
+    """Compiles the brainfuck file at `path` into `output`
+
+    The output is skipped when it already holds a hash based .pyc whose hash
+    matches the source and options.
+
+    Returns:
+        bool: whether the file was compiled, False if the cached output was kept
+    """
+    with open(path, "rb") as f:
+        digest = options.hasher()
+        for chunk in read_chunks(f):
+            digest.update(chunk)
+        source_hash = digest.digest()
+        if not force and read_source_hash(output, options.magic) == source_hash:
+            return False
+        f.seek(0)
+        buffer = BytesIO()
+        write_pyc(buffer, f, options, source_hash, filename=path)
+    # write next to the output and rename, so concurrent runs never see a
+    # partially written file
+    temporary = f"{output}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(buffer.getbuffer())
+    os.replace(temporary, output)
+    return True
+
+
+def expand_inputs(patterns: list[str]) -> list[str]:
+    paths: list[str] = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise FileNotFoundError(f"no files match {pattern}")
+        paths.extend(match for match in matches if match not in paths)
+    return paths
+
+
+def output_paths(paths: list[str], output_dir: str) -> list[str]:
+    outputs = [
+        os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".pyc")
+        for path in paths
+    ]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("inputs with the same name would overwrite each other")
+    return outputs
+
+
+def compile_many(
+    paths: list[str],
+    outputs: list[str],
+    options: CompileOptions,
+    jobs: Optional[int] = None,
+    force: bool = False,
+) -> list[bool]:
+    """Compiles every file in `paths` to the matching entry of `outputs` using a
+    pool of `jobs` processes
+
+    Returns:
+        list[bool]: for each input, whether it was compiled or found in cache
+    """
+    if len(paths) == 1 or jobs == 1:
+        return [
+            compile_file(path, output, options, force)
+            for path, output in zip(paths, outputs)
+        ]
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(
+            executor.map(
+                compile_file,
+                paths,
+                outputs,
+                [options] * len(paths),
+                [force] * len(paths),
+            )
+        )
+
+
+def main():
+    args = parser.parse_args()
+    tape = Tape(args.tape, args.tape_size, args.cell_bits, args.grow_tape)
+    options = CompileOptions(
+        args.fast_locals,
+        tape,
+        backend=args.backend,
+        target=args.target,
+        propagate_constants=args.propagate_constants,
+        precompute_steps=args.precompute,
+        resumable=args.resumable,
+        safety=args.safety,
+    )
+    paths = expand_inputs(args.inputs)
+    if args.output_dir is None and len(paths) == 1:
+        outputs = ["./out.pyc"]
+    else:
+        os.makedirs(args.output_dir or ".", exist_ok=True)
+        outputs = output_paths(paths, args.output_dir or ".")
+    compiled = compile_many(paths, outputs, options, args.jobs, args.force)
+    if len(paths) == 1:
+        print(f"Compilation ended. Output written to {outputs[0]}")
+        return
+    for path, output, fresh in zip(paths, outputs, compiled):
+        print(f"{path} -> {output}{'' if fresh else ' (cached)'}")
+    print(f"Compiled {sum(compiled)} of {len(paths)} files")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,380 @@
+import sys
+import types
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import groupby
+from operator import itemgetter
+from typing import Optional, Sequence
+
+import bfir
+from assembler import encode_lines
+from bfops import (
+    INPUT_CHUNK_SIZE,
+    OUTPUT_BUFFER_SIZE,
+    TAPE_END_ERROR,
+    TAPE_START_ERROR,
+    Tape,
+)
+
+# CPython refuses more than 20 nested blocks in a single function, the
+# program can be inside a try and a scan adds a loop
+MAX_LOOP_DEPTH = 19
+# longest run of `.` written to the output buffer by a single statement
+MAX_OUTPUT_RUN = 64
+
+
+class StepLimitExceeded(RuntimeError):
+    """The program ran more instructions than allowed"""
+
+
+@dataclass
+class SourceWriter:
+    """Lowers the IR into the source of a `main` function, the counterpart of
+    `bfops.Context` for the python backend
+
+    The program keeps the same variables as the bytecode backend (`memory`,
+    `pointer`, `output`, ...) as function locals, loops become `while` loops
+    and the folded nodes become single statements or bulk tape methods.
+
+    With `count_steps`, the program also counts the IR nodes it executes and
+    leaves the total in the module global `steps`. With `max_steps` as well,
+    it raises StepLimitExceeded (looked up in the module globals) once it has
+    executed more nodes than that.
+
+    With `resumable`, `main` is a generator doing its I/O through yield like
+    the resumable programs of `bfops.Context`, and the module only defines it.
+    With `checked`, scans check the cells they visit and a fixed size tape
+    gets a zero cell past its end, like `Context.checked`.
+
+    `bf_lines` holds the line every source line stands for in the brainfuck
+    program, following `Context.set_line`, for `compile_source` to swap in.
+    """
+
+    tape: Tape = Tape()
+    reach: int = 0
+    lines: list[str] = field(default_factory=list)
+    bf_lines: list[int] = field(default_factory=list)
+    bf_line: int = 0
+    depth: int = 0
+    count_steps: bool = False
+    max_steps: Optional[int] = None
+    resumable: bool = False
+    checked: bool = False
+
+    def line(self, text: str, depth: Optional[int] = None):
+        depth = self.depth + 1 if depth is None else depth
+        self.lines.append("    " * depth + text)
+        self.bf_lines.append(self.bf_line)
+
+    def cell(self, offset: int = 0) -> str:
+        if offset > 0:
+            return f"memory[pointer + {offset}]"
+        if offset < 0:
+            return f"memory[pointer - {-offset}]"
+        return "memory[pointer]"
+
+    def new_tape(self, size: int) -> str:
+        if self.tape.backend == "bytearray":
+            return f"bytearray({size})"
+        if self.tape.backend == "array":
+            return f"array({self.tape.typecode!r}, [0]) * {size}"
+        return f"[0] * {size}"
+
+    def init_io(self):
+        if not self.resumable:
+            self.line("from sys import stdin, stdout")
+            self.line("stdin = stdin.buffer")
+            self.line("stdout = stdout.buffer")
+            self.line("stdout_write = stdout.write")
+            self.line("stdin_read = stdin.read1")
+        self.line(f"output = bytearray({OUTPUT_BUFFER_SIZE})")
+        self.line("output_view = memoryview(output)")
+        self.line("output_len = 0")
+        self.line('input = b""')
+        self.line("input_pos = 0")
+
+    def flush_output(self, flush_stream: bool = False):
+        if self.resumable:
+            self.line("if output_len:")
+            self.line("    yield bytes(output_view[:output_len])")
+            self.line("    output_len = 0")
+            return
+        self.line("stdout_write(output_view[:output_len])")
+        self.line("output_len = 0")
+        if flush_stream:
+            self.line("stdout.flush()")
+
+    def init_memory(self):
+        if self.tape.backend == "array":
+            self.line("from array import array")
+        size = self.tape.size
+        if self.checked and not self.tape.grow:
+            size += 1
+        self.line(f"memory = {self.new_tape(size)}")
+        if self.tape.grow:
+            self.line(f"tape_chunk = {self.new_tape(self.tape.size)}")
+
+    def init_program(self):
+        self.line("def main():", depth=0)
+        self.init_io()
+        if not self.resumable:
+            # flush the output buffer even when the program raises, a
+            # generator can't yield from there
+            self.line("try:")
+            self.depth += 1
+        self.init_memory()
+        self.line("pointer = 0")
+        if self.count_steps:
+            self.line("steps = 0")
+        self.ensure_tape()
+
+    def ensure_tape(self):
+        """Grows the tape until `memory[pointer + reach]` is valid"""
+        if not self.tape.grow:
+            return
+        self.line(f"while pointer + {self.reach} >= len(memory):")
+        self.line("    memory += tape_chunk")
+
+    def move(self, step: int):
+        if step > 0:
+            self.line(f"pointer += {step}")
+            self.ensure_tape()
+        else:
+            self.line(f"pointer -= {-step}")
+
+    def wrapped(self, value: str, wrap: bool = True) -> str:
+        return f"({value}) & {self.tape.mask}" if wrap else value
+
+    def check(self, low: Optional[int] = None, high: Optional[int] = None):
+        """Raises IndexError unless 0 <= pointer + low and pointer + high <
+        tape size, bounds left to None aren't checked"""
+        if low is not None:
+            self.line(f"if pointer < {-low}:")
+            self.line(f"    raise IndexError({TAPE_START_ERROR!r})")
+        if high is not None:
+            self.line(f"if pointer >= {self.tape.size - high}:")
+            self.line(f"    raise IndexError({TAPE_END_ERROR!r})")
+
+    def add(self, value: int, offset: int = 0, wrap: bool = True):
+        cell = self.cell(offset)
+        sign = "+" if value > 0 else "-"
+        self.line(f"{cell} = {self.wrapped(f'{cell} {sign} {abs(value)}', wrap)}")
+
+    def clear(self, offset: int = 0):
+        self.line(f"{self.cell(offset)} = 0")
+
+    def mul_add(self, offset: int, factor: int, source: int = 0, wrap: bool = True):
+        cell = self.cell(offset)
+        product = self.cell(source)
+        if factor != 1:
+            product = f"{product} * {factor}"
+        self.line(f"{cell} = {self.wrapped(f'{cell} + {product}', wrap)}")
+
+    def product_add(
+        self, offset: int, factor: int, source: int, other: int, wrap: bool = True
+    ):
+        cell = self.cell(offset)
+        product = f"{self.cell(source)} * {self.cell(other)}"
+        if factor != 1:
+            product = f"{product} * {factor}"
+        self.line(f"{cell} = {self.wrapped(f'{cell} + {product}', wrap)}")
+
+    def scan(self, step: int):
+        depth = self.depth
+        if step == 1:
+            # index raises ValueError without a zero cell left, the loop
+            # grows the tape or runs off its end instead
+            self.line("if not memory[-1]:")
+            self.line("    pointer = memory.index(0, pointer)")
+            self.depth += 1
+            self.ensure_tape()
+            self.depth -= 1
+            self.line("else:")
+            self.depth += 1
+        if step == -1 and self.tape.backend == "bytearray":
+            # -1 off the tape, for the check that follows a scan to catch
+            find = "rfind" if self.checked else "rindex"
+            self.line(f"pointer = memory.{find}(0, 0, pointer + 1)")
+            return
+        self.line("while memory[pointer]:")
+        self.depth += 1
+        self.move(step)
+        if self.checked:
+            if step < 0:
+                self.check(low=0)
+            elif not self.tape.grow:
+                self.check(high=0)
+        self.depth = depth
+
+    def output(self, offsets: list[int]):
+        """Appends a run of cells to the output buffer in one slice store"""
+        count = len(offsets)
+        values = [self.cell(offset) for offset in offsets]
+        if self.tape.cell_bits > 8:
+            values = [f"{value} & 255" for value in values]
+        self.line(f"if output_len > {OUTPUT_BUFFER_SIZE - count}:")
+        self.depth += 1
+        self.flush_output()
+        self.depth -= 1
+        if count == 1:
+            self.line(f"output[output_len] = {values[0]}")
+        else:
+            run = f"output[output_len:output_len + {count}]"
+            self.line(f"{run} = {', '.join(values)},")
+        self.line(f"output_len += {count}")
+
+    def write(self, data: bytes):
+        """Appends bytes known at compile time to the output buffer"""
+        if len(data) > OUTPUT_BUFFER_SIZE:
+            self.flush_output()
+            self.line(f"{'yield' if self.resumable else 'stdout_write'}({data!r})")
+            return
+        self.line(f"if output_len > {OUTPUT_BUFFER_SIZE - len(data)}:")
+        self.depth += 1
+        self.flush_output()
+        self.depth -= 1
+        self.line(f"output[output_len:output_len + {len(data)}] = {data!r}")
+        self.line(f"output_len += {len(data)}")
+
+    def input(self, offset: int = 0):
+        """Reads a byte from the input buffer, 0 at the end of input"""
+        self.line("if input_pos >= len(input):")
+        self.depth += 1
+        # let interactive programs show their prompt before blocking on input
+        self.flush_output(flush_stream=True)
+        if self.resumable:
+            self.line('input = (yield None) or b""')
+        else:
+            self.line(f"input = stdin_read({INPUT_CHUNK_SIZE})")
+        self.line("input_pos = 0")
+        self.depth -= 1
+        self.line("if input:")
+        self.line(f"    {self.cell(offset)} = input[input_pos]")
+        self.line("    input_pos += 1")
+        self.line("else:")
+        self.line(f"    {self.cell(offset)} = 0")
+
+    def loop(self, body: list[bfir.Node], position: Optional[int] = None):
+        if self.depth >= MAX_LOOP_DEPTH:
+            raise ValueError(
+                f"loops nested in more than {MAX_LOOP_DEPTH} blocks are not "
+                "supported by the python backend"
+            )
+        outer = self.bf_line
+        if position is not None:
+            self.bf_line = position + 1
+        self.line("while memory[pointer]:")
+        self.depth += 1
+        size = len(self.lines)
+        emit_nodes(body, self)
+        if len(self.lines) == size:
+            self.line("pass")
+        self.depth -= 1
+        self.bf_line = outer
+
+    def terminate(self):
+        if not self.resumable:
+            self.line("finally:", depth=self.depth)
+        self.flush_output(flush_stream=True)
+        if not self.resumable:
+            self.depth -= 1
+        if self.count_steps:
+            self.line("return steps")
+        if self.resumable:
+            # started by whoever drives the generator
+            return
+        self.line(f"{'steps = ' if self.count_steps else ''}main()", depth=0)
+
+    @property
+    def source(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def emit_nodes(nodes: list[bfir.Node], writer: SourceWriter):
+    count = len(nodes)
+    if writer.max_steps is not None:
+        # an empty loop body still has to run out of steps
+        count = max(count, 1)
+    if writer.count_steps and count:
+        writer.line(f"steps += {count}")
+        if writer.max_steps is not None:
+            writer.line(f"if steps > {writer.max_steps}:")
+            writer.line("    raise StepLimitExceeded(steps)")
+    outputs: list[int] = []
+    for node in nodes:
+        if isinstance(node, bfir.Output):
+            outputs.append(node.offset)
+            if len(outputs) == MAX_OUTPUT_RUN:
+                writer.output(outputs)
+                outputs = []
+            continue
+        if outputs:
+            writer.output(outputs)
+            outputs = []
+        if isinstance(node, bfir.Add):
+            writer.add(node.value, node.offset, node.wrap)
+        elif isinstance(node, bfir.Move):
+            writer.move(node.value)
+        elif isinstance(node, bfir.Write):
+            writer.write(node.data)
+        elif isinstance(node, bfir.Input):
+            writer.input(node.offset)
+        elif isinstance(node, bfir.Clear):
+            writer.clear(node.offset)
+        elif isinstance(node, bfir.MulAdd):
+            writer.mul_add(node.offset, node.factor, node.source, node.wrap)
+        elif isinstance(node, bfir.ProductAdd):
+            writer.product_add(
+                node.offset, node.factor, node.source, node.other, node.wrap
+            )
+        elif isinstance(node, bfir.Scan):
+            writer.scan(node.step)
+        elif isinstance(node, bfir.Loop):
+            writer.loop(node.body, node.position)
+        elif isinstance(node, bfir.Check):
+            writer.check(node.low, node.high)
+        else:
+            raise ValueError(f"unsupported node {node}")
+    if outputs:
+        writer.output(outputs)
+
+
+def compile_source(
+    source: str, filename: str = "<brainfuck>", bf_lines: Optional[Sequence[int]] = None
+) -> types.CodeType:
+    """Compiles the generated source with the running interpreter
+
+    Args:
+        bf_lines (Optional[Sequence[int]]): `SourceWriter.bf_lines`, when given
+            the line table is rewritten to report them instead of the lines of
+            the python source, like the bytecode backend does
+    """
+    code = compile(source, filename, "exec", dont_inherit=True, optimize=2)
+    if bf_lines is None:
+        return code
+    return relocate_lines(code, bf_lines)
+
+
+def relocate_lines(code: types.CodeType, bf_lines: Sequence[int]) -> types.CodeType:
+    """Replaces every line `n` in the line tables of `code` and the code
+    objects nested in it with `bf_lines[n - 1]`"""
+    ranges: list[tuple[int, int, int]] = []
+    # newer versions yield a range per instruction, group them by line first
+    for line, group in groupby(code.co_lines(), itemgetter(2)):
+        start, end, _ = next(group)
+        for _, end, _ in deque(group, maxlen=1):
+            pass
+        bf_line = bf_lines[line - 1] if line else 0
+        if ranges and ranges[-1][2] == bf_line and ranges[-1][1] == start // 2:
+            ranges[-1] = (ranges[-1][0], end // 2, bf_line)
+        else:
+            ranges.append((start // 2, end // 2, bf_line))
+    consts = tuple(
+        relocate_lines(const, bf_lines) if isinstance(const, types.CodeType) else const
+        for const in code.co_consts
+    )
+    return code.replace(
+        co_firstlineno=0,
+        co_linetable=encode_lines(ranges, sys.version_info >= (3, 11)),
+        co_consts=consts,
+    )
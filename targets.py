@@ -0,0 +1,410 @@
+"""Per version data needed to turn the instruction stream of `bfops.Context`
+into a code object for a given CPython release
+
+`Context` always emits 3.10 instructions (`bfops.PyOpCode`). Newer releases
+get them rewritten by `assembler.lower` following the tables below, which only
+list the opcodes the compiler actually uses.
+"""
+import sys
+from dataclasses import dataclass, field
+from typing import Mapping, NamedTuple, Optional
+
+from bfops import ABSOLUTE_JUMPS, RELATIVE_JUMPS, PyOpCode
+
+
+class Op(NamedTuple):
+    """Instruction replacing a 3.10 one, with `value` as argument or, when
+    None, the argument of the replaced instruction as `(arg << shift) | flag`"""
+
+    name: str
+    value: Optional[int] = None
+    shift: int = 0
+    flag: int = 0
+
+
+# fields of a code object in marshal order
+CODE_FIELDS_310 = (
+    "argcount",
+    "posonlyargcount",
+    "kwonlyargcount",
+    "nlocals",
+    "stacksize",
+    "flags",
+    "code",
+    "consts",
+    "names",
+    "varnames",
+    "freevars",
+    "cellvars",
+    "filename",
+    "name",
+    "firstlineno",
+    "linetable",
+)
+CODE_FIELDS_311 = (
+    "argcount",
+    "posonlyargcount",
+    "kwonlyargcount",
+    "stacksize",
+    "flags",
+    "code",
+    "consts",
+    "names",
+    "localsplusnames",
+    "localspluskinds",
+    "filename",
+    "name",
+    "qualname",
+    "firstlineno",
+    "linetable",
+    "exceptiontable",
+)
+
+CO_NOFREE = 0x40
+
+# 3.12 and later pack a mask of the orderings matching the comparison next to
+# it, which the specialized integer compare relies on; index by `PyCmpOp`
+COMPARE_MASKS = (2, 10, 8, 7, 4, 12)
+
+
+@dataclass(frozen=True)
+class Target:
+    version: tuple[int, int]
+    magic: bytes
+    # opname -> opcode
+    opcodes: Mapping[str, int]
+    # opname -> number of inline CACHE entries following the instruction
+    caches: Mapping[str, int] = field(default_factory=dict)
+    # opname -> "absolute", "forward" or "backward"
+    jumps: Mapping[str, str] = field(default_factory=dict)
+    # 3.10 opname -> instructions replacing it
+    rewrites: Mapping[str, tuple[Op, ...]] = field(default_factory=dict)
+    # 3.10 jump opname -> (forward opname, backward opname), a missing
+    # backward opname means jumping back needs an unconditional jump
+    branches: Mapping[str, tuple[str, Optional[str]]] = field(
+        default_factory=dict
+    )
+    # COMPARE_OP argument is `(cmp << compare_shift) | mask`
+    compare_shift: int = 0
+    compare_masks: bool = False
+    # COMPARE_OP flag asking for a bool result, 0 if not available
+    compare_bool: int = 0
+    # conditional jumps only accept bools and need a TO_BOOL before them
+    to_bool: bool = False
+    # CALL takes the callable below a NULL instead of on top of one
+    null_above_callable: bool = False
+    # MAKE_FUNCTION takes the qualified name from the stack
+    qualname_on_stack: bool = True
+    # MAKE_FUNCTION takes no flags, SET_FUNCTION_ATTRIBUTE sets each extra
+    function_attributes: bool = False
+    # code objects start with a RESUME
+    resume: bool = False
+    # co_linetable holds location entries (PEP 657) rather than pairs of
+    # bytecode and line deltas
+    location_table: bool = False
+    # extra stack slots the rewritten instructions may need
+    stack_margin: int = 0
+    code_fields: tuple[str, ...] = CODE_FIELDS_310
+    code_flags: int = 0
+
+    @property
+    def name(self) -> str:
+        return ".".join(map(str, self.version))
+
+    @property
+    def abstract(self) -> bool:
+        """Whether the 3.10 instruction stream is used as is"""
+        return self.version == (3, 10)
+
+    def opcode(self, name: str) -> int:
+        try:
+            return self.opcodes[name]
+        except KeyError:
+            raise ValueError(f"{name} is not supported on Python {self.name}")
+
+
+STACK_REWRITES = {
+    "DUP_TOP": (Op("COPY", 1),),
+    "DUP_TOP_TWO": (Op("COPY", 2), Op("COPY", 2)),
+    "ROT_TWO": (Op("SWAP", 2),),
+    "ROT_THREE": (Op("SWAP", 3), Op("SWAP", 2)),
+}
+# generators start by returning themselves and resume after every yield
+GENERATOR_REWRITES = {
+    "GEN_START": (Op("RETURN_GENERATOR", 0), Op("POP_TOP", 0), Op("RESUME", 0)),
+    "YIELD_VALUE": (Op("YIELD_VALUE", 0), Op("RESUME", 1)),
+}
+# NB_* operator numbers of BINARY_OP
+BINARY_REWRITES = {
+    "BINARY_ADD": (Op("BINARY_OP", 0),),
+    "BINARY_AND": (Op("BINARY_OP", 1),),
+    "BINARY_MULTIPLY": (Op("BINARY_OP", 5),),
+    "BINARY_SUBTRACT": (Op("BINARY_OP", 10),),
+    "INPLACE_ADD": (Op("BINARY_OP", 13),),
+    "INPLACE_AND": (Op("BINARY_OP", 14),),
+    "INPLACE_MULTIPLY": (Op("BINARY_OP", 18),),
+    "INPLACE_SUBTRACT": (Op("BINARY_OP", 23),),
+}
+
+TARGET_310 = Target(
+    version=(3, 10),
+    magic=(3439).to_bytes(2, "little") + b"\r\n",
+    opcodes={op.name: op.value for op in PyOpCode},
+    jumps={
+        **{op.name: "absolute" for op in ABSOLUTE_JUMPS},
+        **{op.name: "forward" for op in RELATIVE_JUMPS},
+    },
+    code_flags=CO_NOFREE,
+)
+TARGET_311 = Target(
+    version=(3, 11),
+    magic=(3495).to_bytes(2, "little") + b"\r\n",
+    opcodes={
+        "CACHE": 0,
+        "POP_TOP": 1,
+        "PUSH_NULL": 2,
+        "NOP": 9,
+        "BINARY_SUBSCR": 25,
+        "STORE_SUBSCR": 60,
+        "RETURN_GENERATOR": 75,
+        "RETURN_VALUE": 83,
+        "YIELD_VALUE": 86,
+        "STORE_NAME": 90,
+        "SWAP": 99,
+        "LOAD_CONST": 100,
+        "LOAD_NAME": 101,
+        "BUILD_TUPLE": 102,
+        "BUILD_LIST": 103,
+        "LOAD_ATTR": 106,
+        "COMPARE_OP": 107,
+        "IMPORT_NAME": 108,
+        "IMPORT_FROM": 109,
+        "JUMP_FORWARD": 110,
+        "POP_JUMP_FORWARD_IF_FALSE": 114,
+        "POP_JUMP_FORWARD_IF_TRUE": 115,
+        "LOAD_GLOBAL": 116,
+        "RERAISE": 119,
+        "COPY": 120,
+        "BINARY_OP": 122,
+        "LOAD_FAST": 124,
+        "STORE_FAST": 125,
+        "RAISE_VARARGS": 130,
+        "MAKE_FUNCTION": 132,
+        "BUILD_SLICE": 133,
+        "JUMP_BACKWARD": 140,
+        "EXTENDED_ARG": 144,
+        "RESUME": 151,
+        "LOAD_METHOD": 160,
+        "PRECALL": 166,
+        "CALL": 171,
+        "POP_JUMP_BACKWARD_IF_FALSE": 175,
+        "POP_JUMP_BACKWARD_IF_TRUE": 176,
+    },
+    caches={
+        "LOAD_GLOBAL": 5,
+        "LOAD_ATTR": 4,
+        "LOAD_METHOD": 10,
+        "PRECALL": 1,
+        "CALL": 4,
+        "BINARY_SUBSCR": 4,
+        "STORE_SUBSCR": 1,
+        "BINARY_OP": 1,
+        "COMPARE_OP": 2,
+    },
+    jumps={
+        "JUMP_FORWARD": "forward",
+        "POP_JUMP_FORWARD_IF_FALSE": "forward",
+        "POP_JUMP_FORWARD_IF_TRUE": "forward",
+        "JUMP_BACKWARD": "backward",
+        "POP_JUMP_BACKWARD_IF_FALSE": "backward",
+        "POP_JUMP_BACKWARD_IF_TRUE": "backward",
+    },
+    rewrites={
+        **STACK_REWRITES,
+        **BINARY_REWRITES,
+        **GENERATOR_REWRITES,
+        "LOAD_GLOBAL": (Op("LOAD_GLOBAL", shift=1),),
+        "CALL_METHOD": (Op("PRECALL"), Op("CALL")),
+    },
+    branches={
+        "POP_JUMP_IF_FALSE": (
+            "POP_JUMP_FORWARD_IF_FALSE",
+            "POP_JUMP_BACKWARD_IF_FALSE",
+        ),
+        "POP_JUMP_IF_TRUE": (
+            "POP_JUMP_FORWARD_IF_TRUE",
+            "POP_JUMP_BACKWARD_IF_TRUE",
+        ),
+        "JUMP_ABSOLUTE": ("JUMP_FORWARD", "JUMP_BACKWARD"),
+        "JUMP_FORWARD": ("JUMP_FORWARD", None),
+    },
+    qualname_on_stack=False,
+    resume=True,
+    location_table=True,
+    stack_margin=1,
+    code_fields=CODE_FIELDS_311,
+)
+TARGET_312 = Target(
+    version=(3, 12),
+    magic=(3531).to_bytes(2, "little") + b"\r\n",
+    opcodes={
+        "CACHE": 0,
+        "POP_TOP": 1,
+        "PUSH_NULL": 2,
+        "NOP": 9,
+        "BINARY_SUBSCR": 25,
+        "STORE_SUBSCR": 60,
+        "RETURN_GENERATOR": 75,
+        "RETURN_VALUE": 83,
+        "STORE_NAME": 90,
+        "SWAP": 99,
+        "LOAD_CONST": 100,
+        "LOAD_NAME": 101,
+        "BUILD_TUPLE": 102,
+        "BUILD_LIST": 103,
+        "LOAD_ATTR": 106,
+        "COMPARE_OP": 107,
+        "IMPORT_NAME": 108,
+        "IMPORT_FROM": 109,
+        "JUMP_FORWARD": 110,
+        "POP_JUMP_IF_FALSE": 114,
+        "POP_JUMP_IF_TRUE": 115,
+        "LOAD_GLOBAL": 116,
+        "RERAISE": 119,
+        "COPY": 120,
+        "BINARY_OP": 122,
+        "LOAD_FAST": 124,
+        "STORE_FAST": 125,
+        "RAISE_VARARGS": 130,
+        "MAKE_FUNCTION": 132,
+        "BUILD_SLICE": 133,
+        "JUMP_BACKWARD": 140,
+        "EXTENDED_ARG": 144,
+        "YIELD_VALUE": 150,
+        "RESUME": 151,
+        "CALL": 171,
+    },
+    caches={
+        "LOAD_GLOBAL": 4,
+        "LOAD_ATTR": 9,
+        "CALL": 3,
+        "BINARY_SUBSCR": 1,
+        "STORE_SUBSCR": 1,
+        "BINARY_OP": 1,
+        "COMPARE_OP": 1,
+    },
+    jumps={
+        "JUMP_FORWARD": "forward",
+        "POP_JUMP_IF_FALSE": "forward",
+        "POP_JUMP_IF_TRUE": "forward",
+        "JUMP_BACKWARD": "backward",
+    },
+    rewrites={
+        **STACK_REWRITES,
+        **BINARY_REWRITES,
+        **GENERATOR_REWRITES,
+        "LOAD_GLOBAL": (Op("LOAD_GLOBAL", shift=1),),
+        "LOAD_ATTR": (Op("LOAD_ATTR", shift=1),),
+        "LOAD_METHOD": (Op("LOAD_ATTR", shift=1, flag=1),),
+        "CALL_METHOD": (Op("CALL"),),
+    },
+    branches={
+        "POP_JUMP_IF_FALSE": ("POP_JUMP_IF_FALSE", None),
+        "POP_JUMP_IF_TRUE": ("POP_JUMP_IF_TRUE", None),
+        "JUMP_ABSOLUTE": ("JUMP_FORWARD", "JUMP_BACKWARD"),
+        "JUMP_FORWARD": ("JUMP_FORWARD", None),
+    },
+    compare_shift=4,
+    compare_masks=True,
+    qualname_on_stack=False,
+    resume=True,
+    location_table=True,
+    stack_margin=1,
+    code_fields=CODE_FIELDS_311,
+)
+TARGET_313 = Target(
+    version=(3, 13),
+    magic=(3571).to_bytes(2, "little") + b"\r\n",
+    opcodes={
+        "CACHE": 0,
+        "BINARY_SUBSCR": 5,
+        "MAKE_FUNCTION": 26,
+        "RETURN_GENERATOR": 35,
+        "NOP": 30,
+        "POP_TOP": 32,
+        "PUSH_NULL": 34,
+        "RETURN_VALUE": 36,
+        "STORE_SUBSCR": 39,
+        "TO_BOOL": 40,
+        "BINARY_OP": 45,
+        "BUILD_LIST": 47,
+        "BUILD_SLICE": 50,
+        "BUILD_TUPLE": 52,
+        "CALL": 53,
+        "COMPARE_OP": 58,
+        "COPY": 61,
+        "EXTENDED_ARG": 71,
+        "IMPORT_FROM": 74,
+        "IMPORT_NAME": 75,
+        "JUMP_BACKWARD": 77,
+        "JUMP_FORWARD": 79,
+        "LOAD_ATTR": 82,
+        "LOAD_CONST": 83,
+        "LOAD_FAST": 85,
+        "LOAD_GLOBAL": 91,
+        "LOAD_NAME": 92,
+        "POP_JUMP_IF_FALSE": 97,
+        "POP_JUMP_IF_TRUE": 100,
+        "RAISE_VARARGS": 101,
+        "RERAISE": 102,
+        "STORE_FAST": 110,
+        "STORE_NAME": 114,
+        "SWAP": 115,
+        "SET_FUNCTION_ATTRIBUTE": 106,
+        "YIELD_VALUE": 118,
+        "RESUME": 149,
+    },
+    caches={
+        "LOAD_GLOBAL": 4,
+        "LOAD_ATTR": 9,
+        "CALL": 3,
+        "BINARY_SUBSCR": 1,
+        "STORE_SUBSCR": 1,
+        "BINARY_OP": 1,
+        "COMPARE_OP": 1,
+        "POP_JUMP_IF_FALSE": 1,
+        "POP_JUMP_IF_TRUE": 1,
+        "JUMP_BACKWARD": 1,
+        "TO_BOOL": 3,
+    },
+    jumps=TARGET_312.jumps,
+    rewrites=TARGET_312.rewrites,
+    branches=TARGET_312.branches,
+    compare_shift=5,
+    compare_masks=True,
+    compare_bool=16,
+    to_bool=True,
+    null_above_callable=True,
+    qualname_on_stack=False,
+    function_attributes=True,
+    resume=True,
+    location_table=True,
+    stack_margin=1,
+    code_fields=CODE_FIELDS_311,
+)
+
+TARGETS = {
+    target.name: target
+    for target in (TARGET_310, TARGET_311, TARGET_312, TARGET_313)
+}
+# the running interpreter when it is supported, so the output can be executed
+DEFAULT_TARGET = TARGETS.get(
+    f"{sys.version_info[0]}.{sys.version_info[1]}", TARGET_310
+)
+
+
+def get_target(name: str) -> Target:
+    try:
+        return TARGETS[name]
+    except KeyError:
+        raise ValueError(f"unsupported target Python {name}") from None